@@ -1,22 +1,242 @@
-from typing import Optional, List
+import os
+import time
+from pathlib import Path
+from typing import Optional, List, Mapping, Union
 import pandas as pd
 import torch
 import numpy as np
 from pydantic import BaseModel
-from fastapi import FastAPI, Query
-from starlette.responses import JSONResponse
+from fastapi import FastAPI, Query, Request, HTTPException
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response
 from joblib import load
 
 import uvicorn
 
-from src.models.pipes import load_preprocessing_pipe
-from src.models.pipes import load_label_encoder
+from src.models.batching import MicroBatcher
+from src.models.cache import PredictionCache, make_key
+from src.models.instrumentation import Instrumentation, MetricsRegistry
+from src.models.instrumentation import batch_context
+from src.models.payloads import parse_payload, PayloadError
+from src.models.payloads import UnsupportedPayloadError
+from src.models.pipes import FEATURES
 from src.models.pytorch import get_device
+from src.models.registry import ArtifactRegistry, Artifacts
 
 app = FastAPI()
 
-model = torch.load('../models/model.torch',
-                   map_location=lambda storage, loc: storage)
+MODELS_DIR = Path(os.getenv('MODELS_DIR', '../models'))
+# "model" predicts with the model only, "table" answers from the lookup table
+# of the full input grid and falls back to the model for the other inputs
+SERVING_MODE = os.getenv('SERVING_MODE', 'model')
+
+# The artifacts are loaded once per worker and reloaded in place when the
+# files in the models directory change
+registry = ArtifactRegistry(
+    models_dir=MODELS_DIR,
+    model_name=os.getenv('MODEL_NAME', 'model.pt'),
+    pipe_name=os.getenv('PIPE_NAME', 'pipe.sav'),
+    label_encoder_name=os.getenv('LABEL_ENCODER_NAME', 'label_encoder.sav'),
+    check_interval=float(os.getenv('MODEL_RELOAD_INTERVAL', '5')),
+    lookup_dir=(MODELS_DIR / os.getenv('LOOKUP_TABLE_DIR', 'lookup')
+                if SERVING_MODE == 'table' else None),
+    # "bfloat16" runs the model under bfloat16 autocast, from PyTorch 1.10
+    bf16=os.getenv('INFERENCE_DTYPE', 'float32') == 'bfloat16'
+)
+
+
+# Maximum number of rows scored in one forward pass
+INFERENCE_BATCH_SIZE = int(os.getenv('INFERENCE_BATCH_SIZE', '4096'))
+# Maximum number of rows accepted by the bulk endpoint
+BULK_MAX_ROWS = int(os.getenv('BULK_MAX_ROWS', '100000'))
+
+# Optional cache of the predictions of repeated observations
+CACHE_SIZE = int(os.getenv('PREDICTION_CACHE_SIZE', '0'))
+cache = PredictionCache(
+    maxsize=CACHE_SIZE,
+    max_bytes=int(float(os.getenv('PREDICTION_CACHE_MAX_MB', '64')) * 2 ** 20),
+    ttl=float(os.getenv('PREDICTION_CACHE_TTL', '0')) or None
+) if CACHE_SIZE > 0 else None
+
+
+# Latency and throughput metrics, served on /metrics; a fraction
+# TRACE_SAMPLE_RATE of the requests also get a trace of their stages
+instrumentation = Instrumentation(
+    sample_rate=float(os.getenv('TRACE_SAMPLE_RATE', '0'))
+)
+stage = instrumentation.stage
+
+
+def encode_features(artifacts: Artifacts,
+                    X: Union[pd.DataFrame, Mapping]) -> torch.Tensor:
+    """
+    Encodes the observations with the compiled pipe, writing the features
+    straight into a float32 tensor, or with the pipe if it is not available.
+    - **artifacts**: the pipes to use
+    - **X**:         dataframe, or mapping of column to values, of the
+                     `FEATURES` columns
+    - **return**:    tensor of the features
+    """
+    compiled_pipe = artifacts.compiled_pipe
+    if compiled_pipe is None:
+        with stage('dataframe'):
+            df = pd.DataFrame(X)[FEATURES]
+        with stage('transform'):
+            df_trans = artifacts.pipe.transform(df)
+        with stage('tensor'):
+            return torch.Tensor(np.array(df_trans))
+
+    with stage('transform'):
+        tensor = torch.empty(len(X['brewery_name']), compiled_pipe.n_features)
+        compiled_pipe.transform(X, out=tensor.numpy())
+
+    return tensor
+
+
+def predict_indices(artifacts: Artifacts,
+                    X: Union[pd.DataFrame, Mapping]) -> np.ndarray:
+    """
+    Predicts the encoded beer styles of all the observations, from the
+    lookup table when it is loaded and with the model otherwise.
+    - **artifacts**: the model, pipe and label encoder to use
+    - **X**:         dataframe, or mapping of column to values, of the
+                     `FEATURES` columns
+    - **return**:    array of encoded beer styles
+    """
+    table = artifacts.lookup_table
+    if table is not None:
+        with stage('lookup'):
+            pred, found = table.lookup_many(X)
+        missed = np.flatnonzero(~found)
+        if len(missed) > 0:
+            subset = {col: np.asarray(X[col])[missed] for col in FEATURES}
+            pred[missed] = predict_model(artifacts, subset)
+        return pred
+
+    return predict_model(artifacts, X)
+
+
+def predict_model(artifacts: Artifacts,
+                  X: Union[pd.DataFrame, Mapping]) -> np.ndarray:
+    device = get_device()
+
+    # Encoding the data for prediction
+    df_tensor = encode_features(artifacts, X)
+    with stage('tensor'):
+        df_tensor = df_tensor.to(device)
+    instrumentation.batch_size.labels('model').observe(len(df_tensor))
+
+    # Prediction, in slices to bound the memory of the activations
+    with stage('forward'):
+        pred = torch.cat([
+            artifacts.model(batch).argmax(1)
+            for batch in torch.split(df_tensor, INFERENCE_BATCH_SIZE)
+        ])
+
+        return pred.cpu().numpy()
+
+
+def predict_frame(artifacts: Artifacts,
+                  X: Union[pd.DataFrame, Mapping]) -> List[str]:
+    """
+    Predicts the beer styles of all the observations in one batch.
+    - **artifacts**: the model, pipe and label encoder to use
+    - **X**:         dataframe, or mapping of column to values, of the
+                     `FEATURES` columns
+    - **return**:    list of beer styles
+    """
+    pred = predict_indices(artifacts, X)
+
+    # Decode results to produce human readable classes
+    with stage('decode'):
+        return list(artifacts.label_encoder.inverse_transform(pred))
+
+
+def cache_keys(artifacts: Artifacts, columns: Mapping) -> List[tuple]:
+    return [make_key(artifacts.version, *row)
+            for row in zip(*[columns[col] for col in FEATURES])]
+
+
+def predict_cached(artifacts: Artifacts, columns: Mapping) -> List[str]:
+    """
+    Predicts the beer styles of the observations, sending only the ones
+    missing from the cache to the model.
+    - **artifacts**: the model, pipe and label encoder to use
+    - **columns**:   mapping of column to list of values of the `FEATURES`
+    - **return**:    list of beer styles
+    """
+    if cache is None:
+        return predict_frame(artifacts, columns)
+
+    with stage('cache'):
+        keys = cache_keys(artifacts, columns)
+        pred_names, misses = cache.get_many(keys)
+    if misses:
+        missed = {col: [columns[col][i] for i in misses] for col in FEATURES}
+        missed_names = predict_frame(artifacts, missed)
+        for i, pred_name in zip(misses, missed_names):
+            pred_names[i] = pred_name
+        with stage('cache'):
+            cache.put_many([keys[i] for i in misses], missed_names)
+
+    return pred_names
+
+
+def predict_rows(rows: List[tuple]) -> List[str]:
+    artifacts = registry.get()
+    instrumentation.batch_size.labels('microbatch').observe(len(rows))
+    columns = dict(zip(FEATURES, zip(*rows)))
+    pred_names = predict_frame(artifacts, columns)
+
+    if cache is not None:
+        with stage('cache'):
+            cache.put_many(cache_keys(artifacts, columns), pred_names)
+
+    return pred_names
+
+
+# Concurrent single-row requests are grouped into one forward pass
+batcher = MicroBatcher(
+    predict_fn=predict_rows,
+    max_batch_size=int(os.getenv('BATCH_MAX_SIZE', '32')),
+    max_wait_ms=float(os.getenv('BATCH_MAX_WAIT_MS', '2')),
+    # The stages of a batch are recorded into the trace of every sampled
+    # request in it
+    merge_contexts=batch_context
+)
+instrumentation.registry.gauge(
+    'inference_microbatch_pending',
+    'Number of single-row requests waiting for a micro-batch.'
+).set_function(lambda: batcher.pending)
+
+
+@app.middleware('http')
+async def instrument_requests(request: Request, call_next):
+    # Unknown paths share a label so that they cannot grow the metrics
+    path = request.url.path.rstrip('/') or '/'
+    endpoint = path if path in ENDPOINTS else 'other'
+    in_flight = instrumentation.in_flight.labels(endpoint)
+    start = time.perf_counter()
+    status = 500
+
+    in_flight.inc()
+    try:
+        with instrumentation.tracer.trace(endpoint) as trace:
+            response = await call_next(request)
+            status = response.status_code
+            if trace is not None:
+                trace.attributes['status'] = status
+                response.headers['X-Trace-Id'] = trace.trace_id
+        return response
+    finally:
+        in_flight.dec()
+        instrumentation.observe_request(endpoint, status,
+                                        time.perf_counter() - start)
+
+
+@app.on_event('startup')
+def load_artifacts():
+    registry.load()
 
 
 @app.get('/')
@@ -28,6 +248,8 @@ def read_root():
                               '`review_performance`, `review_appearance`, '
                               '`review_palate`, and `review_taste',
         'List of endpoints': ["/", "/health/", "/beer/type/", "/beers/type/",
+                              "/beer/types/bulk/", "/cache/stats/",
+                              "/metrics/", "/tracing/",
                               "/model/architecture/"],
         'Inputs': {'`brewery_name`': 'str or List[str]',
                    '`review_performance`': 'float or List[float]',
@@ -48,13 +270,14 @@ def healthcheck():
 
 
 @app.post('/beer/type')
-def predict_one(brewery_name: str,
-                review_aroma: float,
-                review_appearance: float,
-                review_palate: float,
-                review_taste: float):
+async def predict_one(brewery_name: str,
+                      review_aroma: float,
+                      review_appearance: float,
+                      review_palate: float,
+                      review_taste: float):
     """
-    Produces a single prediction for a single observation.
+    Produces a single prediction for a single observation. Concurrent
+    requests are predicted together in micro-batches.
     - **brewery_name**:      a single brewery name
     - **review_aroma**:      a single review aroma
     - **review_appearance**: a single review appearance
@@ -62,24 +285,21 @@ def predict_one(brewery_name: str,
     - **review_taste**:      a single review taste
     - **return**:            JSON of the prediction
     """
-    device = get_device()
-    df = pd.DataFrame({'brewery_name': [brewery_name],
-                       'review_aroma': [review_aroma],
-                       'review_appearance': [review_appearance],
-                       'review_palate': [review_palate],
-                       'review_taste': [review_taste]})
-
-    # Encoding the data for prediction
-    pipe = load_preprocessing_pipe('pipe.sav')
-    df_trans = pipe.transform(df)
-    df_tensor = torch.Tensor(np.array(df_trans)).to(device)
-
-    # Prediction
-    pred = model(df_tensor).argmax(1)
-
-    # Decode results to produce human readable classes
-    le = load_label_encoder('label_encoder.sav')
-    pred_name = le.inverse_transform(pred.tolist())[0]
+    row = (brewery_name, review_aroma, review_appearance, review_palate,
+           review_taste)
+    artifacts = registry.get()
+    instrumentation.rows.labels('/beer/type').inc()
+    pred_name = None
+    if artifacts.lookup_table is not None:
+        with stage('lookup'):
+            pred = artifacts.lookup_table.lookup(*row)
+        if pred is not None:
+            pred_name = artifacts.lookup_table.classes[pred]
+    if pred_name is None and cache is not None:
+        with stage('cache'):
+            pred_name = cache.get(make_key(artifacts.version, *row))
+    if pred_name is None:
+        pred_name = await batcher.submit(row)
 
     return JSONResponse(pred_name)
 
@@ -99,38 +319,123 @@ def predict_many(brewery_name: List[str] = Query(None),
     - **review_taste**:      list of review taste
     - **return**:            JSON of predictions
     """
-    device = get_device()
-    df = pd.DataFrame({'brewery_name': brewery_name,
-                       'review_aroma': review_aroma,
-                       'review_appearance': review_appearance,
-                       'review_palate': review_palate,
-                       'review_taste': review_taste})
+    columns = {'brewery_name': brewery_name,
+               'review_aroma': review_aroma,
+               'review_appearance': review_appearance,
+               'review_palate': review_palate,
+               'review_taste': review_taste}
+    if not brewery_name:
+        raise HTTPException(status_code=422,
+                            detail='at least one observation is required')
+    if len({len(values or []) for values in columns.values()}) != 1:
+        raise HTTPException(status_code=422,
+                            detail='all the lists must have the same length')
+    instrumentation.rows.labels('/beer/types').inc(len(brewery_name))
+    pred_names = predict_cached(registry.get(), columns)
 
-    # Encoding the data for prediction
-    pipe = load_preprocessing_pipe('pipe.sav')
-    df_trans = pipe.transform(df)
-    df_tensor = torch.Tensor(np.array(df_trans)).to(device)
+    return JSONResponse(pred_names)
 
-    # Prediction
-    pred = model(df_tensor).argmax(1)
 
-    # Decode results to produce human readable classes
-    le = load_label_encoder('label_encoder.sav')
-    pred_names = list(le.inverse_transform(pred.tolist()))
+@app.post('/beer/types/bulk')
+async def predict_bulk(request: Request, encoded: bool = False):
+    """
+    Predict a large number of observations sent in the request body rather
+    than the query string. The body is one of
+    - **application/json**:     an object mapping each feature to a list of
+                                values
+    - **application/x-ndjson**: one JSON object per observation per line
+    - **application/vnd.apache.arrow.stream**: an Arrow IPC stream
+    - **encoded**:              return the index of each prediction in
+                                `classes` rather than the beer style
+    - **return**:               JSON list of predictions, or JSON of
+                                `classes` and `predictions` if encoded
+    """
+    body = await request.body()
+    content_type = request.headers.get('content-type', 'application/json')
+
+    try:
+        with stage('parse'):
+            df = parse_payload(body, content_type)
+    except UnsupportedPayloadError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except PayloadError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    if len(df) > BULK_MAX_ROWS:
+        raise HTTPException(status_code=413,
+                            detail=f'at most {BULK_MAX_ROWS} rows per '
+                                   f'request, got {len(df)}')
+
+    instrumentation.rows.labels('/beer/types/bulk').inc(len(df))
+    artifacts = registry.get()
+    if encoded:
+        pred = await run_in_threadpool(predict_indices, artifacts, df)
+        return JSONResponse({
+            'classes': artifacts.label_encoder.classes_.tolist(),
+            'predictions': pred.tolist()
+        })
+
+    pred_names = await run_in_threadpool(predict_frame, artifacts, df)
 
     return JSONResponse(pred_names)
 
 
+@app.get('/cache/stats')
+def get_cache_stats():
+    """
+    Hit, miss and eviction counters and the size of the prediction cache.
+    """
+    return JSONResponse(cache.stats() if cache is not None
+                        else {'enabled': False})
+
+
+@app.get('/metrics')
+def get_metrics():
+    """
+    Request, row and batch size counters, requests in flight and latency
+    histograms of the requests and of their stages, in the Prometheus text
+    format.
+    """
+    return Response(instrumentation.render(),
+                    media_type=MetricsRegistry.CONTENT_TYPE)
+
+
+@app.get('/tracing')
+def get_tracing(n: int = Query(20, ge=1)):
+    """
+    The sample rate of the tracing and the last `n` traces.
+    """
+    return JSONResponse({'sample_rate': instrumentation.tracer.sample_rate,
+                         'traces': instrumentation.tracer.recent(n)})
+
+
+@app.put('/tracing')
+def set_tracing(sample_rate: float):
+    """
+    Change the fraction of the requests traced, 0 to stop tracing.
+    """
+    try:
+        instrumentation.tracer.sample_rate = sample_rate
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    return JSONResponse({'sample_rate': sample_rate})
+
+
 @app.get('/model/architecture/')
 def get_architecture():
     architecture_dict = {
         layer.split(':')[0][2:]: layer.split(':')[1]
-        for layer in model.__str__().split('\n')[1:-1]
+        for layer in registry.get().architecture.split('\n')[1:-1]
     }
 
     return JSONResponse(architecture_dict)
 
 
+# Paths of the endpoints, the labels of their metrics
+ENDPOINTS = {route.path.rstrip('/') or '/' for route in app.routes}
+
+
 if __name__ == '__main__':
     uvicorn.run(app)
 else:
@@ -0,0 +1,167 @@
+import logging
+from typing import List, Mapping, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def encode_labels(splits: Mapping[str, Sequence],
+                  classes: Sequence = None
+                  ) -> Tuple[List[np.ndarray], pd.Index]:
+    """
+    Encode the labels of the splits on the same classes. Integer labels
+    with the classes given, e.g. the `y` arrays saved by `save_arrays` and
+    the classes of their metadata, are taken as the codes themselves and
+    are not copied, categorical labels are encoded by mapping their
+    categories, and other labels with one hash lookup.
+    :param splits: mapping of the name of each split to its labels
+    :param classes: the classes, e.g. `label_encoder.classes_`, by default
+    the sorted labels found in the splits
+    :return: the codes of each split, -1 for a missing label, and the
+    classes
+    """
+    values = [s.array if isinstance(s, pd.Series) else np.asarray(s)
+              for s in splits.values()]
+
+    categorical = [isinstance(v, pd.Categorical) for v in values]
+    if classes is not None and not any(categorical) and \
+            all(pd.api.types.is_integer_dtype(v.dtype) for v in values):
+        codes = [np.asarray(v) for v in values]
+        for c in codes:
+            if len(c) and (c.min() < 0 or c.max() >= len(classes)):
+                raise ValueError(f'the integer labels must be codes of '
+                                 f'the {len(classes)} classes, from 0 to '
+                                 f'{len(classes) - 1}')
+        return codes, pd.Index(classes)
+
+    if classes is None:
+        uniques = [v.categories if isinstance(v, pd.Categorical)
+                   else pd.unique(v) for v in values]
+        classes = pd.Index(np.concatenate([np.asarray(u, dtype=object)
+                                           for u in uniques])) \
+            .dropna().unique().sort_values()
+    classes = pd.Index(classes)
+
+    codes = []
+    for v in values:
+        if isinstance(v, pd.Categorical):
+            table = np.append(classes.get_indexer(v.categories), -1)
+            codes.append(table[np.asarray(v.codes)])
+        else:
+            codes.append(classes.get_indexer(v))
+
+    return codes, classes
+
+
+def class_coverage(splits: Mapping[str, Sequence],
+                   classes: Sequence = None,
+                   min_count: int = 10) -> pd.DataFrame:
+    """
+    Count the observations of every class in every split, with one bincount
+    per split, and flag the missing and under-represented classes and the
+    ones whose share drifts from the first split.
+    :param splits: mapping of the name of each split to its labels, the
+    first split, e.g. 'train', is the reference of the drift
+    :param classes: the classes, see `encode_labels`
+    :param min_count: classes with fewer observations in a split are
+    under-represented
+    :return: dataframe indexed by class of the count and the share of the
+    class in each split, whether it is missing from or under-represented in
+    any split, and its drift: the largest absolute difference between its
+    share in a split and in the reference split
+    """
+    names = list(splits)
+    codes, classes = encode_labels(splits, classes)
+    n_classes = len(classes)
+
+    # Only the codes of missing labels are negative, filtering them copies
+    # the codes so it is skipped when there are none
+    counts = np.stack([np.bincount(c if not len(c) or c.min() >= 0
+                                   else c[c >= 0], minlength=n_classes)
+                       for c in codes], axis=1)
+    totals = counts.sum(0)
+    shares = counts / np.maximum(totals, 1)
+
+    result = pd.DataFrame(counts, index=classes, columns=names)
+    for i, name in enumerate(names):
+        result[f'{name}_share'] = shares[:, i]
+    result['missing'] = (counts == 0).any(1)
+    result['under_represented'] = (counts < min_count).any(1)
+    result['drift'] = np.abs(shares - shares[:, :1]).max(1)
+    result.attrs['min_count'] = min_count
+
+    return result
+
+
+def coverage_summary(coverage: pd.DataFrame) -> pd.DataFrame:
+    """
+    Summarise the class coverage of each split.
+    :param coverage: dataframe returned by `class_coverage`
+    :return: dataframe indexed by split of its number of observations and of
+    classes present, missing and present but under-represented, its
+    class-imbalance ratio (largest over smallest non-zero class count), and
+    its total variation distance from the reference split
+    """
+    names = [col for col in coverage.columns
+             if f'{col}_share' in coverage.columns]
+    counts = coverage[names].to_numpy()
+    shares = coverage[[f'{name}_share' for name in names]].to_numpy()
+    smallest = np.where(counts > 0, counts, np.iinfo(counts.dtype).max) \
+        .min(0)
+
+    return pd.DataFrame({
+        'rows': counts.sum(0),
+        'classes': (counts > 0).sum(0),
+        'missing': (counts == 0).sum(0),
+        'under_represented': ((counts > 0) &
+                              (counts < coverage.attrs['min_count'])).sum(0),
+        'imbalance_ratio': counts.max(0) / np.maximum(smallest, 1),
+        'total_variation': np.abs(shares - shares[:, :1]).sum(0) / 2
+    }, index=names)
+
+
+def check_class_coverage(splits: Mapping[str, Sequence],
+                         classes: Sequence = None,
+                         min_count: int = 10,
+                         max_drift: float = None,
+                         strict: bool = False) -> pd.DataFrame:
+    """
+    Cheap guard of the splits before training: log a warning for every
+    split missing classes, or with classes under-represented or drifting
+    from the reference split by more than `max_drift`.
+    :param splits: mapping of the name of each split to its labels
+    :param classes: the classes, see `encode_labels`
+    :param min_count: see `class_coverage`
+    :param max_drift: largest acceptable drift of the share of a class,
+    None not to check it
+    :param strict: whether to raise a ValueError rather than warn
+    :return: the class coverage, see `class_coverage`
+    """
+    coverage = class_coverage(splits, classes, min_count)
+
+    problems = []
+    for name in splits:
+        missing = coverage.index[coverage[name] == 0]
+        if len(missing):
+            problems.append(f'{len(missing)} classes missing from {name}: '
+                            f'{list(missing[:10])}')
+        under = coverage.index[(coverage[name] > 0) &
+                               (coverage[name] < min_count)]
+        if len(under):
+            problems.append(f'{len(under)} classes with fewer than '
+                            f'{min_count} observations in {name}: '
+                            f'{list(under[:10])}')
+    if max_drift is not None:
+        drifting = coverage.index[coverage['drift'] > max_drift]
+        if len(drifting):
+            problems.append(f'{len(drifting)} classes drifting by more than '
+                            f'{max_drift:.2%}: {list(drifting[:10])}')
+
+    for problem in problems:
+        if strict:
+            raise ValueError(problem)
+        logger.warning(problem)
+
+    return coverage
@@ -1,27 +1,230 @@
 # -*- coding: utf-8 -*-
 import click
 import logging
+import os
+import time
 from pathlib import Path
+from typing import Sequence
 from dotenv import find_dotenv, load_dotenv
+import numpy as np
 import pandas as pd
 
+from src.data.sets import split_sets_streaming
+
+logger = logging.getLogger(__name__)
+
+RAW_FILE = 'beer_reviews.csv'
+OUTPUT_DIR = 'subset'
+
+TARGET = 'beer_style'
+# The columns kept, with compact dtypes: the names as categories, whose
+# codes take 1 or 2 bytes, and the scores as float32
+DTYPES = {
+    'beer_style': 'category',
+    'brewery_name': 'category',
+    'review_aroma': np.float32,
+    'review_appearance': np.float32,
+    'review_palate': np.float32,
+    'review_taste': np.float32
+}
+SCORES = ['review_aroma', 'review_appearance', 'review_palate', 'review_taste']
+# The columns identifying a review, used to find the duplicates but not kept
+KEY_COLUMNS = ('review_profilename', 'beer_beerid', 'review_time')
+
+
+class HashSet:
+    """
+    Set of 64-bit row hashes, kept as a sorted NumPy array
+    ...
+
+    Takes 8 bytes per distinct row, rather than the ~100 bytes of a Python
+    set, so deduplicating the whole dump across chunks needs a few MB.
+
+    Attributes
+    ----------
+    hashes : np.ndarray
+        The sorted hashes seen
+
+    Methods
+    -------
+    add_new(hashes)
+        Add the hashes and return which ones were not seen before
+    """
+
+    def __init__(self):
+        self.hashes = np.empty(0, dtype=np.uint64)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add_new(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        :param hashes: hashes of the rows of a chunk
+        :return: boolean mask of the first occurrence of each hash not seen
+        in the previous chunks
+        """
+        # The distinct hashes of the chunk come sorted, so they are merged
+        # into the set by inserting them, without sorting the set again
+        uniques, first = np.unique(hashes, return_index=True)
+        if len(self.hashes):
+            positions = np.searchsorted(self.hashes, uniques)
+            seen = (self.hashes[np.minimum(positions, len(self.hashes) - 1)]
+                    == uniques)
+            uniques, first = uniques[~seen], first[~seen]
+            self.hashes = np.insert(self.hashes, positions[~seen], uniques)
+        else:
+            self.hashes = uniques
+
+        new = np.zeros(len(hashes), dtype=bool)
+        new[first] = True
+
+        return new
+
+
+def clean_chunk(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Drop the reviews without a beer style or with a missing or out of range
+    score. Missing brewery names are kept, the preprocessing pipe encodes
+    them.
+    :param df: a chunk of the raw reviews
+    :return: the clean chunk
+    """
+    scores = df[SCORES].to_numpy()
+    valid = (df[TARGET].notna().to_numpy() &
+             ((scores >= 0) & (scores <= 5)).all(axis=1))
+
+    return df[valid]
+
+
+def _arrow_schema(columns: Sequence[str]):
+    import pyarrow as pa
+
+    # Same index width in every part, whatever the number of categories of
+    # its chunk, so the parts can be read back as one dataset
+    types = {col: (pa.dictionary(pa.int32(), pa.string())
+                   if dtype == 'category' else pa.float32())
+             for col, dtype in DTYPES.items()}
+    return pa.schema([(col, types[col]) for col in columns])
+
+
+def ingest_reviews(input_filepath: Path,
+                   output_dir: Path,
+                   chunksize: int = 200_000,
+                   dedup: bool = True) -> dict:
+    """
+    Stream the raw beer reviews into cleaned, deduplicated Parquet parts:
+    the CSV is read chunk by chunk with compact dtypes, so the peak memory
+    depends on `chunksize` and not on the size of the file, and each chunk
+    is written as a part of the output folder, which `pd.read_parquet`
+    reads back as one dataframe.
+    :param input_filepath: the raw CSV, e.g. ../data/raw/beer_reviews.csv
+    :param output_dir: folder of the parts, e.g. ../data/processed/subset
+    :param chunksize: number of rows per chunk
+    :param dedup: whether to drop the reviews seen before, identified by
+    `KEY_COLUMNS` if the file has them and by all the kept columns otherwise
+    :return: the numbers of rows read, dropped, duplicated and written, the
+    wall time and the throughput in rows and MB per second
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    input_filepath = Path(input_filepath)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for part in output_dir.glob('part-*.parquet'):
+        part.unlink()
+
+    header = pd.read_csv(input_filepath, nrows=0).columns
+    columns = [col for col in DTYPES if col in header]
+    missing = set(DTYPES) - set(columns)
+    if missing:
+        raise ValueError(f'{input_filepath} has no column {sorted(missing)}')
+    key_columns = [col for col in KEY_COLUMNS if col in header] or columns
+    schema = _arrow_schema(columns)
+
+    seen = HashSet()
+    stats = {'rows_read': 0, 'rows_dropped': 0, 'duplicates': 0,
+             'rows_written': 0, 'parts': 0}
+    start = time.perf_counter()
+    reader = pd.read_csv(input_filepath,
+                         usecols=sorted(set(columns) | set(key_columns)),
+                         dtype=DTYPES, chunksize=chunksize)
+    for i, chunk in enumerate(reader):
+        stats['rows_read'] += len(chunk)
+        clean = clean_chunk(chunk)
+        stats['rows_dropped'] += len(chunk) - len(clean)
+
+        if dedup:
+            hashes = pd.util.hash_pandas_object(clean[key_columns],
+                                                index=False).to_numpy()
+            new = seen.add_new(hashes)
+            stats['duplicates'] += int((~new).sum())
+            clean = clean[new]
+
+        table = pa.Table.from_pandas(clean[columns], schema=schema,
+                                     preserve_index=False)
+        pq.write_table(table, output_dir / f'part-{i:05d}.parquet')
+        stats['rows_written'] += len(clean)
+        stats['parts'] += 1
+
+        elapsed = time.perf_counter() - start
+        logger.info(f'chunk {i}: {stats["rows_read"]} rows read, '
+                    f'{stats["rows_written"]} written, '
+                    f'{stats["rows_read"] / elapsed:,.0f} rows/s')
+
+    stats['seconds'] = time.perf_counter() - start
+    stats['rows_per_sec'] = stats['rows_read'] / stats['seconds']
+    stats['mb_per_sec'] = (os.path.getsize(input_filepath) / 2 ** 20 /
+                           stats['seconds'])
+
+    return stats
+
 
 @click.command()
 @click.argument('input_filepath', type=click.Path(exists=True))
 @click.argument('output_filepath', type=click.Path())
-def main(input_filepath, output_filepath):
+@click.option('--chunksize', type=int, default=200_000, show_default=True,
+              help='Number of rows read at a time.')
+@click.option('--no-dedup', is_flag=True,
+              help='Keep the duplicated reviews.')
+@click.option('--split', is_flag=True,
+              help='Also split the reviews into the training, validation '
+                   'and testing sets, stratified by beer style.')
+@click.option('--sets-format', type=click.Choice(['parquet', 'csv']),
+              default='parquet', show_default=True)
+def main(input_filepath, output_filepath, chunksize, no_dedup, split,
+         sets_format):
     """ Runs data processing scripts to turn raw data from (../raw) into
         cleaned data ready to be analyzed (saved in ../processed).
     """
-    logger = logging.getLogger(__name__)
     logger.info('making final data set from raw data')
 
+    input_filepath = Path(input_filepath)
+    if input_filepath.is_dir():
+        input_filepath = input_filepath / RAW_FILE
+
+    stats = ingest_reviews(input_filepath,
+                           Path(output_filepath) / OUTPUT_DIR,
+                           chunksize=chunksize, dedup=not no_dedup)
+    logger.info(f'{stats["rows_written"]} of {stats["rows_read"]} reviews '
+                f'written in {stats["parts"]} parts '
+                f'({stats["rows_dropped"]} invalid, '
+                f'{stats["duplicates"]} duplicates) in '
+                f'{stats["seconds"]:.1f}s: {stats["rows_per_sec"]:,.0f} '
+                f'rows/s, {stats["mb_per_sec"]:.1f} MB/s')
+
+    if split:
+        counts = split_sets_streaming(Path(output_filepath) / OUTPUT_DIR,
+                                      TARGET, Path(output_filepath),
+                                      fmt=sets_format, chunksize=chunksize)
+        logger.info(f'split the reviews into {counts.sum().to_dict()}')
+
 
 if __name__ == '__main__':
     log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=logging.INFO, format=log_fmt)
 
-    # not used in this stub but often useful for finding various files
+    # not used here but often useful for finding various files
     project_dir = Path(__file__).resolve().parents[2]
 
     # find .env automagically by walking up directories until it's found, then
@@ -1,11 +1,21 @@
+import json
+import numpy as np
 import pandas as pd
 from pathlib import Path, WindowsPath
 from dotenv import find_dotenv
-from typing import Tuple
+from typing import Iterable, Iterator, Sequence, Tuple, Union
 from sklearn.model_selection import train_test_split
 
+from src.data.diagnostics import class_coverage
+
 project_dir = Path(find_dotenv()).parent
 
+SET_NAMES = ('train', 'test', 'val')
+METADATA_FILE = 'metadata.json'
+# Fractional part of the golden ratio, the step of the low-discrepancy
+# sequence of the stratified streaming split
+GOLDEN_FRACTION = (5 ** 0.5 - 1) / 2
+
 
 def pop_target(df, target_col, to_numpy=False):
     """Extract target variable from dataframe and convert to nympy arrays if required
@@ -85,7 +95,10 @@ def save_sets(X_train: pd.DataFrame = None,
               y_val: pd.Series = None,
               X_test: pd.DataFrame = None,
               y_test: pd.Series = None,
-              path: WindowsPath = None):
+              path: WindowsPath = None,
+              fmt: str = 'csv',
+              feature_names: Sequence[str] = None,
+              classes: Sequence = None):
     """Save the different sets locally
 
     Parameters
@@ -104,10 +117,24 @@ def save_sets(X_train: pd.DataFrame = None,
         Target for the testing set
     path : str
         Path to the folder where the sets will be saved (default: '../data/processed/')
+    fmt : str
+        'csv' for the raw sets, or 'npy' or 'parquet' for preprocessed
+        features saved as float32 and encoded targets saved as int64, with a
+        metadata file (default: 'csv')
+    feature_names : list
+        Names of the preprocessed features, saved in the metadata
+    classes : list
+        Classes of the encoded target, saved in the metadata
 
     Returns
     -------
     """
+    if fmt != 'csv':
+        save_arrays(path, fmt=fmt, feature_names=feature_names,
+                    classes=classes, X_train=X_train, y_train=y_train,
+                    X_val=X_val, y_val=y_val, X_test=X_test, y_test=y_test)
+        return
+
     if X_train is not None:
         X_train.to_csv(path.joinpath('X_train.csv'), index=False)
     if y_train is not None:
@@ -122,16 +149,99 @@ def save_sets(X_train: pd.DataFrame = None,
         y_test.to_csv(path.joinpath('y_test.csv'), index=False)
 
 
-def load_sets(path: WindowsPath = project_dir / 'data/processed') -> \
+def save_arrays(path: Path,
+                fmt: str = 'npy',
+                feature_names: Sequence[str] = None,
+                classes: Sequence = None,
+                **arrays):
+    """
+    Save preprocessed sets in a binary format: float32 features and int64
+    targets, as `.npy` files that can be memory-mapped or as Parquet files,
+    with a metadata file describing them.
+    :param path: folder where the sets will be saved
+    :param fmt: 'npy' or 'parquet'
+    :param feature_names: names of the features, saved in the metadata
+    :param classes: classes of the encoded target, saved in the metadata
+    :param arrays: the sets, e.g. `X_train=..., y_train=...`
+    :return:
+    """
+    if fmt not in ('npy', 'parquet'):
+        raise ValueError(f'unknown set format {fmt!r}')
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    shapes = {}
+    for name, data in arrays.items():
+        if data is None:
+            continue
+        dtype = np.float32 if name.startswith('X') else np.int64
+        data = np.asarray(data, dtype=dtype)
+        if fmt == 'npy':
+            np.save(path / f'{name}.npy', data)
+        elif name.startswith('X'):
+            columns = (list(feature_names) if feature_names is not None
+                       else [str(i) for i in range(data.shape[1])])
+            pd.DataFrame(data, columns=columns).to_parquet(
+                path / f'{name}.parquet', index=False)
+        else:
+            pd.DataFrame({'target': data}).to_parquet(
+                path / f'{name}.parquet', index=False)
+        shapes[name] = list(data.shape)
+
+    metadata = {'format': fmt,
+                'shapes': shapes,
+                'feature_names': (list(feature_names)
+                                  if feature_names is not None else None),
+                'classes': ([str(c) for c in classes]
+                            if classes is not None else None)}
+    with open(path / METADATA_FILE, 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+
+def load_metadata(path: Path) -> dict:
+    """
+    Metadata of sets saved by `save_arrays`, None for CSV sets.
+    """
+    path = Path(path) / METADATA_FILE
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_sets(path: WindowsPath = project_dir / 'data/processed',
+              fmt: str = None,
+              mmap: bool = True) -> \
         Tuple[pd.DataFrame,
               pd.DataFrame,
               pd.Series,
               pd.Series]:
     """
-
-    :param path:
-    :return:
+    Load the sets saved by `save_sets`.
+    :param path: folder of the sets
+    :param fmt: 'csv', 'npy' or 'parquet', by default the format in the
+    metadata file if there is one and 'csv' otherwise
+    :param mmap: whether to memory-map the `.npy` files rather than reading
+    them, so that they are only read from disk when they are accessed
+    :return: X_train, X_test, X_val, y_train, y_test, y_val
     """
+    path = Path(path)
+    if fmt is None:
+        metadata = load_metadata(path)
+        fmt = metadata['format'] if metadata is not None else 'csv'
+
+    if fmt == 'npy':
+        mmap_mode = 'r' if mmap else None
+        return tuple(np.load(path / f'{prefix}_{name}.npy',
+                             mmap_mode=mmap_mode)
+                     for prefix in ('X', 'y') for name in SET_NAMES)
+
+    if fmt == 'parquet':
+        return tuple(pd.read_parquet(path / f'X_{name}.parquet')
+                     for name in SET_NAMES) + \
+            tuple(pd.read_parquet(path / f'y_{name}.parquet')['target']
+                  for name in SET_NAMES)
+
     X_train = pd.read_csv(path.joinpath('X_train').with_suffix('.csv'))
     X_test = pd.read_csv(path.joinpath('X_test').with_suffix('.csv'))
     X_val = pd.read_csv(path.joinpath('X_val').with_suffix('.csv'))
@@ -143,6 +253,222 @@ def load_sets(path: WindowsPath = project_dir / 'data/processed') -> \
     return X_train, X_test, X_val, y_train, y_test, y_val
 
 
+def iter_chunks(path: Path,
+                chunksize: int = 100_000,
+                columns: Sequence[str] = None) -> Iterator[pd.DataFrame]:
+    """
+    Read a CSV file, a Parquet file or a folder of Parquet parts, e.g. the
+    one written by `src/data/make_dataset.py`, in chunks of at most
+    `chunksize` rows.
+    :param path: path to the file or folder
+    :param chunksize: number of rows per chunk
+    :param columns: the columns to read, by default all of them
+    :return: iterator of dataframes
+    """
+    path = Path(path)
+    if path.is_dir() or path.suffix == '.parquet':
+        import pyarrow.parquet as pq
+
+        parts = sorted(path.glob('*.parquet')) if path.is_dir() else [path]
+        for part in parts:
+            parquet_file = pq.ParquetFile(str(part))
+            for batch in parquet_file.iter_batches(
+                    batch_size=chunksize,
+                    columns=list(columns) if columns is not None else None):
+                yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunksize,
+                               usecols=(list(columns) if columns is not None
+                                        else None))
+
+
+class _SetWriter:
+    """
+    Appends the chunks of a set to a CSV or Parquet file
+    """
+
+    def __init__(self, path: Path, fmt: str):
+        self.path = path
+        self.fmt = fmt
+        self.n_rows = 0
+        self.n_columns = None
+        self._writer = None
+
+    def write(self, df: pd.DataFrame):
+        if self.fmt == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            if self._writer is None:
+                # Categories may differ from a chunk to the next, so their
+                # codes are always stored as int32
+                schema = pa.Schema.from_pandas(df, preserve_index=False)
+                for i, field in enumerate(schema):
+                    if pa.types.is_dictionary(field.type):
+                        schema = schema.set(i, field.with_type(pa.dictionary(
+                            pa.int32(), field.type.value_type)))
+                schema = schema.remove_metadata()
+                self._writer = pq.ParquetWriter(str(self.path), schema)
+            self._writer.write_table(pa.Table.from_pandas(
+                df, schema=self._writer.schema, preserve_index=False))
+        else:
+            df.to_csv(self.path, mode='a' if self.n_rows else 'w',
+                      header=not self.n_rows, index=False)
+        self.n_rows += len(df)
+        self.n_columns = df.shape[1] if df.ndim == 2 else None
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+def _hash_numbers(keys: pd.DataFrame, hash_key: str) -> np.ndarray:
+    # Seeded hash of the key of each observation, in [0, 1)
+    hashes = pd.util.hash_pandas_object(keys, index=False, hash_key=hash_key)
+    return hashes.to_numpy() / 2.0 ** 64
+
+
+def _stratified_numbers(target: pd.Series,
+                        seen: dict,
+                        starts: dict,
+                        hash_key: str) -> np.ndarray:
+    """
+    Numbers in [0, 1) of the observations of a chunk: the n-th observation
+    of each class gets the n-th number of the golden ratio additive
+    recurrence, started at a seeded hash of the class.
+    :param target: the classes of the chunk
+    :param seen: number of observations of each class in the previous
+    chunks, updated
+    :param starts: start of the sequence of each class, updated
+    :param hash_key: key of the hash of the classes
+    :return: the number of each observation
+    """
+    codes, classes = pd.factorize(target)
+    codes = codes.copy()
+    classes = list(classes)
+    if (codes == -1).any():
+        codes[codes == -1] = len(classes)
+        classes.append(None)
+    for label in classes:
+        if label not in starts:
+            starts[label] = pd.util.hash_pandas_object(
+                pd.Series([str(label)]), index=False,
+                hash_key=hash_key).iloc[0] / 2.0 ** 64
+            seen[label] = 0
+
+    # Rank of each observation among the ones of its class
+    ranks = (np.array([seen[label] for label in classes])[codes] +
+             pd.Series(codes).groupby(codes).cumcount().to_numpy())
+    u = (np.array([starts[label] for label in classes])[codes] +
+         ranks * GOLDEN_FRACTION) % 1
+    for label, n in zip(classes, np.bincount(codes, minlength=len(classes))):
+        seen[label] += int(n)
+
+    return u
+
+
+def _save_split_metadata(path: Path, fmt: str, writers: dict):
+    if fmt == 'parquet':
+        shapes = {name: ([writer.n_rows, writer.n_columns]
+                         if name.startswith('X') else [writer.n_rows])
+                  for name, writer in writers.items()}
+        metadata = {'format': fmt, 'shapes': shapes, 'feature_names': None,
+                    'classes': None}
+        with open(path / METADATA_FILE, 'w') as f:
+            json.dump(metadata, f, indent=2)
+    elif (path / METADATA_FILE).exists():
+        # Sets in CSV have no metadata, a stale file would hide them
+        (path / METADATA_FILE).unlink()
+
+
+def split_sets_streaming(chunks: Union[Iterable[pd.DataFrame], Path],
+                         target_col: str,
+                         path: Path,
+                         test_ratio: float = 0.2,
+                         key_cols: Sequence[str] = None,
+                         stratify: bool = True,
+                         seed: int = 8,
+                         fmt: str = 'parquet',
+                         chunksize: int = 100_000) -> pd.DataFrame:
+    """
+    Split the observations into the training, validation and testing sets in
+    one pass over the chunks, writing each chunk of each set straight to the
+    files read by `load_sets`, so that only one chunk is in memory at a
+    time.
+
+    Every observation gets a number in [0, 1), it goes to the testing set
+    if the number is below `test_ratio`, to the validation set if it is
+    below `2 * test_ratio` and to the training set otherwise. With
+    `key_cols`, the number is a seeded hash of the key, so an observation
+    always goes to the same set whatever the order of the input and new
+    observations never move the old ones. Otherwise, with `stratify`, the
+    n-th observation of each class gets the n-th number of a low-discrepancy
+    sequence (the golden ratio additive recurrence, with a seeded start per
+    class), so every set holds the expected share of each class to within
+    a few observations. Without either, the numbers are drawn from a seeded
+    generator. The split is the same for any chunk size.
+
+    :param chunks: iterable of dataframes, e.g. `pd.read_csv(...,
+    chunksize=...)`, or path to the input, read with `iter_chunks`
+    :param target_col: name of the target column
+    :param path: folder where the sets will be saved
+    :param test_ratio: ratio used for the validation and testing sets
+    :param key_cols: columns identifying an observation, to split by hash
+    :param stratify: whether to stratify by the target when not splitting
+    by hash
+    :param seed: seed of the hash, sequence or generator
+    :param fmt: 'csv' or 'parquet'
+    :param chunksize: number of rows per chunk when `chunks` is a path
+    :return: dataframe of the number of observations of each class (rows)
+    in each set (columns)
+    """
+    if fmt not in ('csv', 'parquet'):
+        raise ValueError(f'unknown set format {fmt!r}')
+    if isinstance(chunks, (str, Path)):
+        chunks = iter_chunks(chunks, chunksize)
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    hash_key = f'{seed:016d}'[-16:]
+    rng = np.random.default_rng(seed)
+    # Number of observations and start of the sequence of each class
+    seen, starts = {}, {}
+    writers = {f'{prefix}_{name}': _SetWriter(path / f'{prefix}_{name}.{fmt}',
+                                              fmt)
+               for prefix in ('X', 'y') for name in SET_NAMES}
+    counts = pd.DataFrame(columns=['train', 'val', 'test'], dtype=np.int64)
+
+    try:
+        for chunk in chunks:
+            target = chunk[target_col]
+            if key_cols is not None:
+                u = _hash_numbers(chunk[list(key_cols)], hash_key)
+            elif stratify:
+                u = _stratified_numbers(target, seen, starts, hash_key)
+            else:
+                u = rng.random(len(chunk))
+
+            sets = np.where(u < test_ratio, 'test',
+                            np.where(u < 2 * test_ratio, 'val', 'train'))
+            for name in SET_NAMES:
+                mask = sets == name
+                writers[f'X_{name}'].write(
+                    chunk.loc[mask, chunk.columns != target_col])
+                y = target[mask]
+                writers[f'y_{name}'].write(y.rename('target').to_frame()
+                                           if fmt == 'parquet'
+                                           else y.to_frame())
+            counts = counts.add(pd.crosstab(target, sets), fill_value=0)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    _save_split_metadata(path, fmt, writers)
+
+    return counts.reindex(columns=['train', 'val', 'test']) \
+        .fillna(0).astype(np.int64)
+
+
 def subset_x_y(target, features, start_index: int, end_index: int):
     """Keep only the rows for X and y sets from the specified indexes
 
@@ -214,21 +540,17 @@ def test_class_exclusion(y_train: pd.Series,
                          y_test: pd.Series,
                          y_val: pd.Series):
     """
-    Tests if any classes are missing from any of the data sets
+    Tests if any classes are missing from any of the data sets, see
+    `src.data.diagnostics.class_coverage` for the details
     :param y_train:
     :param y_test:
     :param y_val:
     :return:
     """
+    coverage = class_coverage({'train': y_train, 'test': y_test,
+                               'val': y_val})
 
-    test = (
-            (len(set(y_train.unique()) - set(y_test.unique())) == 0) &
-            (len(set(y_test.unique()) - set(y_train.unique())) == 0) &
-            (len(set(y_val.unique()) - set(y_test.unique())) == 0) &
-            (len(set(y_test.unique()) - set(y_val.unique())) == 0)
-    )
-
-    if test:
+    if not coverage['missing'].any():
         result = '✔ All the sets contain all the classes.'
     else:
         result = '⚠ Some sets are missing some classes'
@@ -236,29 +558,41 @@ def test_class_exclusion(y_train: pd.Series,
     return result
 
 
-def merge_categories(s: pd.Series, threshold: float):
+def merge_categories(s: pd.Series, threshold: float, other: str = 'other'):
     """
-    Merges a the categories of a if their proportion is less than the
-    threshold.
-    :param s:
-    :param threshold:
-    :return:
+    Merges the categories of a series into `other` if their count, or their
+    proportion if the threshold is at most 1, is less than or equal to the
+    threshold. The values are converted to categorical codes once and the
+    rare categories are merged by remapping the codes, so categorical series
+    are merged without touching the strings.
+    :param s: series of the categories, e.g. `df.brewery_name`
+    :param threshold: the count, or proportion, under which a category is
+    merged
+    :param other: name of the merged category
+    :return: the merged series, categorical if `s` is categorical and of the
+    dtype of `s` otherwise
     """
-    result = s.copy(deep=True)
-
-    if threshold > 1:
-        low_freq_cats = (
-            result
-            .value_counts()
-            .loc[lambda x: x <= threshold].index
-        )
+    categorical = isinstance(s.dtype, pd.CategoricalDtype)
+    values = s.array if categorical else pd.Categorical(s)
+    codes = np.asarray(values.codes)
+    categories = values.categories
+
+    counts = np.bincount(codes[codes >= 0], minlength=len(categories))
+    if threshold <= 1:
+        counts = counts / max(counts.sum(), 1)
+    rare = counts <= threshold
+
+    kept = categories[~rare]
+    if other in kept:
+        other_code = kept.get_loc(other)
     else:
-        low_freq_cats = (
-            result
-            .value_counts(normalize=True)
-            .loc[lambda x: x <= threshold].index
-        )
+        other_code = len(kept)
+        kept = kept.append(pd.Index([other]))
+    mapping = np.full(len(categories), other_code, dtype=codes.dtype)
+    mapping[~rare] = np.arange((~rare).sum())
+    merged = np.where(codes >= 0, mapping[codes], -1)
 
-    result.loc[result.isin(low_freq_cats)] = 'other'
+    result = pd.Series(pd.Categorical.from_codes(merged, kept),
+                       index=s.index, name=s.name)
 
-    return result
+    return result if categorical else result.astype(s.dtype)
@@ -0,0 +1,284 @@
+import hashlib
+import inspect
+import json
+import logging
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, Mapping, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import sklearn
+from dotenv import find_dotenv
+from joblib import dump, load
+from sklearn.pipeline import Pipeline
+
+from src.models.pipes import create_preprocessing_pipe
+
+logger = logging.getLogger(__name__)
+
+project_dir = Path(find_dotenv()).parent
+
+PIPE_FILE = 'pipe.sav'
+ENTRY_FILE = 'entry.json'
+
+
+def fingerprint_frame(df: pd.DataFrame) -> str:
+    """
+    SHA-1 fingerprint of the content, index, columns and dtypes of a
+    dataframe or series, computed with vectorised row hashes.
+    """
+    digest = hashlib.sha1()
+    digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    if isinstance(df, pd.DataFrame):
+        digest.update(repr(list(df.columns)).encode())
+        digest.update(repr(list(df.dtypes.astype(str))).encode())
+    else:
+        digest.update(repr((df.name, str(df.dtype))).encode())
+
+    return digest.hexdigest()
+
+
+def fingerprint_factory(factory: Callable, params: Mapping) -> str:
+    """
+    SHA-1 fingerprint of the function creating the pipe, its source code,
+    its parameters and the scikit-learn version, so that changing any of
+    them invalidates the cached entries.
+    """
+    try:
+        source = inspect.getsource(factory)
+    except (OSError, TypeError):
+        source = ''
+    config = {'factory': f'{factory.__module__}.{factory.__qualname__}',
+              'source': source,
+              'params': {key: repr(value)
+                         for key, value in sorted(params.items())},
+              'sklearn': sklearn.__version__}
+
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()) \
+        .hexdigest()
+
+
+def _directory_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.iterdir() if f.is_file())
+
+
+class PreprocessingCache:
+    """
+    On-disk cache of fitted preprocessing pipes and transformed sets
+    ...
+
+    An entry is keyed on the fingerprints of the sets and of the function
+    creating the pipe, with its parameters, so it is reused as long as
+    neither the data nor the preprocessing changes. The transformed sets are
+    saved as float32 `.npy` files and are memory-mapped when loaded. Entries
+    are evicted when they have not been used for `max_age` seconds, then
+    least recently used first while the cache is bigger than `max_bytes`.
+
+    Attributes
+    ----------
+    cache_dir : Path
+        Folder of the entries, one sub-folder per key
+    max_bytes : int
+        Maximum total size of the entries, None for no limit
+    max_age : float
+        Number of seconds an unused entry is kept, None for no limit
+
+    Methods
+    -------
+    key(sets, factory, **params)
+        Return the key of the sets and the preprocessing
+    get(key, mmap)
+        Return the fitted pipe and the transformed sets of a key, or None
+    get_or_create(X_train, y_train, other_sets, factory, **params)
+        Return the cached entry, creating it on a miss
+    evict()
+        Remove the expired entries, then the oldest ones over the budget
+    entries()
+        Return a dataframe describing the entries
+    clear()
+        Remove all the entries
+    """
+
+    def __init__(self,
+                 cache_dir: Path = project_dir / 'data/interim/preprocessing',
+                 max_bytes: Optional[int] = 10 * 2 ** 30,
+                 max_age: Optional[float] = 30 * 24 * 3600):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def key(self,
+            sets: Mapping[str, pd.DataFrame],
+            factory: Callable = create_preprocessing_pipe,
+            **params) -> str:
+        """
+        :param sets: mapping of the name of each set, e.g. 'X_train', to the
+        set
+        :param factory: function fitting the pipe
+        :param params: parameters of `factory`
+        :return: the key
+        """
+        digest = hashlib.sha1(fingerprint_factory(factory, params).encode())
+        for name in sorted(sets):
+            if sets[name] is not None:
+                digest.update(name.encode())
+                digest.update(fingerprint_frame(sets[name]).encode())
+
+        return digest.hexdigest()
+
+    def _read_entry(self, path: Path) -> Optional[dict]:
+        try:
+            with open(path / ENTRY_FILE) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _touch(self, path: Path, entry: dict):
+        entry['last_used'] = time.time()
+        with open(path / ENTRY_FILE, 'w') as f:
+            json.dump(entry, f)
+
+    def get(self,
+            key: str,
+            mmap: bool = True
+            ) -> Optional[Tuple[Pipeline, Dict[str, np.ndarray]]]:
+        """
+        :param key: key returned by `key`
+        :param mmap: whether to memory-map the transformed sets
+        :return: the fitted pipe and the mapping of the name of each set to
+        its transformed array, or None on a miss
+        """
+        path = self.cache_dir / key
+        entry = self._read_entry(path)
+        if entry is None:
+            return None
+        if (self.max_age is not None and
+                time.time() - entry['last_used'] > self.max_age):
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+
+        pipe = load(path / PIPE_FILE)
+        mmap_mode = 'r' if mmap else None
+        arrays = {name: np.load(path / f'{name}.npy', mmap_mode=mmap_mode)
+                  for name in entry['sets']}
+        self._touch(path, entry)
+
+        return pipe, arrays
+
+    def _put(self,
+             key: str,
+             pipe: Pipeline,
+             arrays: Mapping[str, np.ndarray]):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Written aside and renamed so a concurrent reader never sees a
+        # partial entry
+        tmp_dir = Path(tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-'))
+        try:
+            dump(pipe, tmp_dir / PIPE_FILE)
+            # Every set is features, whatever its name, so they are saved
+            # as float32 rather than with the naming rules of save_arrays
+            for name, array in arrays.items():
+                np.save(tmp_dir / f'{name}.npy',
+                        np.asarray(array, dtype=np.float32))
+            entry = {'sets': list(arrays), 'created': time.time()}
+            self._touch(tmp_dir, entry)
+            tmp_dir.rename(self.cache_dir / key)
+        except OSError:
+            # Another process created the same entry first
+            if not (self.cache_dir / key).exists():
+                raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def get_or_create(self,
+                      X_train: pd.DataFrame,
+                      y_train: pd.Series = None,
+                      other_sets: Mapping[str, pd.DataFrame] = None,
+                      factory: Callable = create_preprocessing_pipe,
+                      mmap: bool = True,
+                      **params) -> Tuple[Pipeline, Dict[str, np.ndarray]]:
+        """
+        Return the pipe fitted on the training set and the transformed sets,
+        from the cache if the same sets were preprocessed the same way
+        before.
+        :param X_train: features of the training set, used to fit the pipe
+        :param y_train: target of the training set, passed to `factory`
+        :param other_sets: mapping of the name of each other set, e.g.
+        'X_val', to its features
+        :param factory: function fitting the pipe, called as
+        `factory(X_train, y_train, **params)`
+        :param mmap: whether to memory-map the transformed sets
+        :param params: parameters of `factory`
+        :return: the fitted pipe and the mapping of 'X_train' and the names
+        of the other sets to the transformed float32 arrays
+        """
+        sets = dict(other_sets or {}, X_train=X_train, y_train=y_train)
+        key = self.key(sets, factory, **params)
+
+        cached = self.get(key, mmap=mmap)
+        if cached is not None:
+            logger.info(f'reusing the preprocessed sets {key}')
+            return cached
+
+        start = time.perf_counter()
+        pipe = factory(X_train, y_train, **params)
+        arrays = {name: np.asarray(pipe.transform(X), dtype=np.float32)
+                  for name, X in dict(other_sets or {},
+                                      X_train=X_train).items()}
+        logger.info(f'preprocessed the sets {key} in '
+                    f'{time.perf_counter() - start:.1f}s')
+
+        self._put(key, pipe, arrays)
+        self.evict()
+        if mmap:
+            cached = self.get(key, mmap=True)
+            if cached is not None:
+                return cached
+
+        return pipe, arrays
+
+    def entries(self) -> pd.DataFrame:
+        """
+        :return: dataframe of the key, size, creation time and last use of
+        every entry, least recently used first
+        """
+        rows = []
+        if self.cache_dir.exists():
+            for path in self.cache_dir.iterdir():
+                entry = (self._read_entry(path)
+                         if not path.name.startswith('.') else None)
+                if entry is not None:
+                    rows.append({'key': path.name,
+                                 'bytes': _directory_size(path),
+                                 'created': entry['created'],
+                                 'last_used': entry['last_used']})
+
+        return pd.DataFrame(rows, columns=['key', 'bytes', 'created',
+                                           'last_used']) \
+            .sort_values('last_used', ignore_index=True)
+
+    def evict(self) -> int:
+        """
+        Remove the entries unused for more than `max_age` seconds, then the
+        least recently used ones until the cache fits in `max_bytes`.
+        :return: the number of entries removed
+        """
+        entries = self.entries()
+        expired = pd.Series(False, index=entries.index)
+        if self.max_age is not None:
+            expired = time.time() - entries['last_used'] > self.max_age
+        if self.max_bytes is not None:
+            # Sizes of the entries kept, from the most recently used one
+            kept = entries['bytes'].where(~expired, 0)[::-1].cumsum()[::-1]
+            expired |= kept > self.max_bytes
+
+        for key in entries.loc[expired, 'key']:
+            shutil.rmtree(self.cache_dir / key, ignore_errors=True)
+
+        return int(expired.sum())
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
@@ -0,0 +1,160 @@
+import asyncio
+import contextvars
+from collections import deque
+from concurrent.futures import Executor
+from typing import Any, Callable, List, Optional, Sequence
+
+
+class MicroBatcher:
+    """
+    Asynchronous micro-batcher for single-row predictions
+    ...
+
+    Concurrent calls to `submit()` are queued and grouped into one batch,
+    which is passed to `predict_fn` in a single call. A batch is closed as
+    soon as it holds `max_batch_size` items or `max_wait_ms` milliseconds
+    after the batcher started waiting for it, whichever comes first. While
+    a batch is being predicted new items keep queueing, so the batches grow
+    with the load.
+
+    `predict_fn` runs in `executor` (the event loop's default thread pool if
+    None) so that the event loop is never blocked by the forward pass. It
+    must return one result per item, in the same order.
+
+    A batch mixes the items of several callers, so `predict_fn` cannot run
+    in the context of any one of them. The context of each caller is
+    captured by `submit()`, and `merge_contexts`, if given, maps the
+    contexts of the items of a batch to the one `predict_fn` runs in, e.g.
+    to record its timings into the traces of all the callers. Without it
+    `predict_fn` sees none of the context variables of the callers.
+
+    Attributes
+    ----------
+    predict_fn : function
+        Function mapping a list of items to a list of results
+    max_batch_size : int
+        Maximum number of items per batch
+    max_wait_ms : float
+        Maximum time to wait for a batch to fill up
+    max_concurrent_batches : int
+        Number of batches that can be predicted at the same time
+    executor : concurrent.futures.Executor
+        Executor running `predict_fn`
+    merge_contexts : function
+        Function mapping the contexts of the items of a batch to the
+        context `predict_fn` runs in
+    pending : int
+        Number of items waiting for a batch
+
+    Methods
+    -------
+    submit(item)
+        Queue an item and wait for its result
+    """
+
+    def __init__(self,
+                 predict_fn: Callable[[List[Any]], Sequence[Any]],
+                 max_batch_size: int = 32,
+                 max_wait_ms: float = 2.0,
+                 max_concurrent_batches: int = 1,
+                 executor: Optional[Executor] = None,
+                 merge_contexts: Optional[Callable[
+                     [List[contextvars.Context]],
+                     contextvars.Context]] = None):
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be at least 1')
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_concurrent_batches = max_concurrent_batches
+        self.executor = executor
+        self.merge_contexts = merge_contexts
+
+        self._pending = deque()
+        self._not_empty = None
+        self._full = None
+        self._semaphore = None
+        self._worker = None
+
+    @property
+    def pending(self) -> int:
+        """
+        Number of items waiting for a batch.
+        """
+        return len(self._pending)
+
+    def _start(self):
+        # The events and the worker are bound to the running event loop, so
+        # they are only created on the first call to submit()
+        self._not_empty = asyncio.Event()
+        self._full = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self.max_concurrent_batches)
+        self._worker = asyncio.ensure_future(self._run())
+
+    async def submit(self, item: Any) -> Any:
+        """
+        Queue an item for prediction.
+        :param item: a single observation, as expected by `predict_fn`
+        :return: the prediction for this item
+        """
+        if self._worker is None or self._worker.done():
+            self._start()
+
+        future = asyncio.get_event_loop().create_future()
+        context = (contextvars.copy_context()
+                   if self.merge_contexts is not None else None)
+        self._pending.append((item, future, context))
+        self._not_empty.set()
+        if len(self._pending) >= self.max_batch_size:
+            self._full.set()
+
+        return await future
+
+    async def _collect(self) -> List:
+        while not self._pending:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+
+        if len(self._pending) < self.max_batch_size:
+            self._full.clear()
+            try:
+                await asyncio.wait_for(self._full.wait(),
+                                       self.max_wait_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+
+        size = min(len(self._pending), self.max_batch_size)
+
+        return [self._pending.popleft() for _ in range(size)]
+
+    async def _run(self):
+        while True:
+            await self._semaphore.acquire()
+            batch = await self._collect()
+            asyncio.ensure_future(self._predict(batch))
+
+    async def _predict(self, batch: List):
+        loop = asyncio.get_event_loop()
+        items = [item for item, _, _ in batch]
+        try:
+            if self.merge_contexts is not None:
+                context = self.merge_contexts([c for _, _, c in batch])
+                results = await loop.run_in_executor(
+                    self.executor, context.run, self.predict_fn, items)
+            else:
+                results = await loop.run_in_executor(self.executor,
+                                                     self.predict_fn, items)
+            if len(results) != len(items):
+                raise RuntimeError(f'predict_fn returned {len(results)} '
+                                   f'results for {len(items)} items')
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future, _), result in zip(batch, results):
+                # The caller may have gone away, e.g. a client disconnect
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._semaphore.release()
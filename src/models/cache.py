@@ -0,0 +1,182 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
+
+# Approximate overhead of an OrderedDict entry on top of its key and value
+ENTRY_OVERHEAD = 100
+
+
+def make_key(version: str,
+             brewery_name: str,
+             review_aroma: float,
+             review_appearance: float,
+             review_palate: float,
+             review_taste: float) -> Optional[Tuple]:
+    """
+    Normalised cache key of an observation. The scores are cast to float,
+    and -0.0 to 0.0, so that e.g. 4 and 4.0 share an entry, while any
+    difference that could change the prediction gives a different key.
+    :param version: version of the model making the prediction
+    :return: the key, or None if the observation cannot be cached
+    """
+    scores = (float(review_aroma) + 0.0,
+              float(review_appearance) + 0.0,
+              float(review_palate) + 0.0,
+              float(review_taste) + 0.0)
+    # NaN never equals itself so it could never be hit
+    if not isinstance(brewery_name, str) or any(x != x for x in scores):
+        return None
+
+    return (version, brewery_name) + scores
+
+
+def _sizeof(key: Tuple, value: Any) -> int:
+    return (sys.getsizeof(key) + sum(sys.getsizeof(x) for x in key) +
+            sys.getsizeof(value) + ENTRY_OVERHEAD)
+
+
+class PredictionCache:
+    """
+    Thread-safe LRU cache of predictions with an optional time to live
+    ...
+
+    Entries are evicted, least recently used first, as soon as the cache
+    holds more than `maxsize` entries or its estimated size exceeds
+    `max_bytes`. Expired entries count as misses and are dropped when they
+    are looked up or reach the end of the LRU order.
+
+    Attributes
+    ----------
+    maxsize : int
+        Maximum number of entries
+    max_bytes : int
+        Memory budget of the entries, in bytes
+    ttl : float
+        Number of seconds an entry stays valid, None for no expiry
+    hits, misses, evictions, expirations : int
+        Counters since the cache was created
+
+    Methods
+    -------
+    get(key)
+        Return the cached value or None
+    get_many(keys)
+        Return the cached values and the positions of the misses
+    put(key, value)
+        Cache a value
+    put_many(keys, values)
+        Cache several values
+    stats()
+        Return the counters and the current size
+    """
+
+    def __init__(self,
+                 maxsize: int = 100000,
+                 max_bytes: int = 64 * 2 ** 20,
+                 ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key: Hashable, now: float):
+        # Must be called with the lock held
+        entry = self._entries.get(key) if key is not None else None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        value, expires, size = entry
+        if expires is not None and expires <= now:
+            del self._entries[key]
+            self._bytes -= size
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+
+        return value
+
+    def _put(self, key: Hashable, value: Any, now: float):
+        # Must be called with the lock held
+        if key is None:
+            return
+        size = _sizeof(key, value)
+        if size > self.max_bytes:
+            return
+
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old[2]
+        expires = now + self.ttl if self.ttl is not None else None
+        self._entries[key] = (value, expires, size)
+        self._bytes += size
+
+        while (len(self._entries) > self.maxsize or
+               self._bytes > self.max_bytes):
+            _, (_, expires, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            if expires is not None and expires <= now:
+                self.expirations += 1
+            else:
+                self.evictions += 1
+
+    def get(self, key: Hashable) -> Any:
+        """
+        :param key: key created by `make_key`
+        :return: the cached value, or None on a miss
+        """
+        with self._lock:
+            return self._get(key, time.monotonic())
+
+    def get_many(self, keys: Sequence[Hashable]) -> Tuple[List, List[int]]:
+        """
+        :param keys: keys created by `make_key`
+        :return: the cached values, None for misses, and the positions of the
+        misses
+        """
+        now = time.monotonic()
+        with self._lock:
+            values = [self._get(key, now) for key in keys]
+
+        return values, [i for i, value in enumerate(values) if value is None]
+
+    def put(self, key: Hashable, value: Any):
+        """
+        :param key: key created by `make_key`, None is ignored
+        :param value: the value to cache, must not be None
+        """
+        with self._lock:
+            self._put(key, value, time.monotonic())
+
+    def put_many(self, keys: Sequence[Hashable], values: Sequence[Any]):
+        now = time.monotonic()
+        with self._lock:
+            for key, value in zip(keys, values):
+                self._put(key, value, now)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'maxsize': self.maxsize,
+                    'max_bytes': self.max_bytes}
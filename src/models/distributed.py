@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import socket
+import time
+from pathlib import Path
+from typing import Sequence
+
+import click
+import numpy as np
+import pandas as pd
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+
+from src.data.diagnostics import check_class_coverage
+from src.data.sets import load_metadata, load_sets
+from src.models.pytorch import BatchLoader, MemmapDataset, Trainer
+from src.models.pytorch import build_model
+
+logger = logging.getLogger(__name__)
+
+
+class DistributedTrainer(Trainer):
+    """
+    Trainer of one process of a data-parallel training on CPU
+    ...
+
+    Every process trains a replica of the model, wrapped in
+    DistributedDataParallel, on its own shard of the training set, the
+    remainder of which is dropped, and evaluates it on its own shard of the
+    validation set, which covers every row; the gradients are averaged over
+    the processes with the gloo backend after each backward pass, so the
+    replicas stay identical. The metrics are summed over the processes
+    before they are read, so the history, the early stopping and the
+    learning rate schedule are the same everywhere, and only rank 0 writes
+    the checkpoints. The default process group must be initialised first.
+
+    Attributes
+    ----------
+    rank : int
+        Index of the process
+    world_size : int
+        Number of processes
+    """
+
+    def __init__(self,
+                 model: nn.Module,
+                 criterion,
+                 optimizer: torch.optim.Optimizer,
+                 train_data,
+                 val_data=None,
+                 batch_size: int = 1024,
+                 seed: int = 0,
+                 **kwargs):
+        """
+        :param batch_size: number of observations per batch and process
+        :param seed: seed of the shuffling, must be the same in every
+        process
+        :param kwargs: the other parameters of `Trainer`
+        """
+        super().__init__(model, criterion, optimizer, train_data, val_data,
+                         batch_size=batch_size, device=torch.device('cpu'),
+                         seed=seed, **kwargs)
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+
+        self.model = DistributedDataParallel(model)
+        self.train_loader = BatchLoader(train_data, batch_size, shuffle=True,
+                                        generator=self.generator,
+                                        rank=self.rank,
+                                        world_size=self.world_size)
+        if val_data is not None:
+            # Every row of the validation set is evaluated once, the
+            # metrics are summed over the shards
+            self.val_loader = BatchLoader(val_data, batch_size,
+                                          rank=self.rank,
+                                          world_size=self.world_size,
+                                          even_shards=False)
+
+    def _compute(self, accumulator) -> dict:
+        accumulator.all_reduce()
+        return accumulator.compute()
+
+    def save_checkpoint(self, path: Path):
+        if self.rank == 0:
+            super().save_checkpoint(path)
+        dist.barrier()
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _n_classes(data_dir: Path, y_train: np.ndarray) -> int:
+    metadata = load_metadata(data_dir) or {}
+    if metadata.get('classes'):
+        return len(metadata['classes'])
+    return int(np.max(y_train)) + 1
+
+
+def _worker(rank: int,
+            world_size: int,
+            port: int,
+            data_dir: Path,
+            model_name: str,
+            n_epochs: int,
+            batch_size: int,
+            lr: float,
+            patience: int,
+            checkpoint_path: Path,
+            model_path: Path,
+            seed: int,
+            results):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    # Share the cores between the processes rather than oversubscribing them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    torch.manual_seed(seed)
+
+    try:
+        # Memory-mapped, so the processes share the page cache of the sets
+        X_train, _, X_val, y_train, _, y_val = load_sets(data_dir, fmt='npy')
+        model = build_model(model_name, X_train.shape[1],
+                            _n_classes(data_dir, y_train))
+        optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+
+        trainer = DistributedTrainer(model, nn.CrossEntropyLoss(), optimizer,
+                                     MemmapDataset(X_train, y_train),
+                                     MemmapDataset(X_val, y_val),
+                                     batch_size=batch_size, seed=seed,
+                                     patience=patience,
+                                     checkpoint_path=checkpoint_path)
+        if checkpoint_path is not None:
+            trainer.resume()
+        start = time.perf_counter()
+        history = trainer.fit(n_epochs)
+        elapsed = time.perf_counter() - start
+
+        if rank == 0:
+            if model_path is not None:
+                torch.save(model, model_path)
+            results.put((history, elapsed))
+    finally:
+        dist.destroy_process_group()
+
+
+def train_distributed(data_dir: Path,
+                      model_name: str = 'PytorchClassification_6',
+                      world_size: int = 2,
+                      n_epochs: int = 20,
+                      batch_size: int = 1024,
+                      lr: float = 0.001,
+                      patience: int = None,
+                      checkpoint_path: Path = None,
+                      model_path: Path = None,
+                      seed: int = 0) -> pd.DataFrame:
+    """
+    Train a model with data-parallel processes on the local machine.
+    :param data_dir: folder of the preprocessed sets saved in the 'npy'
+    format by `src.data.sets.save_sets`
+    :param model_name: name of the model class in `src.models.pytorch`
+    :param world_size: number of processes
+    :param n_epochs: number of epochs
+    :param batch_size: number of observations per batch and process, the
+    effective batch size is `batch_size * world_size`
+    :param lr: learning rate of Adam
+    :param patience: number of epochs without improvement of the validation
+    loss before stopping, None to never stop early
+    :param checkpoint_path: checkpoint to resume from and save to
+    :param model_path: where to save the trained model, e.g.
+    ../models/6_pytorch_model.torch
+    :param seed: seed of the initialisation and the shuffling
+    :return: the history of the training, with the total wall time in the
+    `elapsed` attribute
+    """
+    _, _, _, y_train, y_test, y_val = load_sets(data_dir, fmt='npy')
+    check_class_coverage({'train': y_train, 'val': y_val, 'test': y_test},
+                         (load_metadata(data_dir) or {}).get('classes'))
+
+    context = mp.get_context('spawn')
+    results = context.SimpleQueue()
+    mp.spawn(_worker, nprocs=world_size, join=True,
+             args=(world_size, _free_port(), Path(data_dir), model_name,
+                   n_epochs, batch_size, lr, patience, checkpoint_path,
+                   model_path, seed, results))
+    history, elapsed = results.get()
+    history.attrs['elapsed'] = elapsed
+
+    return history
+
+
+def benchmark_scaling(data_dir: Path,
+                      model_name: str = 'PytorchClassification_6',
+                      world_sizes: Sequence[int] = (1, 2, 4),
+                      n_epochs: int = 1,
+                      batch_size: int = 1024) -> pd.DataFrame:
+    """
+    Time the data-parallel training for different numbers of processes.
+    :param world_sizes: the numbers of processes to try
+    :return: dataframe of the wall time, the training throughput, the
+    speedup over the first number of processes and the parallel efficiency
+    """
+    results = []
+    for world_size in world_sizes:
+        history = train_distributed(data_dir, model_name, world_size,
+                                    n_epochs=n_epochs, batch_size=batch_size)
+        results.append({'processes': world_size,
+                        'seconds': history.attrs['elapsed'],
+                        'samples_per_sec': history['samples_per_sec'].mean(),
+                        'val_accuracy': history['val_accuracy'].iloc[-1]})
+
+    results = pd.DataFrame(results)
+    results['speedup'] = results['seconds'].iloc[0] / results['seconds']
+    results['efficiency'] = (results['speedup'] *
+                             results['processes'].iloc[0] /
+                             results['processes'])
+
+    return results
+
+
+@click.group()
+def main():
+    """ Trains models with data-parallel processes on CPU.
+    """
+
+
+@main.command()
+@click.argument('data_dirpath', type=click.Path(exists=True))
+@click.argument('model_filepath', type=click.Path())
+@click.option('--model', 'model_name', default='PytorchClassification_6',
+              show_default=True, help='Model class in src/models/pytorch.py.')
+@click.option('--workers', type=int, default=2, show_default=True,
+              help='Number of processes.')
+@click.option('--epochs', type=int, default=20, show_default=True)
+@click.option('--batch-size', type=int, default=1024, show_default=True,
+              help='Number of observations per batch and process.')
+@click.option('--lr', type=float, default=0.001, show_default=True)
+@click.option('--patience', type=int, default=None,
+              help='Epochs without improvement before stopping early.')
+@click.option('--checkpoint', 'checkpoint_filepath', type=click.Path(),
+              default=None, help='Checkpoint to resume from and save to.')
+def train(data_dirpath, model_filepath, model_name, workers, epochs,
+          batch_size, lr, patience, checkpoint_filepath):
+    """ Trains a model on the preprocessed sets saved in the npy format
+        (e.g. in ../data/processed) and saves it (e.g. to
+        ../models/6_pytorch_model.torch).
+    """
+    history = train_distributed(Path(data_dirpath), model_name, workers,
+                                n_epochs=epochs, batch_size=batch_size, lr=lr,
+                                patience=patience,
+                                checkpoint_path=checkpoint_filepath,
+                                model_path=model_filepath)
+    logger.info(f'training history:\n{history}')
+
+
+@main.command()
+@click.argument('data_dirpath', type=click.Path(exists=True))
+@click.option('--model', 'model_name', default='PytorchClassification_6',
+              show_default=True, help='Model class in src/models/pytorch.py.')
+@click.option('--workers', type=int, multiple=True, default=(1, 2, 4),
+              show_default=True, help='Number of processes, can be repeated.')
+@click.option('--epochs', type=int, default=1, show_default=True)
+def benchmark(data_dirpath, model_name, workers, epochs):
+    """ Times the training with different numbers of processes.
+    """
+    results = benchmark_scaling(Path(data_dirpath), model_name, workers,
+                                n_epochs=epochs)
+    logger.info(f'scaling benchmark:\n{results}')
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,507 @@
+import abc
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency buckets, in seconds, from 50µs to 10s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the batch size buckets, in rows
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384,
+                65536, 262144)
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', r'\\').replace('"', r'\"')
+        .replace('\n', r'\n')) for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class _Metric(abc.ABC):
+    """
+    Base of the metrics: a family of children, one per combination of label
+    values, each updated under its own lock
+    """
+    type_name = None
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self._new_child()
+            self._children[()] = self._default
+
+    @abc.abstractmethod
+    def _new_child(self):
+        """
+        :return: a new child, e.g. a `_CounterChild`
+        """
+
+    def labels(self, *values):
+        """
+        :param values: the value of each label, in the order of `labelnames`
+        :return: the child of these label values, created on first use
+        """
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f'{self.name} expects the labels '
+                                 f'{self.labelnames}, got {values}')
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    @abc.abstractmethod
+    def _samples(self) -> List[Tuple[str, Tuple, Tuple, float]]:
+        """
+        :return: the suffix, label names, label values and value of each
+        sample to render
+        """
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.type_name}']
+        for suffix, names, values, value in self._samples():
+            lines.append(f'{self.name}{suffix}'
+                         f'{_format_labels(names, values)} '
+                         f'{_format_value(value)}')
+        return '\n'.join(lines)
+
+    def __getattr__(self, attr):
+        # A metric without labels is updated like its only child
+        if attr.startswith('_') or '_default' not in self.__dict__:
+            raise AttributeError(attr)
+        return getattr(self._default, attr)
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """
+    Monotonic counter, e.g. of requests or rows
+    """
+    type_name = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _samples(self):
+        return [('_total', self.labelnames, values, child.value)
+                for values, child in list(self._children.items())]
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        """
+        Read the value from `function` when the metrics are rendered.
+        """
+        self.function = function
+
+    @contextmanager
+    def track_in_progress(self):
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+    def get(self) -> float:
+        return self.function() if self.function is not None else self.value
+
+
+class Gauge(_Metric):
+    """
+    Value that goes up and down, e.g. the number of requests in flight
+    """
+    type_name = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def _samples(self):
+        return [('', self.labelnames, values, child.get())
+                for values, child in list(self._children.items())]
+
+
+class _HistogramChild:
+    def __init__(self, upper_bounds: Tuple[float]):
+        self.upper_bounds = upper_bounds
+        # Count of each bucket, not cumulative, the last one is +Inf
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect_left(self.upper_bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observations in cumulative buckets, e.g. of latencies
+    """
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.upper_bounds)
+
+    def _samples(self):
+        samples = []
+        names = self.labelnames + ('le',)
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.upper_bounds + (float('inf'),),
+                                    counts):
+                cumulative += count
+                samples.append(('_bucket', names,
+                                values + (_format_value(bound),),
+                                cumulative))
+            samples.append(('_sum', self.labelnames, values, total))
+            samples.append(('_count', self.labelnames, values, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Collection of metrics rendered in the Prometheus text format
+    ...
+
+    Attributes
+    ----------
+    metrics : dict
+        The metrics, by name
+
+    Methods
+    -------
+    counter(name, documentation, labelnames)
+        Create and register a counter
+    gauge(name, documentation, labelnames)
+        Create and register a gauge
+    histogram(name, documentation, labelnames, buckets)
+        Create and register a histogram
+    render()
+        Return the metrics in the Prometheus text exposition format
+    """
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f'metric {metric.name} already registered')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str,
+                labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str,
+              labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str,
+                  labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames,
+                                        buckets))
+
+    def render(self) -> str:
+        return '\n'.join(metric.render()
+                         for metric in self.metrics.values()) + '\n'
+
+
+# Trace of the request being served, if it was sampled
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Trace:
+    """
+    Timings of the stages of one sampled request
+    """
+
+    def __init__(self, name: str):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.start = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+        self.attributes = {}
+        self.spans = []
+
+    def add_span(self, stage: str, start: float, duration: float):
+        self.spans.append({'stage': stage,
+                           'offset_ms': (start - self._start) * 1000,
+                           'duration_ms': duration * 1000})
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start
+
+    def to_dict(self) -> dict:
+        return {'trace_id': self.trace_id,
+                'name': self.name,
+                'start': self.start,
+                'duration_ms': (self.duration * 1000
+                                if self.duration is not None else None),
+                'attributes': self.attributes,
+                'spans': self.spans}
+
+
+class _BatchTrace:
+    """
+    Stand-in for the current trace while predicting a micro-batch: records
+    each span into the traces of all the sampled requests of the batch
+    """
+    __slots__ = ('traces',)
+
+    def __init__(self, traces: List[Trace]):
+        self.traces = traces
+
+    def add_span(self, stage: str, start: float, duration: float):
+        for trace in self.traces:
+            trace.add_span(stage, start, duration)
+
+
+def batch_context(contexts: Sequence[contextvars.Context]
+                  ) -> contextvars.Context:
+    """
+    Context to predict a micro-batch in, see `MicroBatcher.merge_contexts`:
+    the stages timed in it are recorded into the trace of every sampled
+    request of the batch, along with the size of the batch.
+    :param contexts: the contexts of the requests of the batch
+    :return: a new context
+    """
+    traces = [trace for trace in (context.get(_current_trace)
+                                  for context in contexts)
+              if trace is not None]
+    for trace in traces:
+        trace.attributes['microbatch_size'] = len(contexts)
+
+    context = contextvars.Context()
+    if traces:
+        context.run(_current_trace.set, _BatchTrace(traces))
+    return context
+
+
+class Tracer:
+    """
+    Sampled tracing of the stages of the requests
+    ...
+
+    A fraction `sample_rate` of the requests get a trace, which collects a
+    span per stage timed while serving them, in the same task or in the
+    threads it runs code in. The stages of a micro-batch reach the traces
+    of its requests through `batch_context` only: the same spans are then
+    recorded in the trace of every sampled request of the batch, and the
+    wait for the batch to fill up is not a span of its own. The finished
+    traces are logged as JSON and the last `max_traces` are kept in memory.
+    The sample rate can be changed at any time; at 0 the only cost per
+    request is one comparison.
+
+    Attributes
+    ----------
+    sample_rate : float
+        Fraction of the requests traced, between 0 and 1
+    traces : deque
+        The last finished traces
+
+    Methods
+    -------
+    trace(name)
+        Context manager tracing a request if it is sampled
+    recent(n)
+        Return the last `n` finished traces
+    """
+
+    def __init__(self, sample_rate: float = 0.0, max_traces: int = 100):
+        self.sample_rate = sample_rate
+        self.traces = deque(maxlen=max_traces)
+
+    @property
+    def sample_rate(self) -> float:
+        return self._sample_rate
+
+    @sample_rate.setter
+    def sample_rate(self, value: float):
+        if not 0 <= value <= 1:
+            raise ValueError('the sample rate must be between 0 and 1')
+        self._sample_rate = value
+
+    @contextmanager
+    def trace(self, name: str):
+        if self._sample_rate <= 0 or random.random() >= self._sample_rate:
+            yield None
+            return
+
+        trace = Trace(name)
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            _current_trace.reset(token)
+            trace.finish()
+            self.traces.append(trace)
+            logger.info(f'trace {json.dumps(trace.to_dict())}')
+
+    def recent(self, n: int = None) -> List[dict]:
+        traces = list(self.traces)
+        if n is not None:
+            if n < 0:
+                raise ValueError('the number of traces must be positive')
+            traces = traces[len(traces) - n:] if n < len(traces) else traces
+        return [trace.to_dict() for trace in traces]
+
+
+class _StageTimer:
+    """
+    Context manager timing a stage into a histogram and the current trace,
+    a class rather than a generator as it runs several times per request
+    """
+    __slots__ = ('histogram', 'name', 'start')
+
+    def __init__(self, histogram: _HistogramChild, name: str):
+        self.histogram = histogram
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        duration = time.perf_counter() - self.start
+        self.histogram.observe(duration)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_span(self.name, self.start, duration)
+
+
+class Instrumentation:
+    """
+    Latency and throughput metrics of the inference API
+    ...
+
+    Every stage of a prediction (parsing the payload, building the
+    dataframe, the transform, the conversion to a tensor, the forward pass,
+    decoding the labels, the lookups) is timed into a histogram, and into
+    the current trace when the request is sampled. The requests, rows,
+    batch sizes and requests in flight are counted too. Updating a metric
+    takes a lock and a couple of additions, a few microseconds.
+
+    Attributes
+    ----------
+    registry : MetricsRegistry
+        The metrics
+    tracer : Tracer
+        The sampled tracing
+    requests, rows : Counter
+        Requests by endpoint and status code, and rows predicted by
+        endpoint
+    request_seconds, stage_seconds : Histogram
+        Latency of the requests by endpoint, and of the stages
+    batch_size : Histogram
+        Number of rows per prediction, by source
+    in_flight : Gauge
+        Requests being served, by endpoint
+
+    Methods
+    -------
+    stage(name)
+        Context manager timing a stage
+    observe_request(endpoint, status, seconds)
+        Record a served request
+    render()
+        Return the metrics in the Prometheus text format
+    """
+
+    def __init__(self, namespace: str = 'inference',
+                 sample_rate: float = 0.0):
+        self.registry = MetricsRegistry()
+        self.tracer = Tracer(sample_rate)
+
+        self.requests = self.registry.counter(
+            f'{namespace}_requests', 'Number of requests served.',
+            ('endpoint', 'status'))
+        self.rows = self.registry.counter(
+            f'{namespace}_rows', 'Number of rows predicted.', ('endpoint',))
+        self.request_seconds = self.registry.histogram(
+            f'{namespace}_request_seconds', 'Latency of the requests.',
+            ('endpoint',))
+        self.stage_seconds = self.registry.histogram(
+            f'{namespace}_stage_seconds',
+            'Latency of the stages of the predictions.', ('stage',))
+        self.batch_size = self.registry.histogram(
+            f'{namespace}_batch_size', 'Number of rows per prediction.',
+            ('source',), buckets=SIZE_BUCKETS)
+        self.in_flight = self.registry.gauge(
+            f'{namespace}_requests_in_flight',
+            'Number of requests being served.', ('endpoint',))
+
+    def stage(self, name: str) -> '_StageTimer':
+        return _StageTimer(self.stage_seconds.labels(name), name)
+
+    def observe_request(self, endpoint: str, status: int, seconds: float):
+        self.requests.labels(endpoint, status).inc()
+        self.request_seconds.labels(endpoint).observe(seconds)
+
+    def render(self) -> str:
+        return self.registry.render()
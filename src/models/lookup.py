@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Mapping, Optional, Tuple, Union
+
+import click
+import numpy as np
+import pandas as pd
+import torch
+
+from src.models.pipes import FEATURES, CompiledPipe
+
+logger = logging.getLogger(__name__)
+
+TABLE_FILE = 'table.npy'
+METADATA_FILE = 'metadata.json'
+
+# The review scores go from 0 to 5 in steps of 0.5
+GRID_START = 0.0
+GRID_STEP = 0.5
+GRID_SIZE = 11
+
+
+def file_digest(path: Path) -> str:
+    """
+    SHA-1 digest of a file, used to tie a lookup table to its artifacts.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def classes_digest(classes) -> str:
+    """
+    SHA-1 digest of the classes of a label encoder, in order: the table
+    holds indices into them, so it only decodes right with the same ones.
+    """
+    return hashlib.sha1(json.dumps([str(c) for c in classes])
+                        .encode()).hexdigest()
+
+
+def build_lookup_table(model,
+                       compiled_pipe: CompiledPipe,
+                       classes: list,
+                       output_dir: Path,
+                       metadata: dict = None,
+                       grid_start: float = GRID_START,
+                       grid_step: float = GRID_STEP,
+                       grid_size: int = GRID_SIZE) -> np.memmap:
+    """
+    Score every combination of brewery and on-grid review scores and save
+    the predicted class of each one in a memory-mapped array. Breweries
+    sharing a binary code share the same predictions, so the grid is scored
+    once per distinct code.
+    :param model: the serving model, in evaluation mode
+    :param compiled_pipe: the compiled preprocessing pipe of the model
+    :param classes: the classes of the label encoder
+    :param output_dir: directory to save the table and its metadata into
+    :param metadata: extra metadata to save, e.g. the digests of the
+    artifacts
+    :param grid_start: the lowest review score
+    :param grid_step: the step between two review scores
+    :param grid_size: the number of review scores
+    :return: the table of shape (n_codes, grid_size, ..., grid_size)
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    n_categories = len(compiled_pipe.categories)
+    codes, brewery_codes = np.unique(
+        compiled_pipe.brewery_table[:n_categories], axis=0,
+        return_inverse=True)
+    brewery_codes = brewery_codes.reshape(-1)
+
+    # Features of every combination of scores, the brewery columns are
+    # overwritten for each code
+    grid = grid_start + grid_step * np.arange(grid_size)
+    scores = np.meshgrid(*[grid] * (len(FEATURES) - 1), indexing='ij')
+    n_rows = scores[0].size
+    features = compiled_pipe.transform({
+        'brewery_name': [compiled_pipe.categories[0]] * n_rows,
+        **{col: score.reshape(-1)
+           for col, score in zip(FEATURES[1:], scores)}
+    })
+    X = torch.from_numpy(features)
+
+    dtype = np.uint8 if len(classes) <= 2 ** 8 else np.uint16
+    shape = (len(codes),) + (grid_size,) * (len(FEATURES) - 1)
+    table = np.lib.format.open_memmap(str(output_dir / TABLE_FILE),
+                                      mode='w+', dtype=dtype, shape=shape)
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        for i, code in enumerate(codes):
+            features[:, compiled_pipe.brewery_columns] = code
+            preds = model(X).argmax(1).numpy()
+            table[i] = preds.reshape(shape[1:])
+    table.flush()
+    elapsed = time.perf_counter() - start
+    logger.info(f'scored {len(codes) * n_rows} combinations in '
+                f'{elapsed:.1f}s')
+
+    metadata = dict(metadata or {},
+                    grid_start=grid_start,
+                    grid_step=grid_step,
+                    grid_size=grid_size,
+                    categories=list(compiled_pipe.categories),
+                    brewery_codes=brewery_codes.tolist(),
+                    classes=list(classes),
+                    classes_digest=classes_digest(classes))
+    with open(output_dir / METADATA_FILE, 'w') as f:
+        json.dump(metadata, f)
+
+    return table
+
+
+class LookupTable:
+    """
+    Predictions for the full grid of inputs, read from a memory-mapped array
+    ...
+
+    Answers in constant time, without PyTorch, for known breweries and
+    review scores exactly on the grid. Other inputs are misses and have to
+    be predicted by the model.
+
+    Attributes
+    ----------
+    table : np.ndarray
+        Predicted class per binary code and combination of scores
+    categories : pd.Index
+        The breweries known to the pipe
+    brewery_codes : np.ndarray
+        Position of each brewery's binary code in the table
+    classes : list
+        The beer styles, in the order of the label encoder
+    metadata : dict
+        The metadata saved with the table
+
+    Methods
+    -------
+    load(path)
+        Open a table created by `build_lookup_table`
+    lookup(brewery_name, *scores)
+        Return the predicted class index of an observation or None
+    lookup_many(X)
+        Return the predicted class indices of a batch and which were found
+    """
+
+    def __init__(self, table: np.ndarray, metadata: dict):
+        self.table = table
+        self.metadata = metadata
+        self.categories = pd.Index(metadata['categories'])
+        self.brewery_codes = np.asarray(metadata['brewery_codes'])
+        self.classes = metadata['classes']
+        self.grid_start = metadata['grid_start']
+        self.grid_step = metadata['grid_step']
+        self.grid_size = metadata['grid_size']
+        self._index = dict(zip(metadata['categories'],
+                               self.brewery_codes.tolist()))
+
+    @classmethod
+    def load(cls, path: Path) -> 'LookupTable':
+        path = Path(path)
+        with open(path / METADATA_FILE) as f:
+            metadata = json.load(f)
+        table = np.load(path / TABLE_FILE, mmap_mode='r')
+
+        return cls(table, metadata)
+
+    def _grid_index(self, score: float) -> Optional[int]:
+        position = (score - self.grid_start) / self.grid_step
+        # Also rules out NaN
+        if not 0 <= position < self.grid_size:
+            return None
+        index = int(position)
+
+        return index if index == position else None
+
+    def lookup(self,
+               brewery_name: str,
+               review_aroma: float,
+               review_appearance: float,
+               review_palate: float,
+               review_taste: float) -> Optional[int]:
+        """
+        :return: the index of the predicted class, or None if the brewery is
+        unknown or a score is off the grid
+        """
+        code = self._index.get(brewery_name)
+        if code is None:
+            return None
+
+        index = [code]
+        for score in (review_aroma, review_appearance, review_palate,
+                      review_taste):
+            position = self._grid_index(score)
+            if position is None:
+                return None
+            index.append(position)
+
+        return int(self.table[tuple(index)])
+
+    def lookup_many(self,
+                    X: Union[pd.DataFrame, Mapping]
+                    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param X: dataframe, or mapping of column to values, of the
+        `FEATURES` columns
+        :return: the index of the predicted class of each observation, -1 for
+        misses, and the boolean mask of the hits
+        """
+        rows = self.categories.get_indexer(pd.Index(X['brewery_name']))
+        found = rows != -1
+        index = [np.where(found, self.brewery_codes[rows], 0)]
+
+        for col in FEATURES[1:]:
+            position = ((np.asarray(X[col], dtype=np.float64) -
+                         self.grid_start) / self.grid_step)
+            on_grid = ((position == np.floor(position)) & (position >= 0) &
+                       (position < self.grid_size))
+            found &= on_grid
+            index.append(np.where(on_grid, position, 0).astype(np.intp))
+
+        preds = np.full(len(rows), -1, dtype=np.int64)
+        preds[found] = self.table[tuple(i[found] for i in index)]
+
+        return preds, found
+
+
+@click.command()
+@click.argument('model_filepath', type=click.Path(exists=True))
+@click.argument('pipe_filepath', type=click.Path(exists=True))
+@click.argument('label_encoder_filepath', type=click.Path(exists=True))
+@click.argument('output_dirpath', type=click.Path())
+def main(model_filepath, pipe_filepath, label_encoder_filepath,
+         output_dirpath):
+    """ Scores the full grid of inputs with the serving model (e.g.
+        ../models/model.pt) and saves the lookup table (e.g. in
+        ../models/lookup) for the "table" serving mode.
+    """
+    from joblib import load
+    from src.models.pipes import compile_preprocessing_pipe
+    from src.models.registry import load_model
+
+    model, _ = load_model(Path(model_filepath))
+    compiled_pipe = compile_preprocessing_pipe(load(pipe_filepath))
+    le = load(label_encoder_filepath)
+
+    build_lookup_table(model, compiled_pipe, le.classes_.tolist(),
+                       Path(output_dirpath),
+                       metadata={
+                           'model_digest': file_digest(model_filepath),
+                           'pipe_digest': file_digest(pipe_filepath)
+                       })
+    logger.info(f'saved the lookup table in {output_dirpath}')
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
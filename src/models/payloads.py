@@ -0,0 +1,147 @@
+import io
+import json
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from src.models.pipes import FEATURES
+
+SCORE_COLUMNS = FEATURES[1:]
+
+JSON_CONTENT_TYPE = 'application/json'
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+ARROW_CONTENT_TYPE = 'application/vnd.apache.arrow.stream'
+
+
+class PayloadError(ValueError):
+    """Raised when a bulk prediction payload cannot be parsed or is invalid"""
+
+
+class UnsupportedPayloadError(PayloadError):
+    """Raised when a bulk prediction payload has an unsupported format"""
+
+
+def parse_columnar_json(body: bytes) -> pd.DataFrame:
+    """
+    Parse a columnar JSON payload, i.e. an object mapping each feature to a
+    list of values, e.g. `{"brewery_name": [...], "review_aroma": [...]}`.
+    :param body: the raw request body
+    :return: dataframe of the features
+    """
+    try:
+        columns = json.loads(body)
+    except ValueError as e:
+        raise PayloadError(f'invalid JSON: {e}')
+
+    if not isinstance(columns, dict):
+        raise PayloadError('expected a JSON object mapping each feature to '
+                           'a list of values')
+    for col in FEATURES:
+        if not isinstance(columns.get(col, []), list):
+            raise PayloadError(f'`{col}` must be a list')
+
+    lengths = {col: len(columns[col]) for col in FEATURES if col in columns}
+    if len(set(lengths.values())) > 1:
+        raise PayloadError(f'all features must have the same number of '
+                           f'values, got {lengths}')
+
+    return pd.DataFrame({col: columns[col]
+                         for col in FEATURES if col in columns})
+
+
+def parse_ndjson(body: bytes) -> pd.DataFrame:
+    """
+    Parse a newline delimited JSON payload with one object per observation.
+    :param body: the raw request body
+    :return: dataframe of the features
+    """
+    try:
+        records = [json.loads(line) for line in body.splitlines()
+                   if line.strip()]
+    except ValueError as e:
+        raise PayloadError(f'invalid NDJSON: {e}')
+
+    if not all(isinstance(record, dict) for record in records):
+        raise PayloadError('expected one JSON object per line')
+
+    return pd.DataFrame.from_records(records, columns=FEATURES)
+
+
+def parse_arrow(body: bytes) -> pd.DataFrame:
+    """
+    Parse an Arrow IPC stream. Requires `pyarrow`.
+    :param body: the raw request body
+    :return: dataframe of the features
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise UnsupportedPayloadError('Arrow payloads require pyarrow to be '
+                                      'installed')
+
+    try:
+        table = pa.ipc.open_stream(io.BytesIO(body)).read_all()
+    except pa.ArrowInvalid as e:
+        raise PayloadError(f'invalid Arrow IPC stream: {e}')
+
+    return table.to_pandas()
+
+
+PARSERS = {
+    JSON_CONTENT_TYPE: parse_columnar_json,
+    NDJSON_CONTENT_TYPE: parse_ndjson,
+    ARROW_CONTENT_TYPE: parse_arrow
+}
+
+
+def _first_rows(mask: np.ndarray, n: int = 10) -> List[int]:
+    return np.flatnonzero(mask)[:n].tolist()
+
+
+def validate_features(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Validates all the observations at once with column-wise operations
+    rather than one object per row.
+    :param df: dataframe of the features, e.g. from one of the parsers
+    :return: dataframe of the `FEATURES` columns with float scores
+    """
+    missing = [col for col in FEATURES if col not in df.columns]
+    if missing:
+        raise PayloadError(f'missing features: {missing}')
+
+    if len(df) == 0:
+        raise PayloadError('the payload contains no observations')
+
+    names = df['brewery_name']
+    if pd.api.types.infer_dtype(names, skipna=False) != 'string':
+        bad = ~names.map(lambda x: isinstance(x, str)).to_numpy()
+        raise PayloadError(f'`brewery_name` must be strings, invalid rows: '
+                           f'{_first_rows(bad)}')
+
+    scores = df[SCORE_COLUMNS].apply(pd.to_numeric, errors='coerce')
+    bad = ~np.isfinite(scores.to_numpy(dtype=np.float64)).all(axis=1)
+    if bad.any():
+        raise PayloadError(f'review scores must be finite numbers, invalid '
+                           f'rows: {_first_rows(bad)}')
+
+    result = scores.astype(np.float64)
+    result.insert(0, 'brewery_name', names)
+
+    return result
+
+
+def parse_payload(body: bytes, content_type: str) -> pd.DataFrame:
+    """
+    Parse and validate a bulk prediction payload.
+    :param body: the raw request body
+    :param content_type: the media type of the body, one of `PARSERS`
+    :return: dataframe of the `FEATURES` columns
+    """
+    media_type = content_type.split(';')[0].strip().lower()
+    if media_type not in PARSERS:
+        raise UnsupportedPayloadError(f'unsupported content type '
+                                      f'`{media_type}`, expected one of '
+                                      f'{list(PARSERS)}')
+
+    return validate_features(PARSERS[media_type](body))
@@ -1,7 +1,9 @@
-from sklearn.metrics import roc_auc_score
-from typing import Dict
+from typing import Dict, Sequence
+import numpy as np
 import pandas as pd
 
+AGGREGATES = ['accuracy', 'macro avg', 'weighted avg']
+
 
 def convert_cr_to_dataframe(report_dict: Dict) -> pd.DataFrame:
     """
@@ -11,47 +13,166 @@ def convert_cr_to_dataframe(report_dict: Dict) -> pd.DataFrame:
     sklearn.metrics.classification_report.
     :return: Returns a dataframe of the same information.
     """
-    beer_style = list(report_dict.keys())
-    beer_style.remove('accuracy')
-    beer_style.remove('macro avg')
-    beer_style.remove('weighted avg')
+    result = (
+        pd.DataFrame.from_dict(
+            {key: value for key, value in report_dict.items()
+             if key not in AGGREGATES},
+            orient='index')
+        .rename(columns={'f1-score': 'f1'})
+        .rename_axis('beer_style')
+        .reset_index()
+    )
+
+    return result[['beer_style', 'precision', 'recall', 'f1', 'support']]
+
+
+def _encode(y_true, y_pred=None, classes: Sequence = None):
+    # Codes of the labels in `classes`, by default the sorted labels seen
+    if classes is None:
+        labels = y_true if y_pred is None else np.concatenate([y_true, y_pred])
+        classes = np.unique(labels)
+    classes = np.asarray(classes)
+    index = pd.Index(classes)
+    true_codes = index.get_indexer(y_true)
+    pred_codes = index.get_indexer(y_pred) if y_pred is not None else None
+    if (true_codes == -1).any() or (
+            pred_codes is not None and (pred_codes == -1).any()):
+        raise ValueError('some labels are not in `classes`')
+
+    return classes, true_codes, pred_codes
+
+
+def _block_auc(y_true: np.ndarray, scores: np.ndarray,
+               columns: np.ndarray) -> np.ndarray:
+    # AUC of the classes `columns`, whose scores are the columns of `scores`
+    n_rows, n_columns = scores.shape
 
-    precision = []
-    recall = []
-    f1 = []
-    support = []
+    order = np.argsort(scores, axis=0, kind='mergesort')
+    sorted_scores = np.take_along_axis(scores, order, axis=0)
 
-    for key, value in report_dict.items():
-        if key not in ['accuracy', 'macro avg', 'weighted avg']:
-            precision.append(value['precision'])
-            recall.append(value['recall'])
-            f1.append(value['f1-score'])
-            support.append(value['support'])
+    # Tie groups of each column, numbered across all the columns
+    new_group = np.ones_like(sorted_scores, dtype=bool)
+    new_group[1:] = sorted_scores[1:] != sorted_scores[:-1]
+    group = np.cumsum(new_group.T.ravel()) - 1
+    sizes = np.bincount(group)
+    starts = np.flatnonzero(new_group.T.ravel()) % n_rows
+    # Average 1-based rank of each tie group
+    ranks = (starts + (sizes + 1) / 2)[group].reshape(n_columns, n_rows)
 
-    result = pd.DataFrame({'beer_style': beer_style,
+    # Whether each sorted row is a positive of the class of its column
+    positive = (y_true[order.T] == columns[:, None])
+    n_positives = positive.sum(1)
+    n_negatives = n_rows - n_positives
+    rank_sums = (ranks * positive).sum(1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        auc = ((rank_sums - n_positives * (n_positives + 1) / 2) /
+               (n_positives * n_negatives))
+
+    return np.where((n_positives > 0) & (n_negatives > 0), auc, np.nan)
+
+
+def one_vs_rest_auc(y_true: np.ndarray, scores: np.ndarray,
+                    block_size: int = 2 ** 22) -> np.ndarray:
+    """
+    One-vs-rest ROC AUC of every class, from the Mann-Whitney U statistic:
+    the columns are sorted, tied scores get their average rank, counted with
+    one bincount, and the ranks of the positives are summed. The columns
+    are processed in blocks, so the temporary arrays stay around
+    `block_size` elements whatever the number of classes.
+    :param y_true: codes of the true classes, from 0 to n_classes - 1
+    :param scores: matrix of the probability, or any score, of each class,
+    one row per observation
+    :param block_size: number of scores processed at once, rounded down to
+    whole columns, at least one
+    :return: the AUC of each class, NaN for a class without positives or
+    negatives
+    """
+    y_true = np.asarray(y_true)
+    scores = np.asarray(scores)
+    n_rows, n_classes = scores.shape
+    step = max(1, block_size // max(n_rows, 1))
+
+    auc = np.empty(n_classes)
+    for start in range(0, n_classes, step):
+        stop = min(start + step, n_classes)
+        auc[start:stop] = _block_auc(
+            y_true, scores[:, start:stop].astype(np.float64),
+            np.arange(start, stop))
+
+    return auc
+
+
+def classification_metrics(y_true,
+                           y_pred=None,
+                           proba: np.ndarray = None,
+                           classes: Sequence = None) -> pd.DataFrame:
+    """
+    Per-class precision, recall, F1 and support, from a confusion matrix
+    built with one bincount, and the one-vs-rest ROC AUC if the
+    probabilities are given.
+    :param y_true: the true classes
+    :param y_pred: the predicted classes, by default the most likely class
+    of `proba`
+    :param proba: matrix of the probability of each class, with the columns
+    in the order of `classes`
+    :param classes: the classes, e.g. `label_encoder.classes_`, by default
+    the sorted classes seen in `y_true` and `y_pred`; required with `proba`
+    if the labels are not the column indices
+    :return: dataframe with one row per class
+    """
+    y_true = np.asarray(y_true)
+    if classes is None and proba is not None:
+        classes = np.arange(np.shape(proba)[1])
+    if y_pred is None:
+        if proba is None:
+            raise ValueError('either `y_pred` or `proba` is required')
+        y_pred = np.asarray(classes)[np.argmax(proba, axis=1)]
+
+    classes, true_codes, pred_codes = _encode(y_true, np.asarray(y_pred),
+                                              classes)
+    n_classes = len(classes)
+    confusion = np.bincount(true_codes * n_classes + pred_codes,
+                            minlength=n_classes * n_classes) \
+        .reshape(n_classes, n_classes)
+
+    true_positives = np.diagonal(confusion).astype(np.float64)
+    support = confusion.sum(1)
+    predicted = confusion.sum(0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(predicted > 0, true_positives / predicted, 0.0)
+        recall = np.where(support > 0, true_positives / support, 0.0)
+        f1 = np.where(support + predicted > 0,
+                      2 * true_positives / (support + predicted), 0.0)
+
+    result = pd.DataFrame({'beer_style': classes,
                            'precision': precision,
                            'recall': recall,
                            'f1': f1,
                            'support': support})
+    if proba is not None:
+        result['auc'] = one_vs_rest_auc(true_codes, proba)
 
     return result
 
 
 def roc_auc_score_multiclass(actual_class, pred_class, average="macro"):
-    # From https://stackoverflow.com/a/52750599
-    # creating a set of all the unique classes using the actual class list
-    unique_class = set(actual_class)
-    roc_auc_dict = {}
-    for per_class in unique_class:
-        # creating a list of all the classes except the current class
-        other_class = [x for x in unique_class if x != per_class]
-
-    # marking the current class as 1 and all other classes as 0
-    new_actual_class = [0 if x in other_class else 1 for x in actual_class]
-    new_pred_class = [0 if x in other_class else 1 for x in pred_class]
-
-    # using the sklearn metrics method to calculate the roc_auc_score
-    roc_auc = roc_auc_score(new_actual_class, new_pred_class, average=average)
-    roc_auc_dict[per_class] = roc_auc
-
-    return roc_auc_dict
+    """
+    One-vs-rest ROC AUC of the hard predictions of each class of
+    `actual_class`, as `sklearn.metrics.roc_auc_score` on the binarised
+    labels and predictions would give.
+    :param actual_class: the true classes
+    :param pred_class: the predicted classes
+    :param average: kept for compatibility, the binary AUC of each class is
+    not averaged
+    :return: dictionary of the AUC of each class
+    """
+    actual_class = np.asarray(actual_class)
+    classes, true_codes, pred_codes = _encode(actual_class,
+                                              np.asarray(pred_class))
+    one_hot = np.zeros((len(pred_codes), len(classes)), dtype=np.float64)
+    one_hot[np.arange(len(pred_codes)), pred_codes] = 1
+    auc = one_vs_rest_auc(true_codes, one_hot)
+
+    present = np.isin(classes, actual_class)
+    return dict(zip(classes[present].tolist(), auc[present].tolist()))
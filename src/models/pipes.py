@@ -1,22 +1,173 @@
 from pathlib import Path
+from typing import Mapping, Union
 from category_encoders.binary import BinaryEncoder
+from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler, LabelEncoder
+import numpy as np
 import pandas as pd
 from joblib import load
 from pathlib import Path
 
+# The columns expected by the preprocessing pipe, in order
+FEATURES = ['brewery_name', 'review_aroma', 'review_appearance',
+            'review_palate', 'review_taste']
+
+
+class BinaryCodeEncoder(BaseEstimator, TransformerMixin):
+    """
+    Binary encoder of a high-cardinality column working on categorical codes
+    ...
+
+    The categories are numbered in the order they are first seen and keep
+    their number when new batches are learnt with `partial_fit`, so the
+    binary code of a category never changes. The categories seen at most
+    `min_count` times are merged by remapping their code to the one of the
+    unknown categories, whose binary code is all zeros; missing values have
+    their own code. A categorical column is encoded by mapping its
+    categories once and taking its codes, and other columns with one hash
+    lookup, rather than re-learning a mapping over the strings.
+
+    Attributes
+    ----------
+    col : str
+        The column to encode
+    min_count : int
+        Categories seen at most this many times are merged
+    n_bits : int
+        Number of output columns, None to use as few as needed; set it to
+        keep the output width when new categories are learnt
+    categories_ : pd.Index
+        The categories seen, in the order they were first seen
+    counts_ : np.ndarray
+        Number of times each category was seen
+    codes_ : np.ndarray
+        Code of each category after merging the rare ones
+    n_bits_ : int
+        Number of output columns
+
+    Methods
+    -------
+    fit(X, y)
+        Learn the categories of a dataframe
+    partial_fit(X, y)
+        Learn the categories of a new batch, keeping the codes of the
+        categories seen before
+    transform(X)
+        Replace the column by its binary code
+    """
+
+    # Codes of the merged and unknown categories and of the missing values,
+    # the categories are numbered from `FIRST_CODE`
+    OTHER_CODE = 0
+    MISSING_CODE = 1
+    FIRST_CODE = 2
+
+    def __init__(self,
+                 col: str = 'brewery_name',
+                 min_count: int = 0,
+                 n_bits: int = None):
+        self.col = col
+        self.min_count = min_count
+        self.n_bits = n_bits
+
+    def fit(self, X: pd.DataFrame, y: pd.Series = None):
+        for attr in ('categories_', 'counts_'):
+            if hasattr(self, attr):
+                delattr(self, attr)
+        return self.partial_fit(X, y)
+
+    def partial_fit(self, X: pd.DataFrame, y: pd.Series = None):
+        values = X[self.col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+        else:
+            codes, uniques = pd.factorize(values)
+        counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        uniques, counts = uniques[counts > 0], counts[counts > 0]
+
+        if not hasattr(self, 'categories_'):
+            self.categories_ = pd.Index([], dtype=object)
+            self.counts_ = np.zeros(0, dtype=np.int64)
+        positions = self.categories_.get_indexer(uniques)
+        new = positions == -1
+        self.categories_ = self.categories_.append(uniques[new])
+        self.counts_ = np.concatenate([self.counts_,
+                                       np.zeros(new.sum(), dtype=np.int64)])
+        positions[new] = np.arange(len(self.categories_) - new.sum(),
+                                   len(self.categories_))
+        self.counts_[positions] += counts
+
+        self.codes_ = np.where(self.counts_ > self.min_count,
+                               np.arange(len(self.categories_)) +
+                               self.FIRST_CODE,
+                               self.OTHER_CODE)
+        n_bits = max(int(len(self.categories_) + self.FIRST_CODE - 1)
+                     .bit_length(), 1)
+        if self.n_bits is not None:
+            if n_bits > self.n_bits:
+                raise ValueError(f'{len(self.categories_)} categories do not '
+                                 f'fit in {self.n_bits} bits')
+            n_bits = self.n_bits
+        self.n_bits_ = n_bits
+
+        return self
+
+    def _codes(self, values: pd.Series) -> np.ndarray:
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # Map the categories once, then take the codes of the values
+            positions = self.categories_.get_indexer(values.cat.categories)
+            table = np.append(np.where(positions >= 0,
+                                       self.codes_[positions],
+                                       self.OTHER_CODE),
+                              self.MISSING_CODE)
+            return table[values.cat.codes.to_numpy()]
+
+        positions = self.categories_.get_indexer(values)
+        codes = np.where(positions >= 0, self.codes_[positions],
+                         self.OTHER_CODE)
+        codes[np.asarray(pd.isna(values))] = self.MISSING_CODE
+        return codes
+
+    def transform(self, X: pd.DataFrame) -> pd.DataFrame:
+        codes = self._codes(X[self.col])
+        shifts = np.arange(self.n_bits_ - 1, -1, -1)
+        bits = ((codes[:, None] >> shifts) & 1).astype(np.uint8)
+
+        encoded = pd.DataFrame(bits,
+                               columns=[f'{self.col}_{i}'
+                                        for i in range(self.n_bits_)],
+                               index=X.index)
+        position = list(X.columns).index(self.col)
+
+        return pd.concat([X.iloc[:, :position], encoded,
+                          X.iloc[:, position + 1:]], axis=1)
+
 
 def create_preprocessing_pipe(X: pd.DataFrame,
-                              y: pd.Series = None) -> Pipeline:
+                              y: pd.Series = None,
+                              encoder: str = 'binary',
+                              min_count: int = 0) -> Pipeline:
     """
     Create a pipeline object with elements fitted to the training data.
     :param X: The dataframe of features
     :param y: The target series
+    :param encoder: 'binary' for the BinaryEncoder of category_encoders, or
+    'codes' for a `BinaryCodeEncoder`, which is faster on high-cardinality
+    columns and can learn new breweries with `partial_fit`
+    :param min_count: with 'codes', the breweries seen at most this many
+    times are merged with the unknown ones
     :return: a pipeline object
     """
+    if encoder == 'binary':
+        bin_encoder = BinaryEncoder(cols=['brewery_name'])
+    elif encoder == 'codes':
+        bin_encoder = BinaryCodeEncoder('brewery_name', min_count=min_count)
+    else:
+        raise ValueError(f'unknown encoder {encoder!r}')
+
     pipe = Pipeline([
-        ('bin_encoder', BinaryEncoder(cols=['brewery_name'])),
+        ('bin_encoder', bin_encoder),
         ('scaler', StandardScaler())
     ])
 
@@ -33,3 +184,220 @@ def load_preprocessing_pipe(pipe_name: str) -> Pipeline:
 def load_label_encoder(label_encoder_name: str) -> LabelEncoder:
     le = load(f'../models/{label_encoder_name}')
     return le
+
+
+def _encoder_categories(encoder) -> list:
+    """
+    Returns the brewery names learnt by a fitted BinaryEncoder or
+    BinaryCodeEncoder. Older versions of category_encoders wrap a
+    BaseNEncoder instead of subclassing it.
+    """
+    if isinstance(encoder, BinaryCodeEncoder):
+        return [name for name in encoder.categories_ if isinstance(name, str)]
+    base_n_encoder = getattr(encoder, 'base_n_encoder', encoder)
+    for mapping in base_n_encoder.ordinal_encoder.mapping:
+        if mapping['col'] == 'brewery_name':
+            return [name for name in mapping['mapping'].index
+                    if isinstance(name, str)]
+    raise ValueError('the encoder was not fitted on `brewery_name`')
+
+
+class CompiledPipe:
+    """
+    Pandas-free equivalent of a fitted preprocessing pipe
+    ...
+
+    Holds the binary code of every known brewery, already standardised, and
+    the mean and scale of the review scores as NumPy arrays, so that a batch
+    is transformed with one hash lookup and a few vectorised operations.
+    The scaling is done in float64 exactly like the StandardScaler, so the
+    output is bit-for-bit equal to `pipe.transform(X).astype(np.float32)`.
+
+    Attributes
+    ----------
+    categories : pd.Index
+        The brewery names known to the encoder
+    brewery_table : np.ndarray
+        Standardised binary code of each brewery, followed by the rows for
+        unknown and missing names (None if the encoder raises on them)
+    brewery_columns : np.ndarray
+        Positions of the binary code in the output
+    score_columns : np.ndarray
+        Positions of the review scores in the output
+    mean : np.ndarray
+        Mean of each review score
+    scale : np.ndarray
+        Scale of each review score
+    n_features : int
+        Number of output columns
+
+    Methods
+    -------
+    from_pipe(pipe)
+        Compile a fitted pipe created by `create_preprocessing_pipe`
+    transform(X, out)
+        Transform a batch of observations
+    transform_one(brewery_name, *scores)
+        Transform a single observation
+    """
+
+    def __init__(self,
+                 categories: list,
+                 brewery_table: np.ndarray,
+                 unknown_row: np.ndarray,
+                 missing_row: np.ndarray,
+                 brewery_columns: np.ndarray,
+                 score_columns: np.ndarray,
+                 mean: np.ndarray,
+                 scale: np.ndarray):
+        self.categories = pd.Index(categories)
+        self.brewery_columns = np.asarray(brewery_columns)
+        self.score_columns = np.asarray(score_columns)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.n_features = len(self.brewery_columns) + len(self.score_columns)
+
+        # Unknown and missing names are looked up in the last two rows
+        n_bits = len(self.brewery_columns)
+        self.unknown_index = len(categories)
+        self.missing_index = len(categories) + 1
+        self.has_unknown = unknown_row is not None
+        self.has_missing = missing_row is not None
+        self.brewery_table = np.vstack([
+            brewery_table,
+            unknown_row if self.has_unknown else np.zeros(n_bits),
+            missing_row if self.has_missing else np.zeros(n_bits)
+        ])
+        self._index = {name: i for i, name in enumerate(categories)}
+
+    @classmethod
+    def from_pipe(cls, pipe: Pipeline) -> 'CompiledPipe':
+        """
+        Compile a fitted pipe created by `create_preprocessing_pipe`.
+        :param pipe: the fitted BinaryEncoder + StandardScaler pipeline
+        :return: the compiled pipe
+        """
+        encoder, scaler = pipe.steps[0][1], pipe.steps[-1][1]
+        if len(pipe.steps) != 2 or not isinstance(scaler, StandardScaler):
+            raise TypeError('only BinaryEncoder or BinaryCodeEncoder + '
+                            'StandardScaler pipes can be compiled')
+
+        categories = _encoder_categories(encoder)
+        scores = FEATURES[1:]
+
+        def encode(names):
+            df = pd.DataFrame({'brewery_name': names})
+            for col in scores:
+                df[col] = 0.0
+            return encoder.transform(df[FEATURES])
+
+        # Encoding the names with the fitted encoder itself gives the exact
+        # codes, including the ones for unknown and missing names
+        encoded = encode(categories)
+        columns = list(encoded.columns)
+        score_columns = np.array([columns.index(col) for col in scores])
+        brewery_columns = np.array([i for i, col in enumerate(columns)
+                                    if col not in scores])
+
+        n_columns = len(columns)
+        mean = scaler.mean_ if scaler.with_mean else np.zeros(n_columns)
+        scale = scaler.scale_ if scaler.with_std else np.ones(n_columns)
+
+        def standardise(codes):
+            codes = np.array(codes, dtype=np.float64)
+            codes -= mean[brewery_columns]
+            codes /= scale[brewery_columns]
+            return codes
+
+        rows = encoded.iloc[:, brewery_columns].to_numpy()
+        special_rows = []
+        for name in ['\x00unknown brewery', None]:
+            try:
+                row = encode([name]).iloc[0, brewery_columns].to_numpy()
+                special_rows.append(standardise(row))
+            except ValueError:
+                special_rows.append(None)
+
+        return cls(categories=categories,
+                   brewery_table=standardise(rows),
+                   unknown_row=special_rows[0],
+                   missing_row=special_rows[1],
+                   brewery_columns=brewery_columns,
+                   score_columns=score_columns,
+                   mean=mean[score_columns],
+                   scale=scale[score_columns])
+
+    def _check_rows(self, rows: np.ndarray):
+        if not self.has_unknown and (rows == self.unknown_index).any():
+            raise ValueError('unknown brewery_name')
+        if not self.has_missing and (rows == self.missing_index).any():
+            raise ValueError('missing brewery_name')
+
+    def transform(self,
+                  X: Union[pd.DataFrame, Mapping],
+                  out: np.ndarray = None) -> np.ndarray:
+        """
+        Transform a batch of observations.
+        :param X: dataframe, or mapping of column name to values, of the
+        `FEATURES` columns
+        :param out: preallocated float32 array of shape (n, n_features),
+        e.g. `tensor.numpy()`, to write the features into
+        :return: float32 array of the features
+        """
+        names = pd.Index(X['brewery_name'])
+        n = len(names)
+        if out is None:
+            out = np.empty((n, self.n_features), dtype=np.float32)
+
+        rows = self.categories.get_indexer(names)
+        rows[rows == -1] = self.unknown_index
+        rows[np.asarray(pd.isna(names))] = self.missing_index
+        self._check_rows(rows)
+        out[:, self.brewery_columns] = self.brewery_table[rows]
+
+        for i, col in enumerate(FEATURES[1:]):
+            scores = np.array(X[col], dtype=np.float64)
+            scores -= self.mean[i]
+            scores /= self.scale[i]
+            out[:, self.score_columns[i]] = scores
+
+        return out
+
+    def transform_one(self,
+                      brewery_name: str,
+                      review_aroma: float,
+                      review_appearance: float,
+                      review_palate: float,
+                      review_taste: float,
+                      out: np.ndarray = None) -> np.ndarray:
+        """
+        Transform a single observation.
+        :param out: preallocated float32 array of shape (1, n_features)
+        :return: float32 array of shape (1, n_features)
+        """
+        if out is None:
+            out = np.empty((1, self.n_features), dtype=np.float32)
+
+        if isinstance(brewery_name, str):
+            row = self._index.get(brewery_name, self.unknown_index)
+        else:
+            row = self.missing_index
+        self._check_rows(np.array([row]))
+        out[0, self.brewery_columns] = self.brewery_table[row]
+
+        scores = np.array([review_aroma, review_appearance, review_palate,
+                           review_taste], dtype=np.float64)
+        scores -= self.mean
+        scores /= self.scale
+        out[0, self.score_columns] = scores
+
+        return out
+
+
+def compile_preprocessing_pipe(pipe: Pipeline) -> CompiledPipe:
+    """
+    Compile a fitted preprocessing pipe for fast inference.
+    :param pipe: a pipe created by `create_preprocessing_pipe`
+    :return: the compiled pipe
+    """
+    return CompiledPipe.from_pipe(pipe)
@@ -1,40 +1,604 @@
-from starlette.responses import JSONResponse
-import pandas as pd
+# -*- coding: utf-8 -*-
+import io
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+from typing import Iterator, List, Sequence, Tuple
+
+import click
 import numpy as np
+from joblib import load
+from starlette.responses import JSONResponse
+import pandas as pd
 import torch
-import torch.nn as nn
-import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
-from category_encoders.binary import BinaryEncoder
-from sklearn.compose import ColumnTransformer
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import StandardScaler, LabelEncoder, OneHotEncoder
-from joblib import dump, load
-
-from src.data.sets import save_sets, load_sets
-from src.visualization.visualize import classification_reports
-from src.models.pytorch import PytorchClassification
+
 from src.models.pytorch import get_device
-from src.models.pytorch import train_classification
-from src.models.pytorch import test_classification
-from src.models.pytorch import PytorchDataset
-from src.models.pipes import create_preprocessing_pipe
+from src.models.pipes import CompiledPipe
+from src.models.pipes import FEATURES
+from src.models.pipes import compile_preprocessing_pipe
 from src.models.pipes import load_preprocessing_pipe
-from src.models.pipes import load_label_encoder
-from src.visualization.visualize import plot_nn_model
+from src.models.registry import load_model
+
+logger = logging.getLogger(__name__)
+
+
+def encode(compiled_pipe: CompiledPipe, X: pd.DataFrame) -> torch.Tensor:
+    """
+    Encode the observations, writing the features straight into a tensor.
+    :param compiled_pipe: the compiled preprocessing pipe
+    :param X: dataframe of the `FEATURES` columns
+    :return: float32 tensor of the features on the device
+    """
+    X_tensor = torch.empty(len(X), compiled_pipe.n_features)
+    compiled_pipe.transform(X, out=X_tensor.numpy())
+
+    return X_tensor.to(get_device())
 
 
 def predict(model,
             X: pd.DataFrame,
             pipe_name: str = 'pipe.sav',
-            label_encoder_name: str = 'label_encoder.sav'):
-    pipe = load_preprocessing_pipe(pipe_name=pipe_name)
-    X_trans = pipe.transform(X)
-    device = get_device()
-    X_tensor = torch.Tensor(np.array(X_trans)).to(device)
-    le = load_label_encoder()
+            label_encoder_name: str = 'label_encoder.sav',
+            compiled_pipe: CompiledPipe = None):
+    if compiled_pipe is None:
+        pipe = load_preprocessing_pipe(pipe_name=pipe_name)
+        compiled_pipe = compile_preprocessing_pipe(pipe)
+
+    preds = model(encode(compiled_pipe, X)).tolist()
+
+    return JSONResponse(preds)
+
+
+def read_chunks(path: Path,
+                chunksize: int,
+                columns: Sequence[str] = FEATURES) -> Iterator[pd.DataFrame]:
+    """
+    Read a CSV or Parquet file in chunks of at most `chunksize` rows.
+    :param path: path to a `.csv` or `.parquet` file
+    :param chunksize: number of rows per chunk
+    :param columns: the columns to read
+    :return: iterator of dataframes
+    """
+    path = Path(path)
+    if path.suffix == '.parquet':
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(str(path))
+        for batch in parquet_file.iter_batches(batch_size=chunksize,
+                                               columns=list(columns)):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunksize,
+                               usecols=list(columns))
+
+
+class ChunkWriter:
+    """
+    Append dataframes to a CSV or Parquet file
+    ...
+
+    Attributes
+    ----------
+    path : Path
+        Path to a `.csv` or `.parquet` file
+
+    Methods
+    -------
+    write(df)
+        Append a dataframe
+    close()
+        Close the file
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._parquet = self.path.suffix == '.parquet'
+        self._writer = None
+        self._schema = None
+        self._header = True
+
+    def write(self, df: pd.DataFrame):
+        if self._parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._schema = table.schema
+                if not len(df):
+                    # The columns of an empty dataframe have no values to
+                    # infer their type from, they are written as strings
+                    self._schema = pa.schema([
+                        pa.field(field.name, pa.string())
+                        if pa.types.is_null(field.type) else field
+                        for field in self._schema])
+                self._writer = pq.ParquetWriter(str(self.path), self._schema)
+            if not table.schema.equals(self._schema):
+                table = table.cast(self._schema)
+            self._writer.write_table(table)
+        else:
+            df.to_csv(self.path, mode='w' if self._header else 'a',
+                      header=self._header, index=False)
+            self._header = False
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def score_chunk(model,
+                compiled_pipe: CompiledPipe,
+                classes: np.ndarray,
+                X: pd.DataFrame,
+                top_k: int = 0,
+                keep: Sequence[str] = ()) -> pd.DataFrame:
+    """
+    Predict the beer style of a chunk of observations.
+    :param model: the model, in evaluation mode
+    :param compiled_pipe: the compiled preprocessing pipe
+    :param classes: the classes of the label encoder
+    :param X: dataframe of the `FEATURES` columns
+    :param top_k: number of most likely styles to output with their
+    probabilities
+    :param keep: columns of `X` to copy to the output, e.g. an identifier
+    :return: dataframe of the kept columns and the predictions
+    """
+    with torch.no_grad():
+        output = model(encode(compiled_pipe, X))
+
+    result = pd.DataFrame({col: X[col].to_numpy() for col in keep})
+    result['beer_style'] = classes[output.argmax(1).cpu().numpy()]
+
+    if top_k > 0:
+        probs, indices = torch.softmax(output, 1).topk(top_k, dim=1)
+        probs, indices = probs.cpu().numpy(), indices.cpu().numpy()
+        for k in range(top_k):
+            result[f'top_{k + 1}_style'] = classes[indices[:, k]]
+            result[f'top_{k + 1}_prob'] = probs[:, k]
+
+    return result
+
+
+def _empty_chunk(columns: Sequence[str]) -> pd.DataFrame:
+    # Scored to write the header, or the schema, of an output without rows
+    return pd.DataFrame({col: pd.Series([], dtype=np.float64
+                                        if col in FEATURES[1:] else object)
+                         for col in columns})
+
+
+def score_file(model,
+               compiled_pipe: CompiledPipe,
+               classes: np.ndarray,
+               input_path: Path,
+               output_path: Path,
+               chunksize: int = 100000,
+               top_k: int = 0,
+               keep: Sequence[str] = (),
+               n_threads: int = 2) -> int:
+    """
+    Score a CSV or Parquet file chunk by chunk. The next chunks are read
+    while the previous ones are transformed and scored in a thread pool, and
+    at most `2 * n_threads` chunks are in memory at any time, whatever the
+    size of the input. The predictions are written in the input order. The
+    output is created even if the input has no rows, with only the header
+    of the CSV, or the schema of the Parquet file.
+    :param model: the model, in evaluation mode
+    :param compiled_pipe: the compiled preprocessing pipe
+    :param classes: the classes of the label encoder
+    :param input_path: path to a `.csv` or `.parquet` file of observations
+    :param output_path: path to the `.csv` or `.parquet` output
+    :param chunksize: number of rows per chunk
+    :param top_k: number of most likely styles to output with their
+    probabilities
+    :param keep: input columns to copy to the output, e.g. an identifier
+    :param n_threads: number of chunks scored at the same time
+    :return: the number of rows scored
+    """
+    model.eval()
+    classes = np.asarray(classes)
+    columns = list(FEATURES) + [col for col in keep if col not in FEATURES]
+    max_pending = 2 * n_threads
+    n_rows = 0
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(n_threads) as pool, \
+            ChunkWriter(output_path) as writer:
+        pending = deque()
+        for chunk in read_chunks(input_path, chunksize, columns):
+            pending.append(pool.submit(score_chunk, model, compiled_pipe,
+                                       classes, chunk, top_k, keep))
+            while len(pending) >= max_pending:
+                result = pending.popleft().result()
+                writer.write(result)
+                n_rows += len(result)
+
+        while pending:
+            result = pending.popleft().result()
+            writer.write(result)
+            n_rows += len(result)
+
+        if n_rows == 0:
+            writer.write(score_chunk(model, compiled_pipe, classes,
+                                     _empty_chunk(columns), top_k, keep))
+
+    elapsed = time.perf_counter() - start
+    logger.info(f'scored {n_rows} rows in {elapsed:.1f}s '
+                f'({n_rows / max(elapsed, 1e-9):.0f} rows/s)')
+
+    return n_rows
+
+
+class _ByteRange(io.RawIOBase):
+    """
+    Read-only view of the bytes `start` to `end` of a file.
+    """
+
+    def __init__(self, path: Path, start: int, end: int):
+        super().__init__()
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._remaining)
+        data = self._file.read(size)
+        buffer[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def _next_line(f, offset: int) -> int:
+    # Offset of the first line starting at or after `offset`
+    f.seek(offset - 1)
+    f.readline()
+    return f.tell()
+
+
+def plan_shards(path: Path, n_shards: int) -> List[Tuple]:
+    """
+    Split a CSV file into byte ranges of whole lines, or a Parquet file into
+    groups of row groups, of about the same size. CSV values must not
+    contain line breaks. A Parquet file has at most as many shards as row
+    groups, an empty file has one empty shard.
+    :param path: path to a `.csv` or `.parquet` file
+    :param n_shards: number of shards
+    :return: list of (path, start, end) byte ranges, or of (path, row
+    groups) for Parquet
+    """
+    path = Path(path)
+    if path.suffix == '.parquet':
+        import pyarrow.parquet as pq
+
+        n_row_groups = pq.ParquetFile(str(path)).num_row_groups
+        groups = np.array_split(np.arange(n_row_groups), n_shards)
+        return [(path, group.tolist()) for group in groups
+                if len(group)] or [(path, [])]
+
+    size = path.stat().st_size
+    with open(path, 'rb') as f:
+        f.readline()
+        data_start = f.tell()
+        bounds = [data_start]
+        for i in range(1, n_shards):
+            offset = data_start + (size - data_start) * i // n_shards
+            bounds.append(max(bounds[-1], _next_line(f, offset)))
+        bounds.append(size)
+
+    # An empty file still gets a shard, so that the output is created
+    return [(path, start, end) for start, end in zip(bounds, bounds[1:])
+            if end > start] or [(path, data_start, size)]
+
+
+def read_shard(shard: Tuple,
+               chunksize: int,
+               columns: Sequence[str]) -> Iterator[pd.DataFrame]:
+    """
+    Read a shard created by `plan_shards` in chunks.
+    :return: iterator of dataframes
+    """
+    path = shard[0]
+    if path.suffix == '.parquet':
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(str(path))
+        for batch in parquet_file.iter_batches(batch_size=chunksize,
+                                               row_groups=shard[1],
+                                               columns=list(columns)):
+            yield batch.to_pandas()
+    else:
+        names = pd.read_csv(path, nrows=0).columns
+        with io.TextIOWrapper(io.BufferedReader(_ByteRange(*shard)),
+                              encoding='utf-8') as f:
+            yield from pd.read_csv(f, header=None, names=names,
+                                   usecols=list(columns),
+                                   chunksize=chunksize)
+
+
+# Artifacts of a scoring worker process, loaded once by `_init_worker`
+_worker_artifacts = None
+
+
+def _init_worker(model_filepath: Path,
+                 pipe_filepath: Path,
+                 label_encoder_filepath: Path,
+                 n_threads: int):
+    global _worker_artifacts
+
+    # Share the cores between the workers rather than oversubscribing them
+    torch.set_num_threads(n_threads)
+    model, _ = load_model(Path(model_filepath))
+    compiled_pipe = compile_preprocessing_pipe(load(pipe_filepath))
+    classes = np.asarray(load(label_encoder_filepath).classes_)
+    _worker_artifacts = (model, compiled_pipe, classes)
+
+
+def _score_shard(shard: Tuple,
+                 part_path: Path,
+                 chunksize: int,
+                 top_k: int,
+                 keep: Sequence[str]) -> int:
+    model, compiled_pipe, classes = _worker_artifacts
+    columns = list(FEATURES) + [col for col in keep if col not in FEATURES]
+    n_rows = 0
+    with ChunkWriter(part_path) as writer:
+        for chunk in read_shard(shard, chunksize, columns):
+            result = score_chunk(model, compiled_pipe, classes, chunk,
+                                 top_k, keep)
+            writer.write(result)
+            n_rows += len(result)
+
+        if n_rows == 0:
+            writer.write(score_chunk(model, compiled_pipe, classes,
+                                     _empty_chunk(columns), top_k, keep))
+
+    return n_rows
+
+
+def _writer_schema(schemas: Sequence):
+    # One schema for all the parts: a column typed differently by the shards,
+    # e.g. an identifier read as int64 in one CSV shard and as float64 in
+    # another, or all missing (null) in one of them, gets a common type
+    import pyarrow as pa
+
+    fields = []
+    for field in schemas[0]:
+        types = []
+        for schema in schemas:
+            type_ = schema.field(field.name).type
+            if not pa.types.is_null(type_) and type_ not in types:
+                types.append(type_)
+        if not types:
+            type_ = pa.null()
+        elif len(types) == 1:
+            type_ = types[0]
+        elif all(pa.types.is_integer(t) or pa.types.is_floating(t)
+                 for t in types):
+            type_ = pa.float64()
+        else:
+            type_ = pa.string()
+        fields.append(pa.field(field.name, type_))
+
+    return pa.schema(fields)
+
+
+def merge_parts(part_paths: Sequence[Path], output_path: Path):
+    """
+    Concatenate the CSV or Parquet outputs of the shards, in order, without
+    loading them in memory. Missing parts, i.e. empty shards, are skipped.
+    The Parquet row groups are cast to one schema common to all the parts.
+    The output is written next to `output_path` and renamed once complete,
+    so a failed merge never leaves a truncated file behind.
+    """
+    output_path = Path(output_path)
+    part_paths = [path for path in part_paths if Path(path).exists()]
+    tmp_path = output_path.with_name(output_path.name + '.tmp')
+
+    try:
+        if output_path.suffix == '.parquet':
+            import pyarrow.parquet as pq
+
+            parts = [pq.ParquetFile(str(path)) for path in part_paths]
+            if not parts:
+                return
+            schema = _writer_schema([part.schema_arrow for part in parts])
+            writer = pq.ParquetWriter(str(tmp_path), schema)
+            try:
+                for part in parts:
+                    for i in range(part.num_row_groups):
+                        table = part.read_row_group(i)
+                        writer.write_table(table.replace_schema_metadata()
+                                           .cast(schema))
+            finally:
+                writer.close()
+        else:
+            with open(tmp_path, 'wb') as output:
+                for i, path in enumerate(part_paths):
+                    with open(path, 'rb') as part:
+                        # Only the first part keeps its header
+                        if i > 0:
+                            part.readline()
+                        shutil.copyfileobj(part, output)
+        os.replace(tmp_path, output_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def score_file_sharded(model_filepath: Path,
+                       pipe_filepath: Path,
+                       label_encoder_filepath: Path,
+                       input_path: Path,
+                       output_path: Path,
+                       n_workers: int = None,
+                       chunksize: int = 100000,
+                       top_k: int = 0,
+                       keep: Sequence[str] = ()) -> int:
+    """
+    Score a CSV or Parquet file with several processes. The file is split
+    into one shard per worker, each worker loads the artifacts once, uses
+    its share of the cores for PyTorch, streams its shard into a part file,
+    and the parts are merged in the input order.
+    :param model_filepath: TorchScript (.pt) or PyTorch (.torch) model
+    :param pipe_filepath: the preprocessing pipe
+    :param label_encoder_filepath: the label encoder
+    :param input_path: path to a `.csv` or `.parquet` file of observations
+    :param output_path: path to the `.csv` or `.parquet` output
+    :param n_workers: number of processes (default: the number of cores)
+    :param chunksize: number of rows per chunk
+    :param top_k: number of most likely styles to output with their
+    probabilities
+    :param keep: input columns to copy to the output, e.g. an identifier
+    :return: the number of rows scored
+    """
+    n_cores = os.cpu_count() or 1
+    n_workers = n_workers or n_cores
+    output_path = Path(output_path)
+    parts_dir = output_path.with_name(output_path.name + '.parts')
+    parts_dir.mkdir(parents=True, exist_ok=True)
+
+    shards = plan_shards(Path(input_path), n_workers)
+    part_paths = [parts_dir / f'part-{i:05d}{output_path.suffix}'
+                  for i in range(len(shards))]
+    start = time.perf_counter()
+
+    # Forking a process that already used PyTorch's thread pools can hang
+    context = multiprocessing.get_context('spawn')
+    try:
+        with ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(model_filepath, pipe_filepath,
+                          label_encoder_filepath,
+                          max(1, n_cores // n_workers))) as pool:
+            counts = list(pool.map(_score_shard, shards, part_paths,
+                                   [chunksize] * len(shards),
+                                   [top_k] * len(shards),
+                                   [tuple(keep)] * len(shards)))
+        merge_parts(part_paths, output_path)
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+    n_rows = sum(counts)
+    elapsed = time.perf_counter() - start
+    logger.info(f'scored {n_rows} rows with {n_workers} workers in '
+                f'{elapsed:.1f}s ({n_rows / max(elapsed, 1e-9):.0f} rows/s)')
+
+    return n_rows
+
+
+def benchmark_sharded(model_filepath: Path,
+                      pipe_filepath: Path,
+                      label_encoder_filepath: Path,
+                      input_path: Path,
+                      output_path: Path,
+                      worker_counts: Sequence[int],
+                      chunksize: int = 100000) -> pd.DataFrame:
+    """
+    Time `score_file_sharded` for different numbers of workers.
+    :param worker_counts: the numbers of workers to try, e.g. [1, 2, 4, 8]
+    :return: dataframe of the wall time, the throughput, the speedup over
+    the first number of workers and the parallel efficiency
+    """
+    results = []
+    for n_workers in worker_counts:
+        start = time.perf_counter()
+        n_rows = score_file_sharded(model_filepath, pipe_filepath,
+                                    label_encoder_filepath, input_path,
+                                    output_path, n_workers=n_workers,
+                                    chunksize=chunksize)
+        results.append({'workers': n_workers,
+                        'seconds': time.perf_counter() - start,
+                        'rows': n_rows})
+
+    results = pd.DataFrame(results)
+    results['rows_per_sec'] = results['rows'] / results['seconds']
+    results['speedup'] = results['seconds'].iloc[0] / results['seconds']
+    results['efficiency'] = (results['speedup'] * results['workers'].iloc[0] /
+                             results['workers'])
+
+    return results
+
+
+@click.command()
+@click.argument('input_filepath', type=click.Path(exists=True))
+@click.argument('output_filepath', type=click.Path())
+@click.option('--model', 'model_filepath', type=click.Path(exists=True),
+              default='models/model.pt', show_default=True,
+              help='TorchScript (.pt) or PyTorch (.torch) model.')
+@click.option('--pipe', 'pipe_filepath', type=click.Path(exists=True),
+              default='models/pipe.sav', show_default=True)
+@click.option('--label-encoder', 'label_encoder_filepath',
+              type=click.Path(exists=True),
+              default='models/label_encoder.sav', show_default=True)
+@click.option('--chunksize', type=int, default=100000, show_default=True,
+              help='Number of rows per chunk.')
+@click.option('--top-k', type=int, default=0, show_default=True,
+              help='Number of most likely styles to output with their '
+                   'probabilities.')
+@click.option('--keep', multiple=True,
+              help='Input column to copy to the output, can be repeated.')
+@click.option('--threads', type=int, default=2, show_default=True,
+              help='Number of chunks scored at the same time.')
+@click.option('--workers', type=int, default=1, show_default=True,
+              help='Number of processes, each scoring a shard of the file.')
+@click.option('--benchmark', is_flag=True,
+              help='Time the scoring with 1, 2, 4, ... up to --workers '
+                   'processes instead.')
+def main(input_filepath, output_filepath, model_filepath, pipe_filepath,
+         label_encoder_filepath, chunksize, top_k, keep, threads, workers,
+         benchmark):
+    """ Predicts the beer style of every review of a CSV or Parquet file
+        and saves the predictions as CSV or Parquet.
+    """
+    if benchmark:
+        worker_counts = [2 ** i for i in range(workers.bit_length())]
+        if worker_counts[-1] != workers:
+            worker_counts.append(workers)
+        results = benchmark_sharded(model_filepath, pipe_filepath,
+                                    label_encoder_filepath,
+                                    Path(input_filepath),
+                                    Path(output_filepath), worker_counts,
+                                    chunksize=chunksize)
+        logger.info(f'sharded scoring benchmark:\n{results}')
+        return
+
+    if workers > 1:
+        score_file_sharded(model_filepath, pipe_filepath,
+                           label_encoder_filepath, Path(input_filepath),
+                           Path(output_filepath), n_workers=workers,
+                           chunksize=chunksize, top_k=top_k, keep=keep)
+        return
+
+    model, _ = load_model(Path(model_filepath))
+    compiled_pipe = compile_preprocessing_pipe(load(pipe_filepath))
+    le = load(label_encoder_filepath)
+
+    score_file(model, compiled_pipe, le.classes_, Path(input_filepath),
+               Path(output_filepath), chunksize=chunksize, top_k=top_k,
+               keep=keep, n_threads=threads)
+
 
-    preds = model(X_tensor).tolist()
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
 
-    return JSONResponse(preds)
\ No newline at end of file
+    main()
@@ -1,8 +1,36 @@
+import contextlib
+import logging
+import os
+import random
+import time
+from pathlib import Path
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.utils.data import Dataset, DataLoader
 import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def autocast_bf16(device, enabled: bool = True):
+    """
+    Context manager running the operations that support it, e.g. the Linear
+    layers, in bfloat16 and the others, e.g. the losses, in float32. The
+    weights stay in float32. Autocast on CPU needs PyTorch 1.10 or later.
+    :param device: the device of the model
+    :param enabled: False for a context manager doing nothing
+    :return: the context manager
+    """
+    if not enabled:
+        return contextlib.nullcontext()
+    if not hasattr(torch, 'autocast'):
+        raise RuntimeError('bfloat16 autocast needs PyTorch 1.10 or later, '
+                           f'found {torch.__version__}')
+
+    return torch.autocast(torch.device(device).type, dtype=torch.bfloat16)
 
 
 def get_device():
@@ -13,235 +41,582 @@ def get_device():
     return device
 
 
-class PytorchClassification_2(nn.Module):
-    def __init__(self, n_features: int, n_classes: int):
-        super().__init__()
-        self.layer_1 = nn.Linear(n_features, 256)
-        self.batchnorm1 = nn.BatchNorm1d(256)
-        self.layer_2 = nn.Linear(256, 128)
-        self.batchnorm2 = nn.BatchNorm1d(128)
-        self.layer_out = nn.Linear(128, n_classes)
+def _scale(n_units: int, width: float) -> int:
+    # Number of units of a hidden layer scaled by the width multiplier
+    return max(1, int(round(n_units * width)))
 
-        self.relu = nn.ReLU()
-        self.dropout = nn.Dropout(p=0.2)
 
-    def forward(self, x):
-        x = self.layer_1(x)
-        x = self.batchnorm1(x)
-        x = self.relu(x)
+ACTIVATIONS = {
+    'relu': nn.ReLU,
+    'leaky_relu': nn.LeakyReLU,
+    'elu': nn.ELU,
+    'gelu': nn.GELU,
+    'silu': nn.SiLU,
+    'tanh': nn.Tanh
+}
+
+
+class PytorchMLP(nn.Module):
+    """
+    Multi-layer perceptron for classification
+    ...
 
-        x = self.layer_2(x)
-        x = self.batchnorm2(x)
-        x = self.relu(x)
-        x = self.dropout(x)
+    Every hidden layer is a Linear layer followed by a BatchNorm1d layer and
+    the activation, and by Dropout from the second hidden layer on. The
+    layers are named `layer_1`, `batchnorm1`, ..., `layer_out`, like in the
+    original PytorchClassification models, so their state dicts load as they
+    are.
+
+    Attributes
+    ----------
+    n_features : int
+        Number of input features
+    n_classes : int
+        Number of classes
+    hidden_sizes : list
+        Number of units of each hidden layer
+    activation_name : str
+        Name of the activation in `ACTIVATIONS`
+    p_dropout : float
+        Probability of Dropout
+    fused : bool
+        Whether the BatchNorm layers are folded into the Linear layers
+
+    Methods
+    -------
+    forward(x)
+        Return the logits of the classes
+    fuse()
+        Fold the BatchNorm layers into the Linear layers for inference
+    config()
+        Return the parameters to build the same model
+    """
+
+    def __init__(self,
+                 n_features: int,
+                 n_classes: int,
+                 hidden_sizes=(256, 128),
+                 activation: str = 'relu',
+                 p_dropout: float = 0.2):
+        super().__init__()
+        self.n_features = n_features
+        self.n_classes = n_classes
+        self.hidden_sizes = list(hidden_sizes)
+        self.activation_name = activation
+        self.p_dropout = p_dropout
+        self.fused = False
+
+        # Registered in the order of the forward pass, which
+        # `src.models.serving.fold_batchnorm` relies on
+        in_features = n_features
+        for i, size in enumerate(self.hidden_sizes, start=1):
+            setattr(self, f'layer_{i}', nn.Linear(in_features, size))
+            setattr(self, f'batchnorm{i}', nn.BatchNorm1d(size))
+            in_features = size
+        self.layer_out = nn.Linear(in_features, n_classes)
+
+        self.activation = ACTIVATIONS[activation]()
+        self.dropout = nn.Dropout(p=p_dropout)
+
+    def forward(self, x):
+        for i in range(1, len(self.hidden_sizes) + 1):
+            x = getattr(self, f'layer_{i}')(x)
+            x = getattr(self, f'batchnorm{i}')(x)
+            x = self.activation(x)
+            if i > 1:
+                x = self.dropout(x)
 
         x = self.layer_out(x)
 
         return x
 
+    def fuse(self) -> 'PytorchMLP':
+        """
+        Fold every BatchNorm layer into the Linear layer preceding it, in
+        place, and put the model in evaluation mode. The fused model gives
+        the same predictions in evaluation mode and can no longer be
+        trained.
+        :return: the model
+        """
+        from src.models.serving import fuse_linear_batchnorm
+
+        self.eval()
+        if not self.fused:
+            for i in range(1, len(self.hidden_sizes) + 1):
+                setattr(self, f'layer_{i}', fuse_linear_batchnorm(
+                    getattr(self, f'layer_{i}'),
+                    getattr(self, f'batchnorm{i}')))
+                setattr(self, f'batchnorm{i}', nn.Identity())
+            self.fused = True
+
+        return self
+
+    def config(self) -> dict:
+        return {'n_features': self.n_features,
+                'n_classes': self.n_classes,
+                'hidden_sizes': self.hidden_sizes,
+                'activation': self.activation_name,
+                'p_dropout': self.p_dropout}
+
+    def __setstate__(self, state):
+        # Models pickled before PytorchMLP existed only have the layers, and
+        # call their activation `relu`
+        super().__setstate__(state)
+        if 'hidden_sizes' in self.__dict__:
+            return
+        modules = self._modules
+        n_hidden = sum(1 for name in modules if name.startswith('layer_') and
+                       name != 'layer_out')
+        self.hidden_sizes = [modules[f'layer_{i}'].out_features
+                             for i in range(1, n_hidden + 1)]
+        self.n_features = modules['layer_1'].in_features
+        self.n_classes = modules['layer_out'].out_features
+        self.activation_name = 'relu'
+        self.p_dropout = modules['dropout'].p
+        self.fused = False
+
+        # Same registration order as a new model
+        relu = modules.pop('relu')
+        dropout = modules.pop('dropout')
+        modules['activation'] = relu
+        modules['dropout'] = dropout
+
+
+class PytorchClassification_2(PytorchMLP):
+    def __init__(self, n_features: int, n_classes: int, width: float = 1.0,
+                 p_dropout: float = 0.2):
+        super().__init__(n_features, n_classes,
+                         [_scale(n, width) for n in (256, 128)],
+                         p_dropout=p_dropout)
+
+
+class PytorchClassification_3(PytorchMLP):
+    def __init__(self, n_features: int, n_classes: int, width: float = 1.0,
+                 p_dropout: float = 0.2):
+        super().__init__(n_features, n_classes,
+                         [_scale(n, width) for n in (512, 128, 64)],
+                         p_dropout=p_dropout)
+
+
+class PytorchClassification_5(PytorchMLP):
+    def __init__(self, n_features: int, n_classes: int, width: float = 1.0,
+                 p_dropout: float = 0.2):
+        super().__init__(n_features, n_classes,
+                         [_scale(n, width) for n in (1024, 256, 128, 64)],
+                         p_dropout=p_dropout)
+
+
+class PytorchClassification_6(PytorchMLP):
+    def __init__(self, n_features: int, n_classes: int, width: float = 1.0,
+                 p_dropout: float = 0.2):
+        super().__init__(n_features, n_classes,
+                         [_scale(n, width) for n in (2048, 512, 256, 64)],
+                         p_dropout=p_dropout)
+
+
+class PytorchClassification_8(PytorchMLP):
+    def __init__(self, n_features: int, n_classes: int, width: float = 1.0,
+                 p_dropout: float = 0.2):
+        super().__init__(n_features, n_classes,
+                         [_scale(n, width)
+                          for n in (4096, 1024, 256, 128, 64)],
+                         p_dropout=p_dropout)
+
+
+def build_model(name: str, n_features: int, n_classes: int,
+                **params) -> PytorchMLP:
+    """
+    Build a model by class name, e.g. for a sweep.
+    :param name: 'PytorchMLP', with `hidden_sizes` and optionally
+    `activation` and `p_dropout`, or the name of one of the
+    PytorchClassification models, with optionally `width` and `p_dropout`
+    :param params: parameters of the model, the others are ignored
+    :return: the model
+    """
+    if name == 'PytorchMLP':
+        keys = ('hidden_sizes', 'activation', 'p_dropout')
+    else:
+        keys = ('width', 'p_dropout')
 
-class PytorchClassification_3(nn.Module):
-    def __init__(self, n_features: int, n_classes: int):
-        super().__init__()
-        self.layer_1 = nn.Linear(n_features, 512)
-        self.batchnorm1 = nn.BatchNorm1d(512)
-        self.layer_2 = nn.Linear(512, 128)
-        self.batchnorm2 = nn.BatchNorm1d(128)
-        self.layer_3 = nn.Linear(128, 64)
-        self.batchnorm3 = nn.BatchNorm1d(64)
-        self.layer_out = nn.Linear(64, n_classes)
+    return globals()[name](n_features, n_classes,
+                           **{key: params[key] for key in keys
+                              if key in params})
 
-        self.relu = nn.ReLU()
-        self.dropout = nn.Dropout(p=0.2)
 
+class PytorchDataset(Dataset):
+    """
+    Pytorch dataset
+    ...
 
-    def forward(self, x):
-        x = self.layer_1(x)
-        x = self.batchnorm1(x)
-        x = self.relu(x)
+    The features are kept as one contiguous float32 tensor and the target as
+    one int64 tensor, sharing the memory of the NumPy arrays when they
+    already have these types, so that batches can be sliced out of them by
+    `BatchLoader` without going through each observation.
 
-        x = self.layer_2(x)
-        x = self.batchnorm2(x)
-        x = self.relu(x)
-        x = self.dropout(x)
+    Attributes
+    ----------
+    X_tensor : Pytorch tensor
+        Features tensor, float32
+    y_tensor : Pytorch tensor
+        Target tensor, int64
 
-        x = self.layer_3(x)
-        x = self.batchnorm3(x)
-        x = self.relu(x)
-        x = self.dropout(x)
+    Methods
+    -------
+    __getitem__(index)
+        Return features and target for a given index, or tensor of indices
+    __len__
+        Return the number of observations
+    to_tensor(data, dtype)
+        Convert Pandas or NumPy data to a contiguous Pytorch tensor
+    """
 
-        x = self.layer_out(x)
+    def __init__(self, X, y):
+        self.X_tensor = self.to_tensor(X, np.float32)
+        self.y_tensor = self.to_tensor(y, np.int64)
 
-        return x
+    def __getitem__(self, index):
+        if isinstance(index, torch.Tensor) and index.dim() > 0:
+            return (self.X_tensor.index_select(0, index),
+                    self.y_tensor.index_select(0, index))
+        return self.X_tensor[index], self.y_tensor[index]
 
+    def __len__(self):
+        return len(self.X_tensor)
 
-class PytorchClassification_5(nn.Module):
-    def __init__(self, n_features: int, n_classes: int):
-        super().__init__()
-        self.layer_1 = nn.Linear(n_features, 1024)
-        self.batchnorm1 = nn.BatchNorm1d(1024)
-        self.layer_2 = nn.Linear(1024, 256)
-        self.batchnorm2 = nn.BatchNorm1d(256)
-        self.layer_3 = nn.Linear(256, 128)
-        self.batchnorm3 = nn.BatchNorm1d(128)
-        self.layer_4 = nn.Linear(128, 64)
-        self.batchnorm4 = nn.BatchNorm1d(64)
-        self.layer_out = nn.Linear(64, n_classes)
+    def to_tensor(self, data, dtype=np.float32):
+        if isinstance(data, torch.Tensor):
+            data = data.numpy()
+        array = np.ascontiguousarray(np.asarray(data, dtype=dtype))
+        # Tensors cannot share the memory of read-only arrays
+        if not array.flags.writeable:
+            array = array.copy()
 
-        self.relu = nn.ReLU()
-        self.dropout = nn.Dropout(p=0.2)
+        return torch.from_numpy(array)
 
 
-    def forward(self, x):
-        x = self.layer_1(x)
-        x = self.batchnorm1(x)
-        x = self.relu(x)
+class MemmapDataset(Dataset):
+    """
+    Pytorch dataset reading from memory-mapped arrays
+    ...
 
-        x = self.layer_2(x)
-        x = self.batchnorm2(x)
-        x = self.relu(x)
-        x = self.dropout(x)
+    Used for the sets saved as `.npy` files by `src.data.sets.save_arrays`
+    and opened with `load_sets(mmap=True)`, so that sets bigger than the
+    memory can be trained on. Only the rows of each batch are read from
+    disk; the indices of a shuffled batch are sorted first so the reads go
+    forward through the file.
 
-        x = self.layer_3(x)
-        x = self.batchnorm3(x)
-        x = self.relu(x)
-        x = self.dropout(x)
+    Attributes
+    ----------
+    X : np.ndarray
+        Features array, float32, usually a np.memmap
+    y : np.ndarray
+        Target array, int64, usually a np.memmap
 
-        x = self.layer_4(x)
-        x = self.batchnorm4(x)
-        x = self.relu(x)
-        x = self.dropout(x)
+    Methods
+    -------
+    __getitem__(index)
+        Return features and target for an index, slice or tensor of indices
+    __len__
+        Return the number of observations
+    """
 
-        x = self.layer_out(x)
+    def __init__(self, X: np.ndarray, y: np.ndarray):
+        if X.dtype != np.float32 or y.dtype != np.int64:
+            raise ValueError('the features must be float32 and the target '
+                             'int64, see src.data.sets.save_arrays')
+        self.X = X
+        self.y = y
 
-        return x
+    def __getitem__(self, index):
+        if isinstance(index, torch.Tensor):
+            index = np.sort(index.numpy())
+        # Copies the rows out of the read-only mapping
+        return (torch.from_numpy(np.array(self.X[index])),
+                torch.from_numpy(np.array(self.y[index])))
 
+    def __len__(self):
+        return len(self.X)
 
-class PytorchClassification_6(nn.Module):
-    def __init__(self, n_features: int, n_classes: int):
-        super().__init__()
-        self.layer_1 = nn.Linear(n_features, 2048)
-        self.batchnorm1 = nn.BatchNorm1d(2048)
-        self.layer_2 = nn.Linear(2048, 512)
-        self.batchnorm2 = nn.BatchNorm1d(512)
-        self.layer_3 = nn.Linear(512, 256)
-        self.batchnorm3 = nn.BatchNorm1d(256)
-        self.layer_4 = nn.Linear(256, 64)
-        self.batchnorm4 = nn.BatchNorm1d(64)
-        self.layer_out = nn.Linear(64, n_classes)
 
-        self.relu = nn.ReLU()
-        self.dropout = nn.Dropout(p=0.2)
+class BatchLoader:
+    """
+    Loader slicing the batches out of a PytorchDataset or a MemmapDataset
+    ...
 
+    Without shuffling the batches are slices of the dataset, views for a
+    PytorchDataset, with shuffling they are gathered with one indexing per
+    batch from a permutation drawn at the start of every epoch, so there is
+    no per-observation work or collation.
 
-    def forward(self, x):
-        x = self.layer_1(x)
-        x = self.batchnorm1(x)
-        x = self.relu(x)
+    Attributes
+    ----------
+    dataset : PytorchDataset or MemmapDataset
+        The dataset to iterate over
+    batch_size : int
+        Number of observations per batch
+    shuffle : bool
+        Whether to draw a new order of the observations every epoch
+    drop_last : bool
+        Whether to drop the last batch if it is smaller than `batch_size`
+    generator : torch.Generator
+        Random number generator of the permutations, for reproducibility;
+        it must be seeded the same in every process of a sharded loader
+    rank : int
+        Index of the shard of the dataset iterated over
+    world_size : int
+        Number of shards, e.g. of processes of a distributed training
+    even_shards : bool
+        Whether to drop the remainder of the dataset so that every shard
+        has the same number of rows, as the processes of a distributed
+        training must run the same number of backward passes; otherwise
+        the first shards get one row more and no row is dropped, e.g. to
+        evaluate the whole validation set
 
-        x = self.layer_2(x)
-        x = self.batchnorm2(x)
-        x = self.relu(x)
-        x = self.dropout(x)
+    Methods
+    -------
+    __iter__()
+        Yield the (features, target) batches of one epoch
+    __len__
+        Return the number of batches per epoch
+    """
 
-        x = self.layer_3(x)
-        x = self.batchnorm3(x)
-        x = self.relu(x)
-        x = self.dropout(x)
+    def __init__(self,
+                 dataset: Dataset,
+                 batch_size: int,
+                 shuffle: bool = False,
+                 drop_last: bool = False,
+                 generator: torch.Generator = None,
+                 rank: int = 0,
+                 world_size: int = 1,
+                 even_shards: bool = True):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+        self.rank = rank
+        self.world_size = world_size
+        self.even_shards = even_shards
+
+    @property
+    def n_shard_rows(self) -> int:
+        n_rows, remainder = divmod(len(self.dataset), self.world_size)
+        if self.even_shards:
+            return n_rows
+        return n_rows + (self.rank < remainder)
 
-        x = self.layer_4(x)
-        x = self.batchnorm4(x)
-        x = self.relu(x)
-        x = self.dropout(x)
+    def __len__(self):
+        if self.drop_last:
+            return self.n_shard_rows // self.batch_size
+        return -(-self.n_shard_rows // self.batch_size)
+
+    def __iter__(self):
+        n_rows = len(self) * self.batch_size if self.drop_last \
+            else self.n_shard_rows
+
+        if not self.shuffle:
+            n_rows_per_shard, remainder = divmod(len(self.dataset),
+                                                 self.world_size)
+            offset = self.rank * n_rows_per_shard
+            if not self.even_shards:
+                offset += min(self.rank, remainder)
+            for start in range(offset, offset + n_rows, self.batch_size):
+                yield self.dataset[start:min(start + self.batch_size,
+                                             offset + n_rows)]
+            return
+
+        # Every process draws the same permutation and takes its own share
+        order = torch.randperm(len(self.dataset), generator=self.generator)
+        order = order[self.rank::self.world_size][:n_rows]
+        for index in torch.split(order, self.batch_size):
+            yield self.dataset[index]
+
+
+def make_loader(data, batch_size, shuffle=False, generate_batch=None,
+                generator=None):
+    """
+    BatchLoader for a PytorchDataset or a MemmapDataset, DataLoader for any
+    other dataset or when a collate function is given.
+    """
+    if (isinstance(data, (PytorchDataset, MemmapDataset)) and
+            generate_batch is None):
+        return BatchLoader(data, batch_size=batch_size, shuffle=shuffle,
+                           generator=generator)
 
-        x = self.layer_out(x)
+    return DataLoader(data, batch_size=batch_size, shuffle=shuffle,
+                      collate_fn=generate_batch, generator=generator)
 
-        return x
 
+class TopKAccuracy:
+    """
+    Share of observations whose target is among the k most likely classes
 
-class PytorchClassification_8(nn.Module):
-    def __init__(self, n_features: int, n_classes: int):
-        super().__init__()
-        self.layer_1 = nn.Linear(n_features, 4096)
-        self.batchnorm1 = nn.BatchNorm1d(4096)
-        self.layer_2 = nn.Linear(4096, 1024)
-        self.batchnorm2 = nn.BatchNorm1d(1024)
-        self.layer_3 = nn.Linear(1024, 256)
-        self.batchnorm3 = nn.BatchNorm1d(256)
-        self.layer_4 = nn.Linear(256, 128)
-        self.batchnorm4 = nn.BatchNorm1d(128)
-        self.layer_5 = nn.Linear(128, 64)
-        self.batchnorm5 = nn.BatchNorm1d(64)
-        self.layer_out = nn.Linear(64, n_classes)
-
-        self.relu = nn.ReLU()
-        self.dropout = nn.Dropout(p=0.2)
+    Attributes
+    ----------
+    k : int
+        Number of classes considered
+    name : str
+        Name of the metric in the results, e.g. 'top_3_accuracy'
+    """
 
+    def __init__(self, k: int = 3):
+        self.k = k
+        self.name = f'top_{k}_accuracy'
 
-    def forward(self, x):
-        x = self.layer_1(x)
-        x = self.batchnorm1(x)
-        x = self.relu(x)
-
-        x = self.layer_2(x)
-        x = self.batchnorm2(x)
-        x = self.relu(x)
-        x = self.dropout(x)
-
-        x = self.layer_3(x)
-        x = self.batchnorm3(x)
-        x = self.relu(x)
-        x = self.dropout(x)
-
-        x = self.layer_4(x)
-        x = self.batchnorm4(x)
-        x = self.relu(x)
-        x = self.dropout(x)
-
-        x = self.layer_5(x)
-        x = self.batchnorm5(x)
-        x = self.relu(x)
-        x = self.dropout(x)
+    def reset(self, device):
+        self.correct = torch.zeros((), dtype=torch.long, device=device)
 
-        x = self.layer_out(x)
+    def update(self, output, target):
+        top_k = output.topk(min(self.k, output.shape[1]), dim=1).indices
+        self.correct += (top_k == target.unsqueeze(1)).sum()
 
-        return x
-    
+    def all_reduce(self):
+        torch.distributed.all_reduce(self.correct)
 
-class PytorchDataset(Dataset):
+    def compute(self, accumulator) -> float:
+        return self.correct.item() / max(accumulator.n_observations, 1)
+
+
+class MacroF1:
     """
-    Pytorch dataset
-    ...
+    Unweighted mean of the F1 score of each class, computed from the
+    confusion matrix. Classes absent from both the targets and the
+    predictions are left out of the mean.
 
     Attributes
     ----------
-    X_tensor : Pytorch tensor
-        Features tensofr
-    y_tensor : Pytorch tensor
-        Target tensor
+    name : str
+        Name of the metric in the results, 'macro_f1'
+    """
 
-    Methods
-    -------
-    __getitem__(index)
-        Return features and target for a given index
-    __len__
-        Return the number of observations
-    to_tensor(data)
-        Convert Pandas Series to Pytorch tensor
+    name = 'macro_f1'
+
+    def reset(self, device):
+        pass
+
+    def update(self, output, target):
+        pass
+
+    def compute(self, accumulator) -> float:
+        confusion = accumulator.confusion.double()
+        true_positives = confusion.diagonal()
+        support = confusion.sum(1)
+        predicted = confusion.sum(0)
+        present = (support + predicted) > 0
+        f1 = 2 * true_positives / (support + predicted).clamp(min=1)
+
+        return f1[present].mean().item() if present.any() else 0.0
+
+
+class MetricsAccumulator:
     """
+    Running metrics of an epoch kept as tensors on the device
+    ...
 
-    def __init__(self, X, y):
-        self.X_tensor = self.to_tensor(X)
-        self.y_tensor = self.to_tensor(y)
+    The loss, the number of correct predictions and the confusion matrix
+    are summed on the device without synchronising with the host, and are
+    only read back by `compute`, once per epoch. Extra metrics, e.g.
+    TopKAccuracy or MacroF1, are updated with every batch and computed at
+    the end.
 
-    def __getitem__(self, index):
-        return self.X_tensor[index], self.y_tensor[index]
+    Attributes
+    ----------
+    n_classes : int
+        Number of classes, inferred from the first batch if None
+    metrics : list
+        Extra metrics, with `reset(device)`, `update(output, target)` and
+        `compute(accumulator)` methods and a `name`
+    loss_sum : torch.Tensor
+        Sum of the loss over the observations
+    confusion : torch.Tensor
+        Confusion matrix, targets in rows and predictions in columns
+    n_observations : int
+        Number of observations seen since the last reset
 
-    def __len__(self):
-        return len(self.X_tensor)
+    Methods
+    -------
+    reset()
+        Zero the running metrics
+    update(output, target, loss)
+        Add a batch
+    compute()
+        Return the metrics as a dictionary of floats
+    all_reduce()
+        Sum the running metrics of all the processes of a distributed run
+    """
 
-    def to_tensor(self, data):
-        return torch.Tensor(np.array(data))
+    def __init__(self, n_classes: int = None, metrics=()):
+        self.n_classes = n_classes
+        self.metrics = list(metrics)
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = None
+        self.confusion = None
+        self.n_observations = 0
+
+    def _start(self, device, n_classes):
+        self.n_classes = self.n_classes or n_classes
+        self.loss_sum = torch.zeros((), device=device)
+        self.confusion = torch.zeros(self.n_classes, self.n_classes,
+                                     dtype=torch.long, device=device)
+        for metric in self.metrics:
+            metric.reset(device)
+
+    def update(self, output, target, loss=None):
+        """
+        :param output: the output of the model for the batch
+        :param target: the int64 targets of the batch
+        :param loss: the mean loss of the batch
+        """
+        output = output.detach()
+        if self.confusion is None:
+            self._start(output.device, output.shape[1])
+
+        if loss is not None:
+            self.loss_sum += loss.detach() * len(target)
+        self.confusion.view(-1).add_(torch.bincount(
+            target * self.n_classes + output.argmax(1),
+            minlength=self.n_classes * self.n_classes))
+        self.n_observations += len(target)
+        for metric in self.metrics:
+            metric.update(output, target)
+
+    def all_reduce(self):
+        """
+        Sum the running metrics over the processes of the default process
+        group, so that `compute` returns the metrics of the whole dataset.
+        Extra metrics holding their own counters must have an `all_reduce`
+        method too.
+        """
+        import torch.distributed as dist
+
+        n_observations = torch.tensor(self.n_observations,
+                                      device=self.confusion.device)
+        for tensor in (self.loss_sum, self.confusion, n_observations):
+            dist.all_reduce(tensor)
+        self.n_observations = int(n_observations.item())
+        for metric in self.metrics:
+            if hasattr(metric, 'all_reduce'):
+                metric.all_reduce()
+
+    @property
+    def correct(self) -> torch.Tensor:
+        return self.confusion.diagonal().sum()
+
+    def compute(self) -> dict:
+        """
+        :return: the mean loss, the accuracy and the extra metrics
+        """
+        if self.confusion is None:
+            return {}
+        n_observations = max(self.n_observations, 1)
+        results = {'loss': self.loss_sum.item() / n_observations,
+                   'accuracy': self.correct.item() / n_observations}
+        for metric in self.metrics:
+            results[metric.name] = metric.compute(self)
+
+        return results
 
 
 def train_classification(train_data,
@@ -251,7 +626,9 @@ def train_classification(train_data,
                          batch_size,
                          device,
                          scheduler=None,
-                         generate_batch=None):
+                         generate_batch=None,
+                         accumulator=None,
+                         bf16=False):
     """Train a Pytorch binary classification model
 
     Parameters
@@ -272,6 +649,11 @@ def train_classification(train_data,
         Pytorch Scheduler used for updating learning rate
     collate_fn : function
         Function defining required pre-processing steps
+    accumulator : MetricsAccumulator
+        Accumulator of the metrics of the epoch, reset first, e.g. with
+        extra metrics to read with `accumulator.compute()` afterwards
+    bf16 : bool
+        Whether to run the forward pass under bfloat16 autocast
 
     Returns
     -------
@@ -281,50 +663,23 @@ def train_classification(train_data,
         Accuracy Score
     """
 
-    # Set model to training mode
-    model.train()
-    train_loss = 0
-    train_acc = 0
-
     # Create data loader
-    data = DataLoader(train_data, batch_size=batch_size, shuffle=True,
-                      collate_fn=generate_batch)
-
-    # Iterate through data by batch of observations
-    for i, (feature, target_class) in enumerate(data):
-        # Reset gradients
-        optimizer.zero_grad()
-
-        # Load data to specified device target_class
-        feature, target_class = feature.to(device), target_class.to(device).to(torch.long)
-
-        # Make predictions
-        output = model(feature)
-
-        # Calculate loss for given batch
-        loss = criterion(output, target_class)
-
-        # Calculate global loss
-        train_loss += loss.item()
-
-        # Calculate gradients
-        loss.backward()
-
-        # Update Weights
-        optimizer.step()
-
-        # Calculate global accuracy
-        train_acc += (output.argmax(1) == target_class).sum().item()
+    data = make_loader(train_data, batch_size, shuffle=True,
+                       generate_batch=generate_batch)
+    accumulator = accumulator or MetricsAccumulator()
+    train_loss = _train_epoch(data, model, criterion, optimizer, device,
+                              accumulator, bf16)
 
     # Adjust the learning rate
     if scheduler:
         scheduler.step()
 
-    return train_loss / len(train_data), train_acc / len(train_data)
+    return (train_loss.item() / len(train_data),
+            _correct(accumulator) / len(train_data))
 
 
 def test_classification(test_data, model, criterion, batch_size, device,
-                generate_batch=None):
+                generate_batch=None, accumulator=None, bf16=False):
     """Calculate performance of a Pytorch binary classification model
 
     Parameters
@@ -341,6 +696,11 @@ def test_classification(test_data, model, criterion, batch_size, device,
         Name of the device used for the model
     collate_fn : function
         Function defining required pre-processing steps
+    accumulator : MetricsAccumulator
+        Accumulator of the metrics of the epoch, reset first, e.g. with
+        extra metrics to read with `accumulator.compute()` afterwards
+    bf16 : bool
+        Whether to run the forward pass under bfloat16 autocast
 
     Returns
     -------
@@ -350,23 +710,87 @@ def test_classification(test_data, model, criterion, batch_size, device,
         Accuracy Score
     """
 
+    # Create data loader
+    data = make_loader(test_data, batch_size, generate_batch=generate_batch)
+    accumulator = accumulator or MetricsAccumulator()
+    test_loss = _test_epoch(data, model, criterion, device, accumulator,
+                            bf16)
+
+    return (test_loss.item() / len(test_data),
+            _correct(accumulator) / len(test_data))
+
+
+def _train_epoch(data, model, criterion, optimizer, device,
+                 accumulator: MetricsAccumulator,
+                 bf16: bool = False) -> torch.Tensor:
+    """
+    Train the model for one pass over the loader and return the sum of the
+    batch losses, as a tensor on the device.
+    """
+    # Set model to training mode
+    model.train()
+    # The metrics stay on the device until the end of the epoch
+    train_loss = torch.zeros((), device=device)
+    accumulator.reset()
+
+    # Iterate through data by batch of observations
+    for feature, target_class in data:
+        # Reset gradients
+        optimizer.zero_grad()
+
+        # Load data to specified device, the BatchLoader target is already
+        # int64 but a DataLoader may yield any dtype
+        feature = feature.to(device, non_blocking=True)
+        target_class = target_class.to(device, non_blocking=True)
+        if target_class.dtype != torch.long:
+            target_class = target_class.to(torch.long)
+
+        with autocast_bf16(device, bf16):
+            # Make predictions
+            output = model(feature)
+
+            # Calculate loss for given batch
+            loss = criterion(output, target_class)
+
+        # Calculate global loss
+        train_loss += loss.detach()
+
+        # Calculate gradients
+        loss.backward()
+
+        # Update Weights
+        optimizer.step()
+
+        # Calculate global accuracy
+        accumulator.update(output, target_class, loss)
+
+    return train_loss
+
+
+def _test_epoch(data, model, criterion, device,
+                accumulator: MetricsAccumulator,
+                bf16: bool = False) -> torch.Tensor:
+    """
+    Evaluate the model on one pass over the loader and return the sum of
+    the batch losses, as a tensor on the device.
+    """
     # Set model to evaluation mode
     model.eval()
-    test_loss = 0
-    test_acc = 0
-
-    # Create data loader
-    data = DataLoader(test_data, batch_size=batch_size,
-                      collate_fn=generate_batch)
+    # The metrics stay on the device until the end of the epoch
+    test_loss = torch.zeros((), device=device)
+    accumulator.reset()
 
     # Iterate through data by batch of observations
     for feature, target_class in data:
-        # Load data to specified device
-        feature, target_class = feature.to(device), target_class.to(device).to(
-            torch.long)
+        # Load data to specified device, the BatchLoader target is already
+        # int64 but a DataLoader may yield any dtype
+        feature = feature.to(device, non_blocking=True)
+        target_class = target_class.to(device, non_blocking=True)
+        if target_class.dtype != torch.long:
+            target_class = target_class.to(torch.long)
 
         # Set no update to gradients
-        with torch.no_grad():
+        with torch.no_grad(), autocast_bf16(device, bf16):
             # Make predictions
             output = model(feature)
 
@@ -374,9 +798,301 @@ def test_classification(test_data, model, criterion, batch_size, device,
             loss = criterion(output, target_class)
 
             # Calculate global loss
-            test_loss += loss.item()
+            test_loss += loss
 
             # Calculate global accuracy
-            test_acc += (output.argmax(1) == target_class).sum().item()
+            accumulator.update(output, target_class, loss)
+
+    return test_loss
+
+
+def _correct(accumulator: MetricsAccumulator) -> int:
+    return (accumulator.correct.item()
+            if accumulator.confusion is not None else 0)
+
+
+def load_pickled(path, map_location='cpu'):
+    """
+    Load a file saved with `torch.save`, e.g. a checkpoint or a whole
+    `.torch` model. They hold pickled modules, NumPy and Python states,
+    which the weights only loading of PyTorch 2.6 and later rejects; older
+    versions have no option.
+    :param path: path to the file
+    :param map_location: where to load the tensors
+    :return: the loaded object
+    """
+    try:
+        return torch.load(path, map_location=map_location, weights_only=False)
+    except TypeError:
+        return torch.load(path, map_location=map_location)
+
+
+class Trainer:
+    """
+    Epoch loop of a Pytorch classification model
+    ...
+
+    Owns the loaders, created once, the optimizer and the scheduler, and
+    runs the epochs with `train_classification`'s and `test_classification`'s
+    loops. It stops early when the validation loss has not improved for
+    `patience` epochs, restores the weights of the epoch with the lowest
+    validation loss at the end of `fit`, and it can save a
+    checkpoint of the model, the optimizer, the scheduler, the history and
+    the random number generators every few epochs to resume an interrupted
+    run exactly where it stopped.
+
+    Attributes
+    ----------
+    model : torch.nn.Module
+        Pytorch Model
+    history : list
+        Metrics, wall time and samples per second of each epoch
+    epoch : int
+        Number of epochs completed
+    best_loss : float
+        Lowest validation loss so far
+    stopped : bool
+        Whether the training stopped early
+
+    Methods
+    -------
+    fit(n_epochs)
+        Train until `n_epochs` epochs are completed or it stops early
+    save_checkpoint(path)
+        Save the state of the training
+    resume(path)
+        Restore the state of the training saved by `save_checkpoint`
+    """
 
-    return test_loss / len(test_data), test_acc / len(test_data)
+    def __init__(self,
+                 model: nn.Module,
+                 criterion,
+                 optimizer: torch.optim.Optimizer,
+                 train_data: Dataset,
+                 val_data: Dataset = None,
+                 batch_size: int = 1024,
+                 device=None,
+                 scheduler=None,
+                 metrics=(),
+                 patience: int = None,
+                 min_delta: float = 0.0,
+                 checkpoint_path: Path = None,
+                 checkpoint_every: int = 1,
+                 seed: int = None,
+                 generate_batch=None,
+                 bf16: bool = False):
+        """
+        :param model: Pytorch Model, already on `device`
+        :param criterion: Loss function
+        :param optimizer: Optimizer of the parameters of `model`
+        :param train_data: Pytorch dataset to train on
+        :param val_data: Pytorch dataset for the validation metrics and the
+        early stopping
+        :param batch_size: Number of observations per batch
+        :param device: device of the model (default: `get_device()`)
+        :param scheduler: scheduler stepped after every epoch
+        :param metrics: extra metrics of the validation set, e.g.
+        `[MacroF1()]`
+        :param patience: number of epochs without improvement of the
+        validation loss before stopping, None to never stop early
+        :param min_delta: minimum decrease of the validation loss counted as
+        an improvement
+        :param checkpoint_path: where to save the checkpoints, None for no
+        checkpoints
+        :param checkpoint_every: number of epochs between two checkpoints
+        :param seed: seed of the shuffling of the training set
+        :param generate_batch: collate function, see `make_loader`
+        :param bf16: whether to run the forward passes under bfloat16
+        autocast
+        """
+        self.model = model
+        # The model whose weights are checkpointed, e.g. the one wrapped by
+        # DistributedDataParallel in a subclass
+        self.module = model
+        self.criterion = criterion
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.train_data = train_data
+        self.val_data = val_data
+        self.device = device or get_device()
+        self.patience = patience
+        self.min_delta = min_delta
+        self.checkpoint_path = (Path(checkpoint_path)
+                                if checkpoint_path is not None else None)
+        self.checkpoint_every = checkpoint_every
+        self.bf16 = bf16
+
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        self.train_loader = make_loader(train_data, batch_size, shuffle=True,
+                                        generate_batch=generate_batch,
+                                        generator=self.generator)
+        self.val_loader = (make_loader(val_data, batch_size,
+                                       generate_batch=generate_batch)
+                           if val_data is not None else None)
+        self.train_accumulator = MetricsAccumulator()
+        self.val_accumulator = MetricsAccumulator(metrics=metrics)
+
+        self.history = []
+        self.epoch = 0
+        self.best_loss = float('inf')
+        self.best_state = None
+        self.bad_epochs = 0
+        self.stopped = False
+
+    def _compute(self, accumulator: MetricsAccumulator) -> dict:
+        return accumulator.compute()
+
+    def _run_epoch(self) -> dict:
+        start = time.perf_counter()
+        _train_epoch(self.train_loader, self.model, self.criterion,
+                     self.optimizer, self.device, self.train_accumulator,
+                     self.bf16)
+        record = {'epoch': self.epoch,
+                  'lr': self.optimizer.param_groups[0]['lr']}
+        record.update({f'train_{name}': value for name, value
+                       in self._compute(self.train_accumulator).items()})
+        train_seconds = time.perf_counter() - start
+
+        if self.scheduler:
+            self.scheduler.step()
+
+        if self.val_loader is not None:
+            # On the model itself rather than the DistributedDataParallel
+            # wrapper, whose forward passes sync the processes: the replicas
+            # are identical, and the shards of the validation set may have
+            # different numbers of batches
+            _test_epoch(self.val_loader, self.module, self.criterion,
+                        self.device, self.val_accumulator, self.bf16)
+            record.update({f'val_{name}': value for name, value
+                           in self._compute(self.val_accumulator).items()})
+
+        record['seconds'] = time.perf_counter() - start
+        record['samples_per_sec'] = len(self.train_data) / train_seconds
+
+        return record
+
+    def _early_stopping(self, val_loss: float) -> bool:
+        if val_loss < self.best_loss - self.min_delta:
+            self.best_loss = val_loss
+            self.best_state = {key: value.detach().clone() for key, value
+                               in self.module.state_dict().items()}
+            self.bad_epochs = 0
+        else:
+            self.bad_epochs += 1
+
+        return (self.patience is not None and
+                self.bad_epochs >= self.patience)
+
+    def fit(self, n_epochs: int, callbacks=()) -> pd.DataFrame:
+        """
+        Train the model until `n_epochs` epochs are completed in total,
+        counting the epochs of a resumed run, or until it stops early.
+        :param n_epochs: total number of epochs
+        :param callbacks: functions called as `callback(trainer, record)`
+        after every epoch, returning True to stop the training, e.g. to
+        prune a trial of a sweep
+        :return: dataframe of the history, one row per epoch
+        """
+        while self.epoch < n_epochs and not self.stopped:
+            record = self._run_epoch()
+            self.history.append(record)
+            self.epoch += 1
+
+            message = (f'epoch {record["epoch"]}: '
+                       f'train loss {record["train_loss"]:.4f}, '
+                       f'acc {record["train_accuracy"]:.3f}')
+            if 'val_loss' in record:
+                message += (f' | val loss {record["val_loss"]:.4f}, '
+                            f'acc {record["val_accuracy"]:.3f}')
+                self.stopped = self._early_stopping(record['val_loss'])
+            logger.info(f'{message} | {record["seconds"]:.1f}s, '
+                        f'{record["samples_per_sec"]:.0f} samples/s')
+            for callback in callbacks:
+                if callback(self, record):
+                    self.stopped = True
+
+            if (self.checkpoint_path is not None and
+                    (self.epoch % self.checkpoint_every == 0 or
+                     self.stopped or self.epoch == n_epochs)):
+                self.save_checkpoint(self.checkpoint_path)
+
+        if self.stopped:
+            logger.info(f'stopped early after {self.epoch} epochs, best '
+                        f'validation loss {self.best_loss:.4f}')
+        if self.best_state is not None:
+            self.module.load_state_dict(self.best_state)
+
+        return pd.DataFrame(self.history)
+
+    def state_dict(self) -> dict:
+        return {
+            'model': self.module.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': (self.scheduler.state_dict()
+                          if self.scheduler is not None else None),
+            'epoch': self.epoch,
+            'history': self.history,
+            'best_loss': self.best_loss,
+            'best_state': self.best_state,
+            'bad_epochs': self.bad_epochs,
+            'stopped': self.stopped,
+            'rng': {
+                'generator': self.generator.get_state(),
+                'torch': torch.get_rng_state(),
+                'cuda': (torch.cuda.get_rng_state_all()
+                         if torch.cuda.is_available() else None),
+                'numpy': np.random.get_state(),
+                'python': random.getstate()
+            }
+        }
+
+    def load_state_dict(self, state: dict):
+        self.module.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        if self.scheduler is not None and state['scheduler'] is not None:
+            self.scheduler.load_state_dict(state['scheduler'])
+        self.epoch = state['epoch']
+        self.history = state['history']
+        self.best_loss = state['best_loss']
+        self.best_state = state['best_state']
+        self.bad_epochs = state['bad_epochs']
+        self.stopped = state['stopped']
+
+        # The RNG states must be CPU ByteTensors, whatever the checkpoint was
+        # mapped to
+        rng = state['rng']
+        self.generator.set_state(rng['generator'].cpu())
+        torch.set_rng_state(rng['torch'].cpu())
+        if rng['cuda'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all([s.cpu() for s in rng['cuda']])
+        np.random.set_state(rng['numpy'])
+        random.setstate(rng['python'])
+
+    def save_checkpoint(self, path: Path):
+        """
+        Save the state of the training, through a temporary file so that an
+        interruption never leaves a truncated checkpoint.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        torch.save(self.state_dict(), tmp_path)
+        os.replace(tmp_path, path)
+
+    def resume(self, path: Path = None) -> bool:
+        """
+        Restore the state saved by `save_checkpoint`, if it exists.
+        :param path: the checkpoint (default: `checkpoint_path`)
+        :return: whether a checkpoint was loaded
+        """
+        path = Path(path or self.checkpoint_path)
+        if not path.exists():
+            return False
+        # Loaded on the CPU: the model and the optimizer move their tensors
+        # to the device of the parameters, and the RNG states must stay there
+        self.load_state_dict(load_pickled(path, 'cpu'))
+        logger.info(f'resumed from {path} after {self.epoch} epochs')
+
+        return True
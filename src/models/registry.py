@@ -0,0 +1,250 @@
+import hashlib
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Any, NamedTuple, Optional, Tuple
+
+from joblib import load
+
+from src.models.lookup import LookupTable, METADATA_FILE, classes_digest
+from src.models.lookup import file_digest
+from src.models.pipes import compile_preprocessing_pipe
+from src.models.pytorch import load_pickled
+from src.models.serving import ServingModel, load_torchscript
+
+logger = logging.getLogger(__name__)
+
+
+class Artifacts(NamedTuple):
+    """
+    An immutable snapshot of everything needed to serve a prediction. The
+    handlers always read the model, pipe and label encoder from the same
+    snapshot, so a reload can never mix artifacts from two versions.
+    """
+    model: Any
+    pipe: Any
+    compiled_pipe: Any
+    label_encoder: Any
+    lookup_table: Any
+    version: str
+    architecture: str
+
+
+def load_model(path: Path, bf16: bool = False) -> Tuple[ServingModel, str]:
+    """
+    Load a serialised PyTorch model onto the CPU and freeze it for serving,
+    so that a prediction does not depend on the other rows of its batch.
+    :param path: path to the `.pt` TorchScript model created by
+    `export_torchscript` or to the `.torch` PyTorch model
+    :param bf16: whether to run the model under bfloat16 autocast
+    :return: the model and the description of its architecture
+    """
+    if path.suffix == '.pt':
+        model, architecture = load_torchscript(path)
+    else:
+        model = load_pickled(path)
+        architecture = str(model)
+
+    return ServingModel(model, bf16=bf16), architecture
+
+
+class ArtifactRegistry:
+    """
+    In-process registry of the serving artifacts
+    ...
+
+    The model, preprocessing pipe and label encoder are loaded once, either
+    eagerly with `load()` (e.g. at app startup) or lazily on the first call
+    to `get()`. Afterwards `get()` checks the files in `models_dir` at most
+    once every `check_interval` seconds and, if any of them changed,
+    loads a complete new set of artifacts and swaps it in with a single
+    reference assignment. Requests that are in flight keep using the
+    snapshot they already hold.
+
+    A new model is best rolled out by writing the files under a temporary
+    name and renaming them into place. If loading fails, e.g. because a
+    file is only half copied, the current artifacts are kept and the load
+    is retried at the next check.
+
+    Attributes
+    ----------
+    models_dir : Path
+        Directory holding the artifacts
+    model_name : str
+        File name of the TorchScript (`.pt`) or PyTorch (`.torch`) model
+    pipe_name : str
+        File name of the preprocessing pipe
+    label_encoder_name : str
+        File name of the label encoder
+    check_interval : float
+        Minimum number of seconds between two checks for changed files. A
+        negative value disables hot reloading.
+    lookup_dir : Path
+        Directory of the lookup table built from the model and the pipe by
+        `build_lookup_table`, None to serve from the model only. A table
+        built from another model or pipe, or with other classes than the
+        label encoder, is ignored.
+    bf16 : bool
+        Whether to run the model under bfloat16 autocast
+
+    Methods
+    -------
+    get()
+        Return the current artifacts, loading or reloading them if required
+    load()
+        Load the artifacts from disk and swap them in
+    reload_if_changed()
+        Reload the artifacts if any of the files changed on disk
+    """
+
+    def __init__(self,
+                 models_dir: Path = Path('../models'),
+                 model_name: str = 'model.pt',
+                 pipe_name: str = 'pipe.sav',
+                 label_encoder_name: str = 'label_encoder.sav',
+                 check_interval: float = 5.0,
+                 lookup_dir: Optional[Path] = None,
+                 bf16: bool = False):
+        self.models_dir = Path(models_dir)
+        self.model_name = model_name
+        self.pipe_name = pipe_name
+        self.label_encoder_name = label_encoder_name
+        self.check_interval = check_interval
+        self.lookup_dir = None if lookup_dir is None else Path(lookup_dir)
+        self.bf16 = bf16
+
+        self._artifacts = None
+        self._signature = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def paths(self) -> Tuple[Path, Path, Path]:
+        return (self.models_dir / self.model_name,
+                self.models_dir / self.pipe_name,
+                self.models_dir / self.label_encoder_name)
+
+    def _stat(self) -> Tuple:
+        paths = list(self.paths)
+        if (self.lookup_dir is not None and
+                (self.lookup_dir / METADATA_FILE).exists()):
+            paths.append(self.lookup_dir / METADATA_FILE)
+
+        signature = []
+        for path in paths:
+            stat = path.stat()
+            signature.append((str(path), stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def _load_lookup_table(self, classes) -> Optional[LookupTable]:
+        if (self.lookup_dir is None or
+                not (self.lookup_dir / METADATA_FILE).exists()):
+            return None
+
+        model_path, pipe_path, _ = self.paths
+        table = LookupTable.load(self.lookup_dir)
+        if (table.metadata.get('model_digest') != file_digest(model_path) or
+                table.metadata.get('pipe_digest') != file_digest(pipe_path)):
+            logger.warning('the lookup table in %s was built from other '
+                           'artifacts, ignoring it', self.lookup_dir)
+            return None
+        # The table holds indices into the classes, which would be decoded
+        # into the wrong styles by another label encoder
+        if table.metadata.get('classes_digest') != classes_digest(classes):
+            logger.warning('the lookup table in %s was built with other '
+                           'classes than the label encoder, ignoring it',
+                           self.lookup_dir)
+            return None
+
+        return table
+
+    def _load(self, signature: Tuple) -> Artifacts:
+        model_path, pipe_path, label_encoder_path = self.paths
+        model, architecture = load_model(model_path, bf16=self.bf16)
+        pipe = load(pipe_path)
+        le = load(label_encoder_path)
+        version = hashlib.sha1(repr(signature).encode()).hexdigest()[:12]
+
+        try:
+            compiled_pipe = compile_preprocessing_pipe(pipe)
+        except (TypeError, ValueError):
+            logger.warning('could not compile %s, falling back to '
+                           'pipe.transform', pipe_path, exc_info=True)
+            compiled_pipe = None
+
+        return Artifacts(model=model,
+                         pipe=pipe,
+                         compiled_pipe=compiled_pipe,
+                         label_encoder=le,
+                         lookup_table=self._load_lookup_table(le.classes_),
+                         version=version,
+                         architecture=architecture)
+
+    def _swap(self, signature: Tuple) -> Artifacts:
+        # Must be called with the lock held
+        artifacts = self._load(signature)
+        self._artifacts = artifacts
+        self._signature = signature
+        self._last_check = time.monotonic()
+        logger.info('loaded artifacts version %s', artifacts.version)
+
+        return artifacts
+
+    def load(self) -> Artifacts:
+        """
+        Load the artifacts from disk and atomically replace the current ones.
+        :return: the newly loaded artifacts
+        """
+        with self._lock:
+            return self._swap(self._stat())
+
+    def reload_if_changed(self) -> bool:
+        """
+        Reload the artifacts if any of the files changed since the last load.
+        Failures are logged and the current artifacts are kept. If another
+        thread is already checking, this returns immediately instead of
+        queueing behind it.
+        :return: whether a new set of artifacts was swapped in
+        """
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self._last_check = time.monotonic()
+            signature = self._stat()
+            if signature == self._signature:
+                return False
+            self._swap(signature)
+        except Exception:
+            logger.exception('failed to reload artifacts, keeping '
+                             'version %s', self.version)
+            return False
+        finally:
+            self._lock.release()
+
+        return True
+
+    def get(self) -> Artifacts:
+        """
+        Return the current artifacts. Loads them on first use and checks for
+        changed files once the check interval has elapsed.
+        :return: the current artifacts
+        """
+        artifacts = self._artifacts
+        if artifacts is None:
+            with self._lock:
+                if self._artifacts is None:
+                    self._swap(self._stat())
+                return self._artifacts
+
+        if (self.check_interval >= 0 and
+                time.monotonic() - self._last_check >= self.check_interval):
+            self.reload_if_changed()
+            artifacts = self._artifacts
+
+        return artifacts
+
+    @property
+    def version(self) -> Optional[str]:
+        artifacts = self._artifacts
+        return None if artifacts is None else artifacts.version
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+import copy
+import io
+import logging
+import time
+from pathlib import Path
+from typing import Dict, Tuple
+
+import click
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+
+from src.models.pytorch import autocast_bf16, load_pickled
+
+logger = logging.getLogger(__name__)
+
+# `torch.inference_mode` is only available from PyTorch 1.9
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+ARCHITECTURE_FILE = 'architecture.txt'
+
+
+def fuse_linear_batchnorm(linear: nn.Linear,
+                          batchnorm: nn.BatchNorm1d) -> nn.Linear:
+    """
+    Fold an evaluation mode BatchNorm1d into the Linear layer preceding it.
+    :param linear: the Linear layer
+    :param batchnorm: the BatchNorm1d layer applied to the output of `linear`
+    :return: a new Linear layer computing batchnorm(linear(x))
+    """
+    with torch.no_grad():
+        std = torch.sqrt(batchnorm.running_var + batchnorm.eps)
+        gamma = (batchnorm.weight if batchnorm.affine
+                 else torch.ones_like(std))
+        beta = (batchnorm.bias if batchnorm.affine
+                else torch.zeros_like(std))
+        factor = gamma / std
+        bias = (linear.bias if linear.bias is not None
+                else torch.zeros_like(std))
+
+        fused = nn.Linear(linear.in_features, linear.out_features)
+        fused.weight.copy_(linear.weight * factor.unsqueeze(1))
+        fused.bias.copy_((bias - batchnorm.running_mean) * factor + beta)
+
+    return fused
+
+
+def fold_batchnorm(model: nn.Module) -> nn.Module:
+    """
+    Return an evaluation mode copy of the model where every BatchNorm1d that
+    directly follows a Linear layer is folded into it and replaced by an
+    Identity. Layers are paired in the order they are registered, which is
+    the order of the forward pass for the PytorchClassification models.
+    :param model: a PyTorch model
+    :return: the folded copy
+    """
+    model = copy.deepcopy(model).eval()
+    parents = {name: module for name, module in model.named_modules()}
+
+    previous = None
+    for name, module in list(model.named_modules()):
+        if len(list(module.children())) > 0:
+            continue
+        if (isinstance(module, nn.BatchNorm1d) and
+                isinstance(previous, tuple) and
+                module.track_running_stats and
+                previous[1].out_features == module.num_features):
+            linear_name, linear = previous
+            _set_module(parents, linear_name,
+                        fuse_linear_batchnorm(linear, module))
+            _set_module(parents, name, nn.Identity())
+        previous = ((name, module) if isinstance(module, nn.Linear)
+                    else None)
+
+    return model
+
+
+def _set_module(parents: dict, name: str, module: nn.Module):
+    parent_name, _, child_name = name.rpartition('.')
+    setattr(parents[parent_name], child_name, module)
+
+
+def get_n_features(model: nn.Module) -> int:
+    """
+    Number of input features of a model, i.e. of its first Linear layer.
+    """
+    for module in model.modules():
+        if isinstance(module, nn.Linear):
+            return module.in_features
+    raise ValueError('the model has no Linear layer')
+
+
+class ServingModel(nn.Module):
+    """
+    Wrapper freezing a model for serving
+    ...
+
+    The wrapped model is put in evaluation mode, so that Dropout is disabled
+    and BatchNorm uses its running statistics, and every call runs under
+    `torch.inference_mode`, so that no autograd graph is recorded. Calling
+    `train()` on the wrapper does not take the model out of evaluation mode.
+    With `bf16`, the forward pass runs under bfloat16 autocast and the
+    output is cast back to float32.
+
+    Attributes
+    ----------
+    model : torch.nn.Module
+        The wrapped model, eager or TorchScript
+    bf16 : bool
+        Whether to run the model under bfloat16 autocast
+
+    Methods
+    -------
+    forward(x)
+        Return the output of the model
+    """
+
+    def __init__(self, model: nn.Module, bf16: bool = False):
+        super().__init__()
+        self.model = model.eval()
+        self.bf16 = bf16
+        for param in self.model.parameters():
+            param.requires_grad_(False)
+
+    def train(self, mode: bool = True):
+        return self
+
+    def forward(self, x):
+        with inference_mode(), autocast_bf16(x.device, self.bf16):
+            output = self.model(x)
+
+        return output.float()
+
+
+def quantize_model(model: nn.Module) -> nn.Module:
+    """
+    Dynamically quantize a model for CPU inference: the weights of the Linear
+    layers are stored as int8 and the activations are quantized on the fly.
+    The BatchNorm layers are folded into the Linear layers first.
+    :param model: the trained PyTorch model
+    :return: the quantized copy
+    """
+    return torch.quantization.quantize_dynamic(fold_batchnorm(model),
+                                               {nn.Linear},
+                                               dtype=torch.qint8)
+
+
+def export_torchscript(model: nn.Module,
+                       path: Path,
+                       quantize: bool = False,
+                       atol: float = 1e-4) -> torch.jit.ScriptModule:
+    """
+    Fold the BatchNorm layers of a model into the Linear layers, trace it,
+    freeze it and save it as TorchScript. The architecture of the original
+    model is saved with it so the app can still describe it.
+    :param model: the trained PyTorch model
+    :param path: where to save the TorchScript model
+    :param quantize: whether to export the dynamically quantized model
+    :param atol: tolerance when checking the exported model against the
+    original one, ignored for the quantized model
+    :return: the exported model
+    """
+    model = model.eval()
+    folded = fold_batchnorm(model)
+    example = torch.randn(8, get_n_features(model))
+
+    with torch.no_grad():
+        if not torch.allclose(model(example), folded(example), atol=atol):
+            raise ValueError('folding the BatchNorm layers changed the '
+                             'output of the model')
+        if quantize:
+            folded = quantize_model(model)
+
+        traced = torch.jit.trace(folded, example)
+        # Freezing inlines the weights as constants; from PyTorch 1.8
+        if hasattr(torch.jit, 'freeze'):
+            traced = torch.jit.freeze(traced)
+
+        if not torch.allclose(folded(example), traced(example), atol=atol):
+            raise ValueError('the traced model does not match the eager '
+                             'model')
+
+    torch.jit.save(traced, str(path),
+                   _extra_files={ARCHITECTURE_FILE: str(model)})
+
+    return traced
+
+
+def get_model_size(model: nn.Module) -> int:
+    """
+    Size in bytes of the serialised model.
+    """
+    buffer = io.BytesIO()
+    if isinstance(model, torch.jit.ScriptModule):
+        torch.jit.save(model, buffer)
+    else:
+        torch.save(model.state_dict(), buffer)
+
+    return buffer.tell()
+
+
+def compare_models(models: Dict[str, nn.Module],
+                   X: torch.Tensor,
+                   y: np.ndarray,
+                   batch_size: int = 4096,
+                   n_single: int = 200) -> pd.DataFrame:
+    """
+    Compare the accuracy and the latency of models on the same data, e.g.
+    the float and the quantized versions of a model on the validation set.
+    The first model is the reference for the agreement of the predictions.
+    :param models: mapping of the name of each model to the model
+    :param X: tensor of the encoded features
+    :param y: array of the encoded targets
+    :param batch_size: number of rows per forward pass for the throughput
+    :param n_single: number of single-row forward passes for the latency
+    :return: dataframe with one row per model
+    """
+    results = []
+    reference = None
+    y = np.asarray(y)
+
+    for name, model in models.items():
+        model.eval()
+
+        with inference_mode():
+            start = time.perf_counter()
+            preds = torch.cat([model(batch).argmax(1)
+                               for batch in torch.split(X, batch_size)])
+            elapsed = time.perf_counter() - start
+
+            latencies = []
+            for row in X[:n_single]:
+                row_start = time.perf_counter()
+                model(row.unsqueeze(0))
+                latencies.append(time.perf_counter() - row_start)
+
+        preds = preds.numpy()
+        latencies = np.array(latencies) * 1000
+
+        if reference is None:
+            reference = preds
+
+        results.append({'model': name,
+                        'accuracy': (preds == y).mean(),
+                        'agreement': (preds == reference).mean(),
+                        'rows_per_sec': len(X) / elapsed,
+                        'latency_p50_ms': np.percentile(latencies, 50),
+                        'latency_p99_ms': np.percentile(latencies, 99),
+                        'size_mb': get_model_size(model) / 2 ** 20})
+
+    return pd.DataFrame(results)
+
+
+def load_torchscript(path: Path) -> Tuple[torch.jit.ScriptModule, str]:
+    """
+    Load a model saved by `export_torchscript` onto the CPU.
+    :param path: path to the TorchScript model
+    :return: the model and the description of its original architecture
+    """
+    extra_files = {ARCHITECTURE_FILE: ''}
+    model = torch.jit.load(str(path), map_location='cpu',
+                           _extra_files=extra_files)
+    architecture = extra_files[ARCHITECTURE_FILE]
+    if isinstance(architecture, bytes):
+        architecture = architecture.decode()
+
+    return model, architecture
+
+
+@click.group()
+def main():
+    """ Prepares trained models for serving.
+    """
+
+
+@main.command()
+@click.argument('model_filepath', type=click.Path(exists=True))
+@click.argument('output_filepath', type=click.Path())
+@click.option('--quantize', is_flag=True,
+              help='Export the dynamically quantized (int8) model.')
+def export(model_filepath, output_filepath, quantize):
+    """ Exports a trained model (e.g. ../models/model.torch) to a frozen
+        TorchScript model (e.g. ../models/model.pt).
+    """
+    logger.info(f'exporting {model_filepath} to TorchScript')
+    model = load_pickled(model_filepath)
+    export_torchscript(model, Path(output_filepath), quantize=quantize)
+    logger.info(f'saved {output_filepath}')
+
+
+@main.command()
+@click.argument('model_filepath', type=click.Path(exists=True))
+@click.argument('pipe_filepath', type=click.Path(exists=True))
+@click.argument('label_encoder_filepath', type=click.Path(exists=True))
+@click.argument('report_filepath', type=click.Path())
+@click.option('--data-dir', type=click.Path(exists=True), default=None,
+              help='Directory of the saved sets (default: data/processed).')
+@click.option('--bf16', is_flag=True,
+              help='Also compare the model under bfloat16 autocast.')
+def compare(model_filepath, pipe_filepath, label_encoder_filepath,
+            report_filepath, data_dir, bf16):
+    """ Compares the accuracy and the latency of the float and the
+        quantized versions of a trained model, and optionally of the model
+        under bfloat16 autocast, on the saved validation set and saves the
+        report as CSV.
+    """
+    from joblib import load
+    from src.data.sets import load_sets
+    from src.models.pipes import compile_preprocessing_pipe
+
+    model = load_pickled(model_filepath).eval()
+    compiled_pipe = compile_preprocessing_pipe(load(pipe_filepath))
+    le = load(label_encoder_filepath)
+
+    sets = load_sets() if data_dir is None else load_sets(Path(data_dir))
+    X_val, y_val = sets[2], sets[5]
+    X = torch.from_numpy(compiled_pipe.transform(X_val))
+    y = le.transform(y_val)
+
+    models = {'float32': model,
+              'float32_folded': fold_batchnorm(model),
+              'int8_dynamic': quantize_model(model)}
+    if bf16:
+        models['bfloat16_autocast'] = ServingModel(model, bf16=True)
+    report = compare_models(models, X, y)
+    report.to_csv(report_filepath, index=False)
+    logger.info(f'comparison on {len(X)} validation rows:\n{report}')
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List, Mapping, Sequence
+
+import click
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+
+from src.data.diagnostics import check_class_coverage
+from src.data.sets import load_metadata, load_sets
+from src.models.pytorch import MacroF1, MemmapDataset, Trainer
+from src.models.pytorch import build_model
+
+logger = logging.getLogger(__name__)
+
+RESULTS_FILE = 'results.csv'
+
+# Search space of the experiments of the notebooks
+DEFAULT_SPACE = {
+    'model': ['PytorchClassification_2', 'PytorchClassification_3',
+              'PytorchClassification_5', 'PytorchClassification_6',
+              'PytorchClassification_8'],
+    'width': [0.5, 1.0],
+    'p_dropout': [0.1, 0.2, 0.3],
+    'lr': [0.0003, 0.001, 0.003],
+    'batch_size': [512, 1024, 2048]
+}
+
+
+def sample_trials(space: Mapping[str, Sequence],
+                  n_trials: int = None,
+                  seed: int = 0) -> List[Dict]:
+    """
+    Parameters of the trials of a sweep: the full grid of the search space,
+    or a random sample of `n_trials` distinct combinations of it.
+    :param space: mapping of each parameter to its candidate values
+    :param n_trials: number of trials, None for the full grid
+    :param seed: seed of the sample
+    :return: list of the parameters of each trial
+    """
+    names = list(space)
+    grid = list(itertools.product(*[space[name] for name in names]))
+    if n_trials is not None and n_trials < len(grid):
+        rng = np.random.RandomState(seed)
+        grid = [grid[i] for i in rng.choice(len(grid), n_trials,
+                                            replace=False)]
+
+    return [dict(zip(names, values)) for values in grid]
+
+
+class MedianPruner:
+    """
+    Prunes the trials doing worse than the median of the others
+    ...
+
+    Every trial reports its validation loss after each epoch to a mapping
+    shared by the processes of the sweep. After `n_warmup_epochs`, a trial
+    whose loss is higher than the median loss of the other trials at the
+    same epoch is stopped, as long as at least `n_min_trials` other trials
+    reached that epoch.
+
+    Attributes
+    ----------
+    reports : dict
+        Shared mapping of each trial to its validation losses, e.g. a
+        `multiprocessing.Manager().dict()`
+    n_warmup_epochs : int
+        Number of epochs before a trial can be pruned
+    n_min_trials : int
+        Minimum number of other trials to compare with
+
+    Methods
+    -------
+    should_prune(trial, epoch, loss)
+        Report the loss of a trial and return whether to prune it
+    callback(trial)
+        Return a `Trainer.fit` callback pruning the trial
+    """
+
+    def __init__(self,
+                 reports: dict,
+                 n_warmup_epochs: int = 2,
+                 n_min_trials: int = 3):
+        self.reports = reports
+        self.n_warmup_epochs = n_warmup_epochs
+        self.n_min_trials = n_min_trials
+
+    def should_prune(self, trial: int, epoch: int, loss: float) -> bool:
+        # Reassigned rather than appended to, for the manager to see it
+        self.reports[trial] = list(self.reports.get(trial, [])) + [loss]
+        if epoch < self.n_warmup_epochs:
+            return False
+
+        others = [losses[epoch] for other, losses in self.reports.items()
+                  if other != trial and len(losses) > epoch]
+        if len(others) < self.n_min_trials:
+            return False
+
+        return loss > np.median(others)
+
+    def callback(self, trial: int):
+        def prune(trainer: Trainer, record: dict) -> bool:
+            pruned = self.should_prune(trial, record['epoch'],
+                                       record['val_loss'])
+            if pruned:
+                trainer.pruned = True
+            return pruned
+
+        return prune
+
+
+# Sets of a sweep worker process, loaded once by `_init_worker`
+_worker_sets = None
+
+
+def _init_worker(data_dir: Path, n_threads: int):
+    global _worker_sets
+
+    # Share the cores between the trials rather than oversubscribing them
+    torch.set_num_threads(n_threads)
+    X_train, _, X_val, y_train, _, y_val = load_sets(data_dir, fmt='npy')
+    metadata = load_metadata(data_dir) or {}
+    n_classes = (len(metadata['classes']) if metadata.get('classes')
+                 else int(np.max(y_train)) + 1)
+    # Memory-mapped, so the workers share the page cache of the sets rather
+    # than each holding a copy
+    _worker_sets = (MemmapDataset(X_train, y_train),
+                    MemmapDataset(X_val, y_val),
+                    n_classes)
+
+
+def _run_trial(trial: int,
+               params: dict,
+               output_dir: Path,
+               n_epochs: int,
+               patience: int,
+               pruner: MedianPruner,
+               seed: int) -> dict:
+    train_data, val_data, n_classes = _worker_sets
+    torch.manual_seed(seed + trial)
+
+    model = build_model(params['model'], train_data.X.shape[1],
+                        n_classes, **params)
+    optimizer = torch.optim.Adam(model.parameters(),
+                                 lr=params.get('lr', 0.001))
+    trainer = Trainer(model, nn.CrossEntropyLoss(), optimizer, train_data,
+                      val_data, batch_size=params.get('batch_size', 1024),
+                      device=torch.device('cpu'), metrics=[MacroF1()],
+                      patience=patience, seed=seed + trial)
+    trainer.pruned = False
+
+    start = time.perf_counter()
+    callbacks = [pruner.callback(trial)] if pruner is not None else []
+    history = trainer.fit(n_epochs, callbacks=callbacks)
+    elapsed = time.perf_counter() - start
+
+    model_path = Path(output_dir) / f'trial_{trial}_model.torch'
+    torch.save(model, model_path)
+    best = history.loc[history['val_loss'].idxmin()]
+
+    return dict(params,
+                trial=trial,
+                state='pruned' if trainer.pruned else 'complete',
+                epochs=len(history),
+                val_loss=best['val_loss'],
+                val_accuracy=best['val_accuracy'],
+                val_macro_f1=best['val_macro_f1'],
+                seconds=elapsed,
+                model_path=str(model_path))
+
+
+def run_sweep(data_dir: Path,
+              output_dir: Path,
+              space: Mapping[str, Sequence] = None,
+              n_trials: int = None,
+              n_parallel: int = None,
+              n_epochs: int = 20,
+              patience: int = 3,
+              n_warmup_epochs: int = 2,
+              prune: bool = True,
+              seed: int = 0) -> pd.DataFrame:
+    """
+    Train the trials of a search space concurrently and save a table of
+    their results.
+    :param data_dir: folder of the preprocessed sets saved in the 'npy'
+    format by `src.data.sets.save_sets`
+    :param output_dir: folder of the models of the trials and the results
+    :param space: mapping of 'model' (class name in `src.models.pytorch`),
+    'width', 'p_dropout', 'lr' and 'batch_size' to their candidate values,
+    or 'hidden_sizes' and 'activation' for 'PytorchMLP' (default:
+    `DEFAULT_SPACE`)
+    :param n_trials: number of trials sampled from the space, None for the
+    full grid
+    :param n_parallel: number of trials trained at the same time, each with
+    its share of the cores (default: the number of cores)
+    :param n_epochs: maximum number of epochs per trial
+    :param patience: number of epochs without improvement before a trial
+    stops early
+    :param n_warmup_epochs: number of epochs before a trial can be pruned
+    :param prune: whether to prune the trials doing worse than the median
+    :param seed: seed of the sample of the trials and of their training
+    :return: dataframe of the results, best validation loss first
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    _, _, _, y_train, y_test, y_val = load_sets(data_dir, fmt='npy')
+    check_class_coverage({'train': y_train, 'val': y_val, 'test': y_test},
+                         (load_metadata(data_dir) or {}).get('classes'))
+    trials = sample_trials(space or DEFAULT_SPACE, n_trials, seed)
+    n_cores = os.cpu_count() or 1
+    n_parallel = min(n_parallel or n_cores, len(trials))
+
+    context = multiprocessing.get_context('spawn')
+    manager = context.Manager()
+    pruner = (MedianPruner(manager.dict(), n_warmup_epochs=n_warmup_epochs)
+              if prune else None)
+
+    results = []
+    try:
+        with ProcessPoolExecutor(max_workers=n_parallel, mp_context=context,
+                                 initializer=_init_worker,
+                                 initargs=(Path(data_dir),
+                                           max(1, n_cores // n_parallel))
+                                 ) as pool:
+            futures = {pool.submit(_run_trial, trial, params, output_dir,
+                                   n_epochs, patience, pruner, seed):
+                       (trial, params)
+                       for trial, params in enumerate(trials)}
+            for future in as_completed(futures):
+                trial, params = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.exception(f'trial {trial} failed')
+                    result = dict(params, trial=trial, state='failed',
+                                  error=str(e))
+                logger.info(f'trial {trial} {result["state"]}: '
+                            f'{result.get("val_loss", float("nan")):.4f} '
+                            f'validation loss with {params}')
+                results.append(result)
+    finally:
+        manager.shutdown()
+
+    # The failed trials have no validation loss, the column is missing if
+    # they all failed
+    results = pd.DataFrame(results)
+    if 'val_loss' not in results.columns:
+        results['val_loss'] = np.nan
+    results = results.sort_values('val_loss', ignore_index=True)
+    results.to_csv(output_dir / RESULTS_FILE, index=False)
+
+    return results
+
+
+def promote_best(results: pd.DataFrame,
+                 models_dir: Path,
+                 pipe_filepath: Path,
+                 label_encoder_filepath: Path) -> pd.Series:
+    """
+    Copy the model of the trial with the lowest validation loss, and the
+    pipe and label encoder it was trained with, to `model.torch`,
+    `pipe.sav` and `label_encoder.sav` in the models directory.
+    :return: the results of the promoted trial
+    """
+    models_dir = Path(models_dir)
+    succeeded = results[results['state'] != 'failed']
+    if succeeded.empty:
+        raise ValueError('no trial of the sweep succeeded, there is no model '
+                         'to promote')
+    best = succeeded.sort_values('val_loss').iloc[0]
+
+    # The hot-reloading registry must never see a partly written file, so
+    # every file is copied aside first, then renamed into place, the model
+    # last as its change triggers the reload
+    copies = []
+    try:
+        for source, name in ((pipe_filepath, 'pipe.sav'),
+                             (label_encoder_filepath, 'label_encoder.sav'),
+                             (best['model_path'], 'model.torch')):
+            target = models_dir / name
+            if Path(source).resolve() != target.resolve():
+                tmp_path = target.with_name(target.name + '.tmp')
+                shutil.copyfile(source, tmp_path)
+                copies.append((tmp_path, target))
+        for tmp_path, target in copies:
+            os.replace(tmp_path, target)
+    finally:
+        for tmp_path, _ in copies:
+            if tmp_path.exists():
+                tmp_path.unlink()
+    logger.info(f'promoted trial {best["trial"]} to {models_dir}')
+
+    return best
+
+
+@click.command()
+@click.argument('data_dirpath', type=click.Path(exists=True))
+@click.argument('pipe_filepath', type=click.Path(exists=True))
+@click.argument('label_encoder_filepath', type=click.Path(exists=True))
+@click.option('--output-dir', 'output_dirpath', type=click.Path(),
+              default='models/sweep', show_default=True,
+              help='Folder of the models of the trials and the results.')
+@click.option('--space', 'space_filepath', type=click.Path(exists=True),
+              default=None, help='JSON file of the search space.')
+@click.option('--trials', type=int, default=None,
+              help='Number of trials sampled from the space (default: all).')
+@click.option('--parallel', type=int, default=None,
+              help='Number of trials at the same time (default: cores).')
+@click.option('--epochs', type=int, default=20, show_default=True)
+@click.option('--patience', type=int, default=3, show_default=True)
+@click.option('--no-pruning', is_flag=True)
+@click.option('--promote', is_flag=True,
+              help='Copy the artifacts of the best trial to --models-dir.')
+@click.option('--models-dir', 'models_dirpath', type=click.Path(),
+              default='models', show_default=True)
+def main(data_dirpath, pipe_filepath, label_encoder_filepath, output_dirpath,
+         space_filepath, trials, parallel, epochs, patience, no_pruning,
+         promote, models_dirpath):
+    """ Runs a sweep over the models of src/models/pytorch.py and their
+        hyperparameters on the preprocessed sets (e.g. in
+        ../data/processed) and saves the results table.
+    """
+    space = None
+    if space_filepath is not None:
+        with open(space_filepath) as f:
+            space = json.load(f)
+
+    results = run_sweep(Path(data_dirpath), Path(output_dirpath), space,
+                        n_trials=trials, n_parallel=parallel,
+                        n_epochs=epochs, patience=patience,
+                        prune=not no_pruning)
+    logger.info(f'sweep results:\n{results}')
+
+    if promote:
+        promote_best(results, Path(models_dirpath), pipe_filepath,
+                     label_encoder_filepath)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
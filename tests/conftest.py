@@ -0,0 +1,9 @@
+import sys
+from pathlib import Path
+
+# The tests import the project as `src` and the API as `main`, as the app
+# does when run from its own folder
+ROOT = Path(__file__).resolve().parents[1]
+for path in (ROOT, ROOT / 'app'):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
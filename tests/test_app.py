@@ -0,0 +1,91 @@
+import asyncio
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+# No reload thread, the artifacts are not needed by these endpoints
+os.environ.setdefault('MODEL_RELOAD_INTERVAL', '-1')
+
+
+@pytest.fixture(scope='module')
+def client():
+    import main
+    return TestClient(main.app)
+
+
+def _requests_total(client, endpoint, status):
+    pattern = (f'inference_requests_total{{endpoint="{endpoint}",'
+               f'status="{status}"}} ')
+    for line in client.get('/metrics').text.splitlines():
+        if line.startswith(pattern):
+            return float(line[len(pattern):])
+    return 0
+
+
+@pytest.mark.parametrize('sample_rate', [-0.5, 1.5])
+def test_put_tracing_rejects_out_of_range(client, sample_rate):
+    response = client.put('/tracing', params={'sample_rate': sample_rate})
+
+    assert response.status_code == 422
+    assert client.get('/tracing').json()['sample_rate'] == 0
+
+
+def test_put_tracing(client):
+    response = client.put('/tracing', params={'sample_rate': 0.25})
+    client.put('/tracing', params={'sample_rate': 0})
+
+    assert response.status_code == 200
+    assert response.json() == {'sample_rate': 0.25}
+
+
+@pytest.mark.parametrize('n', [0, -1])
+def test_get_tracing_rejects_non_positive_n(client, n):
+    response = client.get('/tracing', params={'n': n})
+
+    assert response.status_code == 422
+
+
+def test_unknown_paths_are_grouped(client):
+    before = _requests_total(client, 'other', 404)
+    client.get('/no/such/path')
+    client.get('/another-one')
+
+    assert _requests_total(client, 'other', 404) == before + 2
+    assert '/no/such/path' not in client.get('/metrics').text
+
+
+def test_known_paths_ignore_trailing_slash(client):
+    # The middleware is called directly, the redirect of the trailing slash
+    # is handled differently by the TestClient of each Starlette version
+    import main
+    from starlette.requests import Request
+    from starlette.responses import Response
+
+    async def call_next(request):
+        return Response(status_code=204)
+
+    request = Request({'type': 'http', 'method': 'GET', 'path': '/tracing/',
+                       'query_string': b'', 'headers': []})
+    before = _requests_total(client, '/tracing', 204)
+    response = asyncio.run(main.instrument_requests(request, call_next))
+
+    assert response.status_code == 204
+    assert _requests_total(client, '/tracing', 204) == before + 1
+
+
+def test_predict_many_requires_observations(client):
+    response = client.post('/beer/types')
+
+    assert response.status_code == 422
+    assert response.json()['detail'] == ('at least one observation is '
+                                         'required')
+
+
+def test_predict_many_rejects_uneven_lists(client):
+    response = client.post('/beer/types', params={
+        'brewery_name': ['a', 'b'], 'review_aroma': [4],
+        'review_appearance': [4], 'review_palate': [4],
+        'review_taste': [4]})
+
+    assert response.status_code == 422
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import FunctionTransformer
+
+from src.features.build_features import PreprocessingCache
+
+
+def sqrt_pipe(X, y=None):
+    return Pipeline([('sqrt', FunctionTransformer(np.sqrt))]).fit(X)
+
+
+@pytest.fixture
+def sets():
+    X_train = pd.DataFrame({'score': [1.0, 2.0, 3.0, 4.5]})
+    return X_train, {'val': pd.DataFrame({'score': [2.0, 3.0, 5.0]}),
+                     'X_test': pd.DataFrame({'score': [0.5, 7.0]})}
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_hit_returns_the_arrays_of_the_miss(tmp_path, sets, mmap):
+    X_train, other_sets = sets
+    cache = PreprocessingCache(tmp_path)
+
+    _, missed = cache.get_or_create(X_train, other_sets=other_sets,
+                                    factory=sqrt_pipe, mmap=mmap)
+    _, hit = cache.get_or_create(X_train, other_sets=other_sets,
+                                 factory=sqrt_pipe, mmap=mmap)
+
+    assert sorted(hit) == sorted(missed) == ['X_test', 'X_train', 'val']
+    for name, X in dict(other_sets, X_train=X_train).items():
+        expected = np.sqrt(X.to_numpy()).astype(np.float32)
+        for arrays in (missed, hit):
+            assert arrays[name].dtype == np.float32
+            np.testing.assert_array_equal(arrays[name], expected)
+
+
+def test_key_changes_with_the_data(tmp_path, sets):
+    X_train, other_sets = sets
+    cache = PreprocessingCache(tmp_path)
+
+    key = cache.key(dict(other_sets, X_train=X_train), sqrt_pipe)
+    other_sets = dict(other_sets, val=other_sets['val'] + 1)
+
+    assert cache.key(dict(other_sets, X_train=X_train), sqrt_pipe) != key
@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.diagnostics import check_class_coverage, class_coverage
+from src.data.diagnostics import coverage_summary
+
+
+@pytest.fixture
+def splits():
+    return {'train': pd.Series(['a'] * 30 + ['b'] * 15 + ['c'] * 5),
+            'val': pd.Series(['a'] * 8 + ['b'] * 2 + [None]),
+            'test': pd.Categorical(['a'] * 6 + ['b'] * 4,
+                                   categories=['a', 'b', 'c'])}
+
+
+def test_class_coverage_counts(splits):
+    coverage = class_coverage(splits, min_count=5)
+
+    assert coverage.index.tolist() == ['a', 'b', 'c']
+    assert coverage[['train', 'val', 'test']].to_numpy().tolist() == [
+        [30, 8, 6], [15, 2, 4], [5, 0, 0]]
+    np.testing.assert_allclose(coverage['train_share'], [0.6, 0.3, 0.1])
+    np.testing.assert_allclose(coverage['val_share'], [0.8, 0.2, 0])
+    assert coverage['missing'].tolist() == [False, False, True]
+    assert coverage['under_represented'].tolist() == [False, True, True]
+    np.testing.assert_allclose(coverage['drift'], [0.2, 0.1, 0.1])
+
+
+def test_class_coverage_integer_codes():
+    splits = {'train': np.array([0, 0, 1, 3]), 'val': np.array([1, 1])}
+
+    coverage = class_coverage(splits, classes=['w', 'x', 'y', 'z'])
+
+    assert coverage.index.tolist() == ['w', 'x', 'y', 'z']
+    assert coverage['train'].tolist() == [2, 1, 0, 1]
+    assert coverage['val'].tolist() == [0, 2, 0, 0]
+
+
+def test_class_coverage_integer_labels():
+    # Without the classes, integer labels are labels rather than codes
+    y = pd.Series([1, 5, 5, 1])
+
+    coverage = class_coverage({'train': y, 'val': np.array([5, 5])})
+
+    assert coverage.index.tolist() == [1, 5]
+    assert coverage['train'].tolist() == [2, 2]
+    assert coverage['val'].tolist() == [0, 2]
+
+
+def test_class_coverage_codes_out_of_range():
+    with pytest.raises(ValueError, match='codes of the 2 classes'):
+        class_coverage({'train': np.array([0, 1, 2])}, classes=['x', 'y'])
+
+
+def test_class_coverage_matches_value_counts():
+    rng = np.random.RandomState(0)
+    classes = [f'style {i}' for i in range(20)]
+    splits = {name: pd.Series(rng.choice(classes, n))
+              for name, n in (('train', 5000), ('val', 700))}
+
+    coverage = class_coverage(splits, classes)
+
+    for name, labels in splits.items():
+        expected = labels.value_counts().reindex(classes, fill_value=0)
+        assert coverage[name].tolist() == expected.tolist()
+
+
+def test_coverage_summary(splits):
+    summary = coverage_summary(class_coverage(splits, min_count=5))
+
+    assert summary['rows'].tolist() == [50, 10, 10]
+    assert summary['missing'].tolist() == [0, 1, 1]
+    assert summary['under_represented'].tolist() == [0, 1, 1]
+    np.testing.assert_allclose(summary['imbalance_ratio'], [6, 4, 1.5])
+
+
+def test_check_class_coverage_strict(splits):
+    with pytest.raises(ValueError, match='missing from val'):
+        check_class_coverage(splits, min_count=1, strict=True)
+
+
+def test_class_exclusion_integer_labels():
+    from src.data import sets
+
+    y = pd.Series([1, 5, 5, 1])
+
+    assert sets.test_class_exclusion(y, y, y).startswith('✔')
@@ -0,0 +1,133 @@
+import asyncio
+import re
+
+import pytest
+
+from src.models.batching import MicroBatcher
+from src.models.instrumentation import Counter, Histogram, MetricsRegistry
+from src.models.instrumentation import Tracer, _Metric, _StageTimer
+from src.models.instrumentation import batch_context
+
+
+def test_metric_is_abstract():
+    with pytest.raises(TypeError):
+        _Metric('metric', 'A metric.')
+
+
+def test_counter_render_escapes_labels():
+    registry = MetricsRegistry()
+    counter = registry.counter('requests', 'Number of requests.',
+                               ('endpoint',))
+    counter.labels('a"b\\c\nd').inc()
+    counter.labels('a"b\\c\nd').inc(2)
+
+    assert registry.render().splitlines() == [
+        '# HELP requests Number of requests.',
+        '# TYPE requests counter',
+        'requests_total{endpoint="a\\"b\\\\c\\nd"} 3'
+    ]
+
+
+def test_counter_without_labels():
+    counter = Counter('rows', 'Number of rows.')
+    counter.inc(5)
+
+    assert counter.render().splitlines()[-1] == 'rows_total 5'
+
+
+def test_histogram_render():
+    histogram = Histogram('latency', 'Latency.', ('stage',),
+                          buckets=(0.5, 0.25, 1))
+    for value in (0.125, 0.25, 0.375, 2, 0.75):
+        histogram.labels('forward').observe(value)
+
+    assert histogram.render().splitlines() == [
+        '# HELP latency Latency.',
+        '# TYPE latency histogram',
+        # The buckets are sorted, cumulative and inclusive of their bound
+        'latency_bucket{stage="forward",le="0.25"} 2',
+        'latency_bucket{stage="forward",le="0.5"} 3',
+        'latency_bucket{stage="forward",le="1"} 4',
+        'latency_bucket{stage="forward",le="+Inf"} 5',
+        'latency_sum{stage="forward"} 3.5',
+        'latency_count{stage="forward"} 5'
+    ]
+
+
+def test_labels_count_mismatch():
+    counter = Counter('requests', 'Number of requests.',
+                      ('endpoint', 'status'))
+
+    with pytest.raises(ValueError):
+        counter.labels('/beer/type')
+
+
+def test_registry_render_is_valid_text_format():
+    registry = MetricsRegistry()
+    registry.counter('a', 'A.').inc()
+    registry.gauge('b', 'B.').set(1.5)
+    registry.histogram('c', 'C.').observe(0.01)
+    sample = re.compile(r'^[a-z_]+(\{[^}]*\})? \S+$')
+
+    text = registry.render()
+    assert text.endswith('\n')
+    for line in text.splitlines():
+        assert line.startswith('# ') or sample.match(line), line
+
+
+@pytest.mark.parametrize('sample_rate, n_traces', [(0, 0), (1, 20)])
+def test_tracer_sampling(sample_rate, n_traces):
+    tracer = Tracer(sample_rate)
+    for _ in range(20):
+        with tracer.trace('request') as trace:
+            assert (trace is not None) == (sample_rate == 1)
+
+    assert len(tracer.recent()) == n_traces
+
+
+@pytest.mark.parametrize('n, n_traces', [(0, 0), (3, 3), (50, 20)])
+def test_tracer_recent(n, n_traces):
+    tracer = Tracer(1)
+    for i in range(20):
+        with tracer.trace(f'request {i}'):
+            pass
+
+    traces = tracer.recent(n)
+    assert [trace['name'] for trace in traces] == [
+        f'request {i}' for i in range(20 - n_traces, 20)]
+    with pytest.raises(ValueError):
+        tracer.recent(-1)
+
+
+@pytest.mark.parametrize('sample_rate', [-0.1, 1.1])
+def test_tracer_rejects_sample_rate(sample_rate):
+    with pytest.raises(ValueError):
+        Tracer(sample_rate)
+    with pytest.raises(ValueError):
+        Tracer().sample_rate = sample_rate
+
+
+def test_micro_batch_spans_reach_every_trace():
+    tracer = Tracer(1)
+    stage_seconds = Histogram('stage_seconds', 'Stages.', ('stage',))
+
+    def predict(items):
+        with _StageTimer(stage_seconds.labels('forward'), 'forward'):
+            return [item * 2 for item in items]
+
+    async def request(batcher, item):
+        with tracer.trace('request') as trace:
+            return await batcher.submit(item), trace
+
+    async def main():
+        batcher = MicroBatcher(predict, max_batch_size=3, max_wait_ms=50,
+                               merge_contexts=batch_context)
+        return await asyncio.gather(*(request(batcher, item)
+                                      for item in range(3)))
+
+    results = asyncio.run(main())
+
+    assert [result for result, _ in results] == [0, 2, 4]
+    for _, trace in results:
+        assert [span['stage'] for span in trace.spans] == ['forward']
+        assert trace.attributes['microbatch_size'] == 3
@@ -0,0 +1,14 @@
+import numpy as np
+
+from src.data.make_dataset import HashSet
+
+
+def test_hash_set_keeps_first_unseen():
+    hashes = HashSet()
+
+    first = hashes.add_new(np.array([5, 3, 5, 9], dtype=np.uint64))
+    second = hashes.add_new(np.array([9, 1, 7, 1, 3], dtype=np.uint64))
+
+    assert first.tolist() == [True, True, False, True]
+    assert second.tolist() == [False, True, True, False, False]
+    assert hashes.hashes.tolist() == [1, 3, 5, 7, 9]
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from sklearn.metrics import precision_recall_fscore_support, roc_auc_score
+
+from src.models.performance import classification_metrics, one_vs_rest_auc
+
+
+@pytest.fixture
+def predictions():
+    rng = np.random.RandomState(0)
+    n_rows, n_classes = 2000, 6
+    y_true = rng.randint(0, n_classes, n_rows)
+    # Rounded so that many scores are tied
+    scores = np.round(rng.dirichlet(np.ones(n_classes), n_rows), 2)
+    scores[np.arange(n_rows), y_true] += 0.1 * rng.rand(n_rows)
+    return y_true, scores
+
+
+def test_one_vs_rest_auc_matches_sklearn(predictions):
+    y_true, scores = predictions
+    expected = [roc_auc_score(y_true == k, scores[:, k])
+                for k in range(scores.shape[1])]
+
+    np.testing.assert_allclose(one_vs_rest_auc(y_true, scores), expected)
+
+
+@pytest.mark.parametrize('block_size', [1, 4000, 8000])
+def test_one_vs_rest_auc_in_blocks(predictions, block_size):
+    y_true, scores = predictions
+
+    np.testing.assert_allclose(
+        one_vs_rest_auc(y_true, scores, block_size=block_size),
+        one_vs_rest_auc(y_true, scores))
+
+
+def test_one_vs_rest_auc_without_positives(predictions):
+    y_true, scores = predictions
+    y_true = np.where(y_true == 2, 0, y_true)
+
+    auc = one_vs_rest_auc(y_true, scores)
+
+    assert np.isnan(auc[2])
+    assert not np.isnan(np.delete(auc, 2)).any()
+
+
+def test_classification_metrics_match_sklearn(predictions):
+    y_true, scores = predictions
+    classes = np.array(list('abcdef'))
+
+    result = classification_metrics(classes[y_true], proba=scores,
+                                    classes=classes)
+    precision, recall, f1, support = precision_recall_fscore_support(
+        classes[y_true], classes[scores.argmax(1)], labels=classes,
+        zero_division=0)
+
+    assert result['beer_style'].tolist() == classes.tolist()
+    np.testing.assert_allclose(result['precision'], precision)
+    np.testing.assert_allclose(result['recall'], recall)
+    np.testing.assert_allclose(result['f1'], f1)
+    np.testing.assert_array_equal(result['support'], support)
+    np.testing.assert_allclose(result['auc'], one_vs_rest_auc(y_true, scores))
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.models.pipes import FEATURES, compile_preprocessing_pipe
+from src.models.pipes import create_preprocessing_pipe
+
+
+def _reviews(n, seed, breweries):
+    rng = np.random.RandomState(seed)
+    X = pd.DataFrame({
+        'brewery_name': rng.choice(breweries, n).astype(object),
+        'review_aroma': rng.randint(0, 11, n) / 2,
+        'review_appearance': rng.randint(0, 11, n) / 2,
+        'review_palate': rng.randint(0, 11, n) / 2,
+        'review_taste': rng.randint(0, 11, n) / 2
+    })
+    return X[FEATURES]
+
+
+@pytest.fixture(scope='module', params=['binary', 'codes'])
+def pipe(request):
+    X = _reviews(500, 0, [f'brewery {i}' for i in range(40)])
+    return create_preprocessing_pipe(X, encoder=request.param)
+
+
+def test_compiled_pipe_matches_pipe(pipe):
+    # Known, unknown and missing breweries
+    X = _reviews(300, 1, [f'brewery {i}' for i in range(50)])
+    X.loc[::7, 'brewery_name'] = None
+    compiled_pipe = compile_preprocessing_pipe(pipe)
+
+    expected = np.asarray(pipe.transform(X), dtype=np.float32)
+    np.testing.assert_array_equal(compiled_pipe.transform(X), expected)
+    np.testing.assert_array_equal(
+        compiled_pipe.transform({col: X[col].tolist() for col in FEATURES}),
+        expected)
+
+
+def test_compiled_pipe_transform_one(pipe):
+    X = _reviews(20, 2, [f'brewery {i}' for i in range(50)])
+    compiled_pipe = compile_preprocessing_pipe(pipe)
+    expected = compiled_pipe.transform(X)
+
+    for i, row in enumerate(X.itertuples(index=False)):
+        np.testing.assert_array_equal(compiled_pipe.transform_one(*row),
+                                      expected[i:i + 1])
+
+
+def test_compiled_pipe_writes_into_out(pipe):
+    X = _reviews(10, 3, ['brewery 1', 'brewery 2'])
+    compiled_pipe = compile_preprocessing_pipe(pipe)
+    out = np.empty((len(X), compiled_pipe.n_features), dtype=np.float32)
+
+    assert compiled_pipe.transform(X, out=out) is out
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.models.pipes import FEATURES, compile_preprocessing_pipe
+from src.models.pipes import create_preprocessing_pipe
+from src.models.predict_model import merge_parts, score_file
+from src.models.pytorch import PytorchMLP
+
+
+@pytest.fixture(scope='module')
+def artifacts():
+    rng = np.random.RandomState(0)
+    n = 200
+    X = pd.DataFrame({
+        'brewery_name': rng.choice(['a', 'b', 'c'], n).astype(object),
+        **{col: rng.randint(0, 11, n) / 2 for col in FEATURES[1:]}
+    })[FEATURES]
+    compiled_pipe = compile_preprocessing_pipe(
+        create_preprocessing_pipe(X, encoder='codes'))
+    classes = np.array(['ale', 'lager', 'stout'], dtype=object)
+    model = PytorchMLP(compiled_pipe.n_features, len(classes),
+                       hidden_sizes=(8,))
+    return model, compiled_pipe, classes, X
+
+
+@pytest.mark.parametrize('suffix', ['.csv', '.parquet'])
+def test_score_file(artifacts, tmp_path, suffix):
+    model, compiled_pipe, classes, X = artifacts
+    X.to_parquet(tmp_path / 'input.parquet')
+    output_path = tmp_path / f'output{suffix}'
+
+    n_rows = score_file(model, compiled_pipe, classes,
+                        tmp_path / 'input.parquet', output_path,
+                        chunksize=64, top_k=2)
+    output = (pd.read_csv(output_path) if suffix == '.csv'
+              else pd.read_parquet(output_path))
+
+    assert n_rows == len(output) == len(X)
+    assert set(output['beer_style']) <= set(classes)
+
+
+@pytest.mark.parametrize('input_name', ['input.csv', 'input.parquet'])
+@pytest.mark.parametrize('suffix', ['.csv', '.parquet'])
+def test_score_file_without_rows(artifacts, tmp_path, input_name, suffix):
+    model, compiled_pipe, classes, X = artifacts
+    input_path = tmp_path / input_name
+    if input_path.suffix == '.csv':
+        X.iloc[:0].to_csv(input_path, index=False)
+    else:
+        X.iloc[:0].to_parquet(input_path)
+    output_path = tmp_path / f'output{suffix}'
+
+    n_rows = score_file(model, compiled_pipe, classes, input_path,
+                        output_path, top_k=1)
+
+    assert n_rows == 0
+    if suffix == '.csv':
+        assert output_path.read_text().strip() == \
+            'beer_style,top_1_style,top_1_prob'
+    else:
+        import pyarrow.parquet as pq
+
+        schema = pq.read_schema(str(output_path))
+        assert schema.names == ['beer_style', 'top_1_style', 'top_1_prob']
+        assert str(schema.field('beer_style').type) == 'string'
+
+
+def test_merge_parts_common_schema(tmp_path):
+    pd.DataFrame({'id': [1, 2], 'note': [None, None],
+                  'beer_style': ['ale', 'lager']}) \
+        .to_parquet(tmp_path / 'part-0.parquet')
+    pd.DataFrame({'id': [3.5, np.nan], 'note': ['x', 'y'],
+                  'beer_style': ['stout', 'ale']}) \
+        .to_parquet(tmp_path / 'part-1.parquet')
+    output_path = tmp_path / 'output.parquet'
+
+    merge_parts([tmp_path / 'part-0.parquet', tmp_path / 'missing.parquet',
+                 tmp_path / 'part-1.parquet'], output_path)
+    output = pd.read_parquet(output_path)
+
+    assert output['id'].tolist()[:3] == [1.0, 2.0, 3.5]
+    assert output['note'].tolist()[2:] == ['x', 'y']
+    assert output['beer_style'].tolist() == ['ale', 'lager', 'stout', 'ale']
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        'output.parquet', 'part-0.parquet', 'part-1.parquet']
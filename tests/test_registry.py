@@ -0,0 +1,17 @@
+import torch
+
+from src.models.pytorch import PytorchMLP
+from src.models.registry import load_model
+
+
+def test_load_pickled_model(tmp_path):
+    # A whole pickled model, which the weights only loading rejects
+    model = PytorchMLP(6, 3, hidden_sizes=(4,)).eval()
+    torch.save(model, tmp_path / 'model.torch')
+
+    loaded, architecture = load_model(tmp_path / 'model.torch')
+    X = torch.randn(5, 6)
+
+    assert architecture == str(model)
+    with torch.no_grad():
+        torch.testing.assert_close(loaded(X), model(X))
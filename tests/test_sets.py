@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.sets import load_sets, merge_categories, split_sets_streaming
+
+
+def _merge_categories_reference(s, threshold):
+    # The original implementation, on the strings
+    result = s.copy(deep=True)
+    counts = result.value_counts(normalize=threshold <= 1)
+    result.loc[result.isin(counts[counts <= threshold].index)] = 'other'
+    return result
+
+
+@pytest.fixture(scope='module')
+def breweries():
+    rng = np.random.RandomState(0)
+    names = np.array([f'brewery {i}' for i in range(300)], dtype=object)
+    s = pd.Series(names[rng.zipf(1.5, 20000) % len(names)], name='brewery')
+    s[::97] = None
+    return s
+
+
+@pytest.mark.parametrize('threshold', [1, 20, 0.001, 0.01])
+def test_merge_categories_matches_reference(breweries, threshold):
+    expected = _merge_categories_reference(breweries, threshold)
+
+    pd.testing.assert_series_equal(merge_categories(breweries, threshold),
+                                   expected)
+
+
+@pytest.mark.parametrize('threshold', [20, 0.01])
+def test_merge_categories_categorical(breweries, threshold):
+    expected = _merge_categories_reference(breweries, threshold)
+
+    result = merge_categories(breweries.astype('category'), threshold)
+
+    assert isinstance(result.dtype, pd.CategoricalDtype)
+    pd.testing.assert_series_equal(result.astype(expected.dtype), expected)
+
+
+def test_merge_categories_existing_other():
+    s = pd.Series(['other', 'a', 'a', 'b', 'other'])
+
+    result = merge_categories(s, 0.3)
+
+    assert result.tolist() == ['other', 'a', 'a', 'other', 'other']
+
+
+@pytest.fixture(scope='module')
+def reviews():
+    rng = np.random.RandomState(1)
+    n = 5000
+    return pd.DataFrame({
+        'brewery_name': rng.choice(['a', 'b', 'c', 'd'], n),
+        'review_aroma': rng.randint(0, 11, n) / 2,
+        'review_taste': rng.randint(0, 11, n) / 2,
+        'beer_style': rng.choice([f'style {i}' for i in range(8)], n,
+                                 p=[.3, .2, .15, .1, .1, .1, .03, .02])
+    })
+
+
+def _chunks(df, chunksize):
+    return (df.iloc[start:start + chunksize]
+            for start in range(0, len(df), chunksize))
+
+
+def _split(df, path, chunksize, **kwargs):
+    counts = split_sets_streaming(_chunks(df, chunksize), 'beer_style',
+                                  path, **kwargs)
+    return counts, load_sets(path)
+
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'stratify': False},
+    {'key_cols': ['brewery_name', 'review_aroma', 'review_taste']},
+    {'fmt': 'csv'}
+])
+def test_split_sets_streaming_chunk_size_invariant(reviews, tmp_path,
+                                                   kwargs):
+    counts, sets = _split(reviews, tmp_path / 'small', 333, **kwargs)
+    other_counts, other_sets = _split(reviews, tmp_path / 'large', 5000,
+                                      **kwargs)
+
+    pd.testing.assert_frame_equal(counts, other_counts)
+    for one, other in zip(sets, other_sets):
+        if isinstance(one, pd.DataFrame):
+            pd.testing.assert_frame_equal(one, other)
+        else:
+            pd.testing.assert_series_equal(one, other)
+
+
+@pytest.mark.parametrize('fmt', ['parquet', 'csv'])
+def test_split_sets_streaming_round_trip(reviews, tmp_path, fmt):
+    counts, sets = _split(reviews, tmp_path, 1000, fmt=fmt)
+    X_train, X_test, X_val, y_train, y_test, y_val = sets
+
+    X = pd.concat([X_train, X_test, X_val], ignore_index=True)
+    y = pd.concat([y_train, y_test, y_val], ignore_index=True)
+    result = X.assign(beer_style=y.astype(object).to_numpy())
+    key = list(reviews.columns)
+    expected = reviews.sort_values(key, ignore_index=True)
+    pd.testing.assert_frame_equal(
+        result.sort_values(key, ignore_index=True)[key], expected,
+        check_dtype=False, check_categorical=False)
+
+    assert counts.sum().to_dict() == {'train': len(y_train),
+                                      'val': len(y_val),
+                                      'test': len(y_test)}
+    # Stratified: every set holds its share of each class to within a few
+    # observations
+    expected_test = 0.2 * counts.sum(1)
+    assert (counts['test'] - expected_test).abs().max() <= 2